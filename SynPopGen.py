@@ -3,6 +3,7 @@ import os
 
 import data.census.raw
 import data.spatial.zones
+import data.spatial.gates
 import data.hts.cleaned
 import data.hts.filtered
 import data.census.cleaned
@@ -37,10 +38,21 @@ class contexts:
     configs.update({"sampling_rate": 1.00})
     configs.update({"random_seed": 1234})
 
+    # Solver of the work and education locations of persons in zones different from their home zone, either
+    # "heuristic" (greedy per person) or "transport" (optimal transport over candidate facilities per zone)
+    configs.update({"primary_solver": "heuristic"})
+
+    # Time budgets (in seconds) of the secondary locations assignment as a whole and per chain of secondary activities,
+    # returning the best locations found when exhausted (0 for no budget). With an overall budget, short chains are
+    # solved first and invalid chains are solved again with the time left
+    configs.update({"secondary_time_budget": 0})
+    configs.update({"secondary_chain_time_budget": 0})
+
     # Paths to the input data and where the output should be stored
     configs.update({"data_path": cwd + "/input"})
     configs.update({"output_path": cwd + "/output"})
     configs.update({"analysis_path": cwd + "/output/Analysis"})
+    configs.update({"cache_path": cwd + "/cache"}) # also keeps snapshots of the parsed lookup workbooks/codebooks
 
     configs.update({"territory_codes_file": "/0_Code_Lists/territory_codes.xlsx"})
     configs.update({"generalizations_file": "generalizations.xlsx"})
@@ -98,124 +110,128 @@ class contexts:
 
         return value
 
-# Initiate the pipeline stages
-context = contexts()
-cwd = os.getcwd()
-
-try:
-    context.stages["data.spatial.zones"] = pickle.load(open(cwd + "/cache/data.spatial.zones.p", "rb" ))
-except:
-    data.spatial.zones.validate(context)
-    context.stages["data.spatial.zones"] = data.spatial.zones.execute(context)
-    pickle.dump(context.stages["data.spatial.zones"], open(cwd + "/cache/data.spatial.zones.p", "wb" ))
-
-try:
-    context.stages["data.census.raw"] = pickle.load(open(cwd + "/cache/data.census.raw.p", "rb" ))
-except:
-    data.census.raw.validate(context)
-    context.stages["data.census.raw"] = data.census.raw.execute(context)
-    pickle.dump(context.stages["data.census.raw"], open(cwd + "/cache/data.census.raw.p", "wb" ))
-
-try:
-    context.stages["data.census.cleaned"] = pickle.load(open(cwd + "/cache/data.census.cleaned.p", "rb" ))
-except:
-    data.census.cleaned.validate(context)
-    context.stages["data.census.cleaned"] = data.census.cleaned.execute(context)
-    pickle.dump(context.stages["data.census.cleaned"], open(cwd + "/cache/data.census.cleaned.p", "wb" ))
-
-try:
-    context.stages["data.hts.cleaned"] = pickle.load(open(cwd + "/cache/data.hts.cleaned.p", "rb" ))
-except:
-    data.hts.cleaned.validate(context)
-    context.stages["data.hts.cleaned"] = data.hts.cleaned.execute(context)
-    pickle.dump(context.stages["data.hts.cleaned"], open(cwd + "/cache/data.hts.cleaned.p", "wb" ))
-
-try:
-    context.stages["data.hts.filtered"] = pickle.load(open(cwd + "/cache/data.hts.filtered.p", "rb" ))
-except:
-    data.hts.filtered.validate(context)
-    context.stages["data.hts.filtered"] = data.hts.filtered.execute(context)
-    pickle.dump(context.stages["data.hts.filtered"], open(cwd + "/cache/data.hts.filtered.p", "wb" ))
-
-try:
-    context.stages["synthesis.population.trips"] = pickle.load(open(cwd + "/cache/synthesis.population.trips.p", "rb" ))
-except:
-    synthesis.population.trips.validate(context)
-    context.stages["synthesis.population.trips"] = synthesis.population.trips.execute(context)
-    pickle.dump(context.stages["synthesis.population.trips"], open(cwd + "/cache/synthesis.population.trips.p", "wb" ))
-
-try:
-    context.stages["synthesis.destinations"] = pickle.load(open(cwd + "/cache/synthesis.destinations.p", "rb" ))
-except:
-    synthesis.destinations.validate(context)
-    context.stages["synthesis.destinations"] = synthesis.destinations.execute(context)
-    pickle.dump(context.stages["synthesis.destinations"], open(cwd + "/cache/synthesis.destinations.p", "wb" ))
-
-try:
-    context.stages["synthesis.population.spatial.by_person.primary_zones"] = \
-        pickle.load(open(cwd + "/cache/synthesis.population.spatial.by_person.primary_zones.p", "rb" ))
-except:
-    synthesis.population.spatial.by_person.primary_zones.validate(context)
-    context.stages["synthesis.population.spatial.by_person.primary_zones"] = \
-        synthesis.population.spatial.by_person.primary_zones.execute(context)
-    pickle.dump(context.stages["synthesis.population.spatial.by_person.primary_zones"],
-                open(cwd + "/cache/synthesis.population.spatial.by_person.primary_zones.p", "wb" ))
-
-try:
-    context.stages["synthesis.population.spatial.by_person.primary_locations"] = \
-        pickle.load(open(cwd + "/cache/synthesis.population.spatial.by_person.primary_locations.p", "rb" ))
-except:
-    synthesis.population.spatial.by_person.primary_locations.validate(context)
-    context.stages["synthesis.population.spatial.by_person.primary_locations"] = \
-        synthesis.population.spatial.by_person.primary_locations.execute(context)
-    pickle.dump(context.stages["synthesis.population.spatial.by_person.primary_locations"],
-                open(cwd + "/cache/synthesis.population.spatial.by_person.primary_locations.p", "wb" ))
+# Run the pipeline only when executed as a script, since worker processes of the stages (spawned on Windows and
+# macOS) import this module again
+if __name__ == "__main__":
+
+    # Initiate the pipeline stages
+    context = contexts()
+    cwd = os.getcwd()
+
+    try:
+        context.stages["data.spatial.zones"] = pickle.load(open(cwd + "/cache/data.spatial.zones.p", "rb" ))
+    except:
+        data.spatial.zones.validate(context)
+        context.stages["data.spatial.zones"] = data.spatial.zones.execute(context)
+        pickle.dump(context.stages["data.spatial.zones"], open(cwd + "/cache/data.spatial.zones.p", "wb" ))
+
+    try:
+        context.stages["data.census.raw"] = pickle.load(open(cwd + "/cache/data.census.raw.p", "rb" ))
+    except:
+        data.census.raw.validate(context)
+        context.stages["data.census.raw"] = data.census.raw.execute(context)
+        pickle.dump(context.stages["data.census.raw"], open(cwd + "/cache/data.census.raw.p", "wb" ))
+
+    try:
+        context.stages["data.census.cleaned"] = pickle.load(open(cwd + "/cache/data.census.cleaned.p", "rb" ))
+    except:
+        data.census.cleaned.validate(context)
+        context.stages["data.census.cleaned"] = data.census.cleaned.execute(context)
+        pickle.dump(context.stages["data.census.cleaned"], open(cwd + "/cache/data.census.cleaned.p", "wb" ))
+
+    try:
+        context.stages["data.hts.cleaned"] = pickle.load(open(cwd + "/cache/data.hts.cleaned.p", "rb" ))
+    except:
+        data.hts.cleaned.validate(context)
+        context.stages["data.hts.cleaned"] = data.hts.cleaned.execute(context)
+        pickle.dump(context.stages["data.hts.cleaned"], open(cwd + "/cache/data.hts.cleaned.p", "wb" ))
+
+    try:
+        context.stages["data.hts.filtered"] = pickle.load(open(cwd + "/cache/data.hts.filtered.p", "rb" ))
+    except:
+        data.hts.filtered.validate(context)
+        context.stages["data.hts.filtered"] = data.hts.filtered.execute(context)
+        pickle.dump(context.stages["data.hts.filtered"], open(cwd + "/cache/data.hts.filtered.p", "wb" ))
+
+    try:
+        context.stages["synthesis.population.trips"] = pickle.load(open(cwd + "/cache/synthesis.population.trips.p", "rb" ))
+    except:
+        synthesis.population.trips.validate(context)
+        context.stages["synthesis.population.trips"] = synthesis.population.trips.execute(context)
+        pickle.dump(context.stages["synthesis.population.trips"], open(cwd + "/cache/synthesis.population.trips.p", "wb" ))
+
+    try:
+        context.stages["synthesis.destinations"] = pickle.load(open(cwd + "/cache/synthesis.destinations.p", "rb" ))
+    except:
+        synthesis.destinations.validate(context)
+        context.stages["synthesis.destinations"] = synthesis.destinations.execute(context)
+        pickle.dump(context.stages["synthesis.destinations"], open(cwd + "/cache/synthesis.destinations.p", "wb" ))
+
+    try:
+        context.stages["synthesis.population.spatial.by_person.primary_zones"] = \
+            pickle.load(open(cwd + "/cache/synthesis.population.spatial.by_person.primary_zones.p", "rb" ))
+    except:
+        synthesis.population.spatial.by_person.primary_zones.validate(context)
+        context.stages["synthesis.population.spatial.by_person.primary_zones"] = \
+            synthesis.population.spatial.by_person.primary_zones.execute(context)
+        pickle.dump(context.stages["synthesis.population.spatial.by_person.primary_zones"],
+                    open(cwd + "/cache/synthesis.population.spatial.by_person.primary_zones.p", "wb" ))
+
+    try:
+        context.stages["synthesis.population.spatial.by_person.primary_locations"] = \
+            pickle.load(open(cwd + "/cache/synthesis.population.spatial.by_person.primary_locations.p", "rb" ))
+    except:
+        synthesis.population.spatial.by_person.primary_locations.validate(context)
+        context.stages["synthesis.population.spatial.by_person.primary_locations"] = \
+            synthesis.population.spatial.by_person.primary_locations.execute(context)
+        pickle.dump(context.stages["synthesis.population.spatial.by_person.primary_locations"],
+                    open(cwd + "/cache/synthesis.population.spatial.by_person.primary_locations.p", "wb" ))
     
-try:
-    context.stages["synthesis.population.spatial.by_person.secondary.distance_distributions"] = \
-        pickle.load(open(cwd + "/cache/synthesis.population.spatial.by_person.secondary.distance_distributions.p", "rb" ))
-except:
-    synthesis.population.spatial.by_person.secondary.distance_distributions.validate(context)
-    context.stages["synthesis.population.spatial.by_person.secondary.distance_distributions"] = \
-        synthesis.population.spatial.by_person.secondary.distance_distributions.execute(context)
-    pickle.dump(context.stages["synthesis.population.spatial.by_person.secondary.distance_distributions"],
-                open(cwd + "/cache/synthesis.population.spatial.by_person.secondary.distance_distributions.p", "wb" ))
-
-try:
-    context.stages["synthesis.population.spatial.by_person.secondary.locations"] = \
-        pickle.load(open(cwd + "/cache/synthesis.population.spatial.by_person.secondary.locations.p", "rb" ))
-except:
-    synthesis.population.spatial.by_person.secondary.locations.validate(context)
-    context.stages["synthesis.population.spatial.by_person.secondary.locations"] = \
-        synthesis.population.spatial.by_person.secondary.locations.execute(context)
-    pickle.dump(context.stages["synthesis.population.spatial.by_person.secondary.locations"],
-                open(cwd + "/cache/synthesis.population.spatial.by_person.secondary.locations.p", "wb" ))
-
-try:
-    context.stages["matsim.scenario.population"] = pickle.load(open(cwd + "/cache/matsim.scenario.population.p", "rb" ))
-except:
-    matsim.scenario.population.validate(context)
-    context.stages["matsim.scenario.population"] = matsim.scenario.population.execute(context)
-    pickle.dump(context.stages["matsim.scenario.population"], open(cwd + "/cache/matsim.scenario.population.p", "wb" ))
-
-# Not at the moment
-# try:
-#     context.stages["matsim.scenario.households"] = pickle.load(open(cwd + "/cache/matsim.scenario.households.p", "rb" ))
-# except:
-#     matsim.scenario.households.validate(context)
-#     context.stages["matsim.scenario.households"] = matsim.scenario.households.execute(context)
-#     pickle.dump(context.stages["matsim.scenario.households"], open(cwd + "/cache/matsim.scenario.households.p", "wb" ))
-
-try:
-    context.stages["matsim.scenario.facilities"] = pickle.load(open(cwd + "/cache/matsim.scenario.facilities.p", "rb" ))
-except:
-    matsim.scenario.facilities.validate(context)
-    context.stages["matsim.scenario.facilities"] = matsim.scenario.facilities.execute(context)
-    pickle.dump(context.stages["matsim.scenario.facilities"], open(cwd + "/cache/matsim.scenario.facilities.p", "wb" ))
-
-try:
-    context.stages["synthesis.output"] = pickle.load(open(cwd + "/cache/synthesis.output.p", "rb" ))
-except:
-    synthesis.output.validate(context)
-    context.stages["synthesis.output"] = synthesis.output.execute(context)
-    pickle.dump(context.stages["synthesis.output"], open(cwd + "/cache/synthesis.output.p", "wb" ))
\ No newline at end of file
+    try:
+        context.stages["synthesis.population.spatial.by_person.secondary.distance_distributions"] = \
+            pickle.load(open(cwd + "/cache/synthesis.population.spatial.by_person.secondary.distance_distributions.p", "rb" ))
+    except:
+        synthesis.population.spatial.by_person.secondary.distance_distributions.validate(context)
+        context.stages["synthesis.population.spatial.by_person.secondary.distance_distributions"] = \
+            synthesis.population.spatial.by_person.secondary.distance_distributions.execute(context)
+        pickle.dump(context.stages["synthesis.population.spatial.by_person.secondary.distance_distributions"],
+                    open(cwd + "/cache/synthesis.population.spatial.by_person.secondary.distance_distributions.p", "wb" ))
+
+    try:
+        context.stages["synthesis.population.spatial.by_person.secondary.locations"] = \
+            pickle.load(open(cwd + "/cache/synthesis.population.spatial.by_person.secondary.locations.p", "rb" ))
+    except:
+        synthesis.population.spatial.by_person.secondary.locations.validate(context)
+        context.stages["synthesis.population.spatial.by_person.secondary.locations"] = \
+            synthesis.population.spatial.by_person.secondary.locations.execute(context)
+        pickle.dump(context.stages["synthesis.population.spatial.by_person.secondary.locations"],
+                    open(cwd + "/cache/synthesis.population.spatial.by_person.secondary.locations.p", "wb" ))
+
+    try:
+        context.stages["matsim.scenario.population"] = pickle.load(open(cwd + "/cache/matsim.scenario.population.p", "rb" ))
+    except:
+        matsim.scenario.population.validate(context)
+        context.stages["matsim.scenario.population"] = matsim.scenario.population.execute(context)
+        pickle.dump(context.stages["matsim.scenario.population"], open(cwd + "/cache/matsim.scenario.population.p", "wb" ))
+
+    # Not at the moment
+    # try:
+    #     context.stages["matsim.scenario.households"] = pickle.load(open(cwd + "/cache/matsim.scenario.households.p", "rb" ))
+    # except:
+    #     matsim.scenario.households.validate(context)
+    #     context.stages["matsim.scenario.households"] = matsim.scenario.households.execute(context)
+    #     pickle.dump(context.stages["matsim.scenario.households"], open(cwd + "/cache/matsim.scenario.households.p", "wb" ))
+
+    try:
+        context.stages["matsim.scenario.facilities"] = pickle.load(open(cwd + "/cache/matsim.scenario.facilities.p", "rb" ))
+    except:
+        matsim.scenario.facilities.validate(context)
+        context.stages["matsim.scenario.facilities"] = matsim.scenario.facilities.execute(context)
+        pickle.dump(context.stages["matsim.scenario.facilities"], open(cwd + "/cache/matsim.scenario.facilities.p", "wb" ))
+
+    try:
+        context.stages["synthesis.output"] = pickle.load(open(cwd + "/cache/synthesis.output.p", "rb" ))
+    except:
+        synthesis.output.validate(context)
+        context.stages["synthesis.output"] = synthesis.output.execute(context)
+        pickle.dump(context.stages["synthesis.output"], open(cwd + "/cache/synthesis.output.p", "wb" ))
\ No newline at end of file
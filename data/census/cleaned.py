@@ -8,6 +8,7 @@ def configure(context):
     context.config("data_path")
     context.config("generalizations_file")
     context.config("routes_file")
+    context.config("cache_path")
 
 def validate(context):
     data_path = context.config("data_path")
@@ -39,29 +40,23 @@ def execute(context):
     # Ignore header warning when reading excel files
     warnings.filterwarnings('ignore', category=UserWarning, module='openpyxl')
 
-    # Import generalizations
-    df_age = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                           header=None, skiprows=1, sheet_name='Person Age', dtype=str)
-    df_edu = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                           header=None, skiprows=1, sheet_name='Person Education', dtype=str)
-    df_age_place = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                           header=None, skiprows=1, sheet_name='EducationPlace FacilityType', dtype=str)
+    # Import generalizations (lookup workbooks are parsed only once, see commonFunctions.readLookupSheet)
+    cache_path = context.config("cache_path")
+    generalizations_file = "%s/%s" % (context.config("data_path"), context.config("generalizations_file"))
+    df_age = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'Person Age', skiprows=1)
+    df_edu = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'Person Education', skiprows=1)
+    df_age_place = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'EducationPlace FacilityType', skiprows=1)
     # df_ap_type = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
     #                            header=None, skiprows=1, sheet_name='Household ApartmentType', dtype=str) # not at the moment
-    df_activity_CityHTS = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                                      header=None, skiprows=1, sheet_name='Person Activity (CityHTS)', dtype=str)
-    df_primary_loc_home = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                                        header=None, skiprows=1, sheet_name='Person PrimaryLocRelationHome', dtype=str)
-    df_journey_mode = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                                    header=None, skiprows=1, sheet_name='Person JourneyMainMode', dtype=str)
-    df_journey_t = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                                 header=None, skiprows=1, sheet_name='Person DeclaredTripTime', dtype=str)
-    df_sector_activity = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                                       header=None, skiprows=1, sheet_name='ActivitySector FacilityUsage', dtype=str)
-    df_routes_gate = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("routes_file")),
-                                        header=0,
-                                   # encoding="cp1250",
-                                   dtype=str)[["KOD_LAU2", "Total_HourCostDrive", "GATEosm_id"]]
+    df_activity_CityHTS = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'Person Activity (CityHTS)', skiprows=1)
+    df_primary_loc_home = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'Person PrimaryLocRelationHome', skiprows=1)
+    df_journey_mode = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'Person JourneyMainMode', skiprows=1)
+    df_journey_t = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'Person DeclaredTripTime', skiprows=1)
+    df_sector_activity = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'ActivitySector FacilityUsage', skiprows=1)
+    df_routes_gate = commonFunctions.readLookupSheet("%s/%s" % (context.config("data_path"),
+                                                                context.config("routes_file")),
+                                                     cache_path, header=0)[["KOD_LAU2", "Total_HourCostDrive",
+                                                                            "GATEosm_id"]]
     df_routes_gate["Total_HourCostDrive"] = df_routes_gate["Total_HourCostDrive"].astype(float)
     df_routes_gate["Total_HourCostDrive"] = df_routes_gate["Total_HourCostDrive"] * 60
     df_routes_gate["Total_HourCostDrive"] = df_routes_gate["Total_HourCostDrive"].astype(int)
@@ -2,12 +2,14 @@ import numpy as np
 import pandas as pd
 import os
 from tqdm import tqdm
+from data import commonFunctions
 import warnings
 
 def configure(context):
     context.config("data_path")
     context.config("census_file")
     context.config("territory_codes_file")
+    context.config("cache_path")
 
 def validate(context):
     data_path = context.config("data_path")
@@ -93,10 +95,9 @@ def execute(context):
                           delimiter=',', chunksize=CHUNK_SIZE, encoding="cp1250", dtype=str)
 
     # Get territorial codes
-    df_codes = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("territory_codes_file")),
-                             header=0,
-                             # encoding="cp1250",
-                             dtype='str')
+    df_codes = commonFunctions.readLookupSheet("%s/%s" % (context.config("data_path"),
+                                                          context.config("territory_codes_file")),
+                                               context.config("cache_path"), header=0)
 
     # Get towns within 89 minutes of Ústí nad Labem (not at the moment)
     # df_routes_time_dist = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("routes_file")),
@@ -1,27 +1,232 @@
 import pandas as pd
 import numpy as np
+import xml.etree.ElementTree as ET
+import functools
+import hashlib
+import pickle
+import os
+
+# Lookup tables (workbooks and codebooks) already parsed in this run, keyed by their snapshot name
+LOOKUP_TABLES = dict()
+
+# Codes of the categories with multiple values per facility or person (FacilityPurpose, FacilityUsage, ActivitySector,
+# EducationPlace), encoded as bits of integer masks, and the code meaning any category
+CATEGORY_CODES = ('0', '1', '2', '3', '4', '5', '6', '7', '8', '9')
+WILDCARD_CODE = '99'
+
+def fileDigest(file_path):
+    """SHA-1 digest of the content of a file"""
+
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def loadLookupTable(file_path, cache_path, parser):
+    """Parse a lookup file only once per content, keeping it in memory and as a binary snapshot in cache_path"""
+
+    snapshot_name = "%s.%s.%s.p" % (os.path.basename(file_path), parser.__name__, fileDigest(file_path))
+
+    if snapshot_name in LOOKUP_TABLES:
+        return LOOKUP_TABLES[snapshot_name]
+
+    snapshot_file = "%s/%s" % (cache_path, snapshot_name)
+    try:
+        with open(snapshot_file, "rb") as f:
+            table = pickle.load(f)
+    except Exception:
+        # Snapshot not found (or the file changed since), or not readable any more (e.g. pickled by other versions
+        # of the libraries), parse the original file and write the snapshot again
+        table = parser(file_path)
+        if os.path.isdir(cache_path):
+            with open(snapshot_file, "wb") as f:
+                pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    LOOKUP_TABLES[snapshot_name] = table
+
+    return table
+
+def parseWorkbook(file_path):
+    """Read all sheets of an excel file as strings, without header"""
+
+    sheets = pd.read_excel(file_path, sheet_name=None, header=None, dtype=str)
+
+    if len(sheets) == 0:
+        raise RuntimeError("Workbook without sheets: %s" % file_path)
+
+    for sheet_name, df_sheet in sheets.items():
+        if len(df_sheet) == 0:
+            raise RuntimeError("Empty sheet %s in workbook: %s" % (sheet_name, file_path))
+
+    return sheets
+
+def parseCodebook(file_path):
+    """Read the variables of an HTS codebook (*_popis.xml) as (code, type, [(factor name, factor code)])"""
+
+    variables = []
+    for variable in ET.parse(file_path).getroot().findall("variable"):
+        factors = [(factor.get("name"), factor.get("code")) for factor in variable.findall("factor")]
+
+        if variable.get("code") is None or any(code is None for _, code in factors):
+            raise RuntimeError("Variable or factor without code in codebook: %s" % file_path)
+
+        variables.append((variable.get("code"), variable.get("type"), factors))
+
+    return variables
+
+def readLookupSheet(file_path, cache_path, sheet_name=0, header=None, skiprows=0):
+    """Get a sheet of an excel file as strings (like pd.read_excel with dtype=str) parsing the file only once"""
+
+    sheets = loadLookupTable(file_path, cache_path, parseWorkbook)
+
+    if sheet_name == 0:
+        sheet_name = list(sheets.keys())[0]
+    if sheet_name not in sheets:
+        raise RuntimeError("Sheet %s not found in: %s" % (sheet_name, file_path))
+
+    df_sheet = sheets[sheet_name].iloc[skiprows:]
+    if header == 0:
+        columns = [column if isinstance(column, str) else "Unnamed: %d" % ind
+                   for ind, column in enumerate(df_sheet.iloc[0])]
+        df_sheet = df_sheet.iloc[1:]
+        df_sheet.columns = columns
+    elif header is not None:
+        raise ValueError("Only header=None or header=0 are supported")
+
+    return df_sheet.reset_index(drop=True).copy()
+
+def readCodebook(file_path, cache_path):
+    """Get the variables of an HTS codebook (see parseCodebook) parsing the file only once"""
+
+    return loadLookupTable(file_path, cache_path, parseCodebook)
+
+@functools.lru_cache(maxsize=None)
+def compileAggregation(alg_cols, input_cols):
+    """Compile aggregation rules of the generalizations.xlsx file into a sum-of-columns plan
+
+    Rules are applied in order, so a rule reading a column written by an earlier rule sums the source columns of that
+    rule instead. Returns the source columns (grouped by rule), the start of each rule in them, the algorithm columns
+    of the rules and the source columns to drop after aggregating."""
+
+    assert len(alg_cols) >= len(input_cols)
+
+    sources = []
+    starts = []
+    targets = []
+    drop_cols = []
+    aggregated = dict() # source columns of the columns written by the rules so far
+    for alg_col, cols_str in zip(alg_cols, input_cols):
+        cols = [col_str.strip() for col_str in cols_str.split(";")]
+        rule_sources = [source for col in cols for source in aggregated.get(col, [col])]
+        starts.append(len(sources))
+        sources.extend(rule_sources)
+        targets.append(alg_col)
+        aggregated[alg_col] = rule_sources
+        # Source columns of each rule other than the one it writes are dropped, as when aggregating rule by rule
+        drop_cols.extend([col for col in cols if col != alg_col and col not in drop_cols])
+
+    return sources, np.array(starts), targets, drop_cols
+
+def applyAggregation(plan, input_df):
+    """Sum columns of a dataframe following a plan from compileAggregation"""
+
+    sources, starts, targets, drop_cols = plan
+
+    values = input_df[sources].to_numpy()
+    if values.dtype.kind == 'f':
+        # Missing values are skipped as in DataFrame.sum
+        values = np.nan_to_num(values)
+    sums = np.add.reduceat(values, starts, axis=1)
+
+    input_df = input_df.drop([col for col in drop_cols if col not in targets], axis=1)
+    for target_ind, target in enumerate(targets):
+        input_df[target] = sums[:, target_ind]
+
+    # Columns written by a rule and read by another one are dropped as well
+    read_targets = [col for col in drop_cols if col in targets]
+    if len(read_targets) > 0:
+        input_df = input_df.drop(read_targets, axis=1)
+
+    return input_df
+
+@functools.lru_cache(maxsize=None)
+def compileValMapping(alg_groups, input_groups):
+    """Compile value groups (bin edges) of the generalizations.xlsx file into bins and labels for pd.cut-like mapping"""
+
+    assert len(alg_groups) + 1 == len(input_groups)
+
+    bins = np.asarray(input_groups)
+    if np.any(np.diff(bins) <= 0):
+        raise ValueError("bins must increase monotonically.")
+
+    return bins, pd.Index(alg_groups)
+
+def applyValMapping(compiled, input_df):
+    """Group values of a series in the right-closed bins from compileValMapping (as pd.cut with labels)"""
+
+    bins, labels = compiled
+
+    values = input_df.to_numpy().astype(bins.dtype, copy=False)
+    codes = np.searchsorted(bins, values, side='left') - 1
+    codes[(codes < 0) | (codes >= len(labels))] = -1 # out of bins (or missing)
+    groups = pd.Categorical.from_codes(codes, categories=labels, ordered=True)
+
+    return pd.Series(groups, index=input_df.index, name=input_df.name)
+
+@functools.lru_cache(maxsize=None)
+def compileStdMapping(alg_groups, input_groups):
+    """Compile value changes of the generalizations.xlsx file into categorical code translation arrays
+
+    Returns the input values (categories) and, for each of them plus a last slot for unmapped values, the tuple of
+    algorithm groups, the same groups joined as text and whether there are multiple groups."""
+
+    assert len(alg_groups) >= len(input_groups)
+
+    mapping = dict()
+    for alg_group, input_vals in zip(alg_groups, input_groups):
+        if not isinstance(input_vals, str):
+            # nan
+            continue
+        for input_val in input_vals.split(','):
+            mapping.setdefault(input_val.strip(), []).append(alg_group)
+
+    categories = pd.Index(list(mapping.keys()), dtype=object)
+    tuples = np.full(len(categories) + 1, np.nan, dtype=object)
+    joined = np.full(len(categories) + 1, np.nan, dtype=object)
+    multiple = np.zeros(len(categories) + 1, dtype=bool)
+    for val_ind, groups in enumerate(mapping.values()):
+        tuples[val_ind] = tuple(groups)
+        joined[val_ind] = ', '.join([str(group) for group in groups])
+        multiple[val_ind] = len(groups) > 1
+
+    return categories, tuples, joined, multiple
+
+def applyStdMapping(compiled, input_df):
+    """Change values of a series with the translation arrays from compileStdMapping
+
+    Values are kept as tuples of groups when any value of the series has multiple groups, otherwise as text."""
+
+    categories, tuples, joined, multiple = compiled
+
+    # Unmapped values get code -1, i.e. the last slot (nan) of the translation arrays
+    codes = categories.get_indexer(input_df)
+    table = tuples if multiple[codes].any() else joined
+
+    return pd.Series(table[codes], index=input_df.index, name=input_df.name)
 
 def aggregateColumns(alg_cols, input_cols_obj, input_df_obj):
     """Aggregate (sum) values of columns based on instructions in the generalizations.xlsx file"""
 
-    assert type(input_df_obj) == type(input_cols_obj)
-
-    if isinstance(input_df_obj, pd.Series):
-        assert len(alg_cols) >= len(input_cols_obj)
-        for cols_ind, input_cols in enumerate(input_cols_obj):
-            input_cols = [input_col.strip() for input_col in input_cols.split(";")]
-            input_df_obj[alg_cols[cols_ind]] = input_df_obj[input_cols].sum(axis=1)
+    if isinstance(input_df_obj, pd.DataFrame):
+        plan = compileAggregation(tuple(alg_cols), tuple(input_cols_obj))
+        input_df_obj = applyAggregation(plan, input_df_obj)
     else:
         assert len(input_df_obj) == len(input_cols_obj)
         for input_ind, input_cols in enumerate(input_cols_obj):
-            assert len(alg_cols) >= len(input_cols)
-            for cols_ind, cols_str in enumerate(input_cols):
-                cols = [col_str.strip() for col_str in cols_str.split(";")]
-                input_df_obj[input_ind][alg_cols[cols_ind]] = input_df_obj[input_ind][cols].sum(axis=1).copy()
-            for cols_ind, cols_str in enumerate(input_cols):
-                cols = [col_str.strip() for col_str in cols_str.split(";")
-                        if col_str.strip() != alg_cols[cols_ind]]
-                input_df_obj[input_ind] = input_df_obj[input_ind].drop(cols, axis=1).copy()
+            plan = compileAggregation(tuple(alg_cols), tuple(input_cols))
+            input_df_obj[input_ind] = applyAggregation(plan, input_df_obj[input_ind])
 
     return input_df_obj
 
@@ -31,14 +236,12 @@ def mappingValCategories(alg_groups, input_groups_obj, input_df_obj):
     assert type(input_df_obj) == type(input_groups_obj)
 
     if isinstance(input_df_obj, pd.Series):
-        assert len(alg_groups) + 1 == len(input_groups_obj)
-        input_df_obj = input_df_obj.astype(input_groups_obj.dtype)
-        input_df_obj = pd.cut(input_df_obj, input_groups_obj, labels=alg_groups)
+        compiled = compileValMapping(tuple(alg_groups), tuple(input_groups_obj))
+        input_df_obj = applyValMapping(compiled, input_df_obj)
     else:
         for input_ind, input_df in enumerate(input_df_obj):
-            assert len(alg_groups) + 1 == len(input_groups_obj[input_ind])
-            input_df_obj[input_ind] = input_df_obj[input_ind].astype(input_groups_obj[input_ind].dtype)
-            input_df_obj[input_ind] = pd.cut(input_df, input_groups_obj[input_ind], labels=alg_groups)
+            compiled = compileValMapping(tuple(alg_groups), tuple(input_groups_obj[input_ind]))
+            input_df_obj[input_ind] = applyValMapping(compiled, input_df)
 
     return input_df_obj
 
@@ -48,51 +251,211 @@ def mappingStdCategories(alg_groups, input_groups_obj, input_df_obj):
     assert type(input_df_obj) == type(input_groups_obj)
 
     if isinstance(input_df_obj, pd.Series):
-        assert len(alg_groups) >= len(input_groups_obj)
-        mapping = dict()
-        for vals_ind, input_vals in enumerate(input_groups_obj):
-            try:
-                for input_val in input_vals.split(','):
-                    input_val = input_val.strip()
-                    if mapping.__contains__(input_val):
-                        mapping[input_val].append(alg_groups[vals_ind])
-                    else:
-                        mapping.update({input_val: [alg_groups[vals_ind]]})
-            except AttributeError:
-                # nan
-                skip = 1
-        for key in mapping:
-            mapping.update({key: tuple(mapping[key])})
-
-        input_df_obj = input_df_obj.map(mapping)
-        if len(input_df_obj.loc[input_df_obj.str.len() > 1]) == 0:
-            input_df_obj = input_df_obj.apply(lambda x: ', '.join([str(i) for i in x]))
+        compiled = compileStdMapping(tuple(alg_groups), tuple(input_groups_obj))
+        input_df_obj = applyStdMapping(compiled, input_df_obj)
     else:
         assert len(input_df_obj) == len(input_groups_obj)
         for input_ind, input_groups in enumerate(input_groups_obj):
-            assert len(alg_groups) >= len(input_groups)
-            mapping = dict()
-            for vals_ind, input_vals in enumerate(input_groups):
-                try:
-                    for input_val in input_vals.split(','):
-                        input_val = input_val.strip()
-                        if mapping.__contains__(input_val):
-                            mapping[input_val].append(alg_groups[vals_ind])
-                        else:
-                            mapping.update({input_val: [alg_groups[vals_ind]]})
-                except AttributeError:
-                    # nan
-                    skip = 1
-
-            for key in mapping:
-                mapping.update({key: tuple(mapping[key])})
-
-            input_df_obj[input_ind] = input_df_obj[input_ind].map(mapping)
-            if len(input_df_obj[input_ind].loc[input_df_obj[input_ind].str.len() > 1]) == 0:
-                input_df_obj[input_ind] = input_df_obj[input_ind].apply(lambda x: ', '.join([str(i) for i in x]))
+            compiled = compileStdMapping(tuple(alg_groups), tuple(input_groups))
+            input_df_obj[input_ind] = applyStdMapping(compiled, input_df_obj[input_ind])
 
     return input_df_obj
 
+def categoryMask(value, codes=CATEGORY_CODES, text_wildcard=True):
+    """Bitmask of a value with multiple categories (tuple of codes or text), bit 0 is the wildcard (i.e. any category),
+    text equal to the wildcard code being the wildcard only if text_wildcard"""
+
+    if value == (WILDCARD_CODE,) or (text_wildcard and type(value) != tuple and value == WILDCARD_CODE):
+        return 1
+
+    try:
+        # Text values match codes by their characters as well, as when intersecting them with sets of codes
+        elements = set(value)
+    except TypeError:
+        # Missing values have no category
+        return 0
+    if type(value) != tuple:
+        elements.add(value)
+
+    mask = 0
+    for ind, code in enumerate(codes):
+        if code in elements:
+            mask |= 1 << (ind + 1)
+
+    return mask
+
+def categoryMasks(input_df, codes=CATEGORY_CODES, text_wildcard=True):
+    """Encode a column with multiple categories per value as integer bitmasks, to filter it with categoryFilter"""
+
+    masks = dict()
+    encoded = np.zeros(len(input_df), dtype=np.int64)
+    for ind, value in enumerate(input_df):
+        # Same values are encoded only once
+        try:
+            if value not in masks:
+                masks[value] = categoryMask(value, codes, text_wildcard)
+            encoded[ind] = masks[value]
+        except TypeError:
+            # Unhashable values (e.g. lists)
+            encoded[ind] = categoryMask(value, codes, text_wildcard)
+
+    return encoded
+
+def categoryFilter(masks, required_codes, codes=CATEGORY_CODES):
+    """Values encoded by categoryMasks with any of the required codes (or with the wildcard)"""
+
+    required_mask = 1
+    for ind, code in enumerate(codes):
+        if code in required_codes:
+            required_mask |= 1 << (ind + 1)
+
+    return (np.asarray(masks) & required_mask) != 0
+
+def categoryBuckets(masks, bucket_codes, codes=CATEGORY_CODES):
+    """Index in bucket_codes of the first code of each value encoded by categoryMasks (-1 if none), so that values
+    with multiple categories belong to a single bucket (as when filtering them by each code in turn)"""
+
+    buckets = np.full(len(masks), -1, dtype=int)
+    for ind, code in enumerate(bucket_codes):
+        buckets[(buckets < 0) & categoryFilter(masks, {code}, codes)] = ind
+
+    return buckets
+
+def tripMainModes(df_trips, mode_columns):
+    """Trip main mode estimated by the longest mode time of each trip (1-based index of mode_columns)"""
+
+    mode_times = df_trips[mode_columns].apply(pd.to_numeric).values
+
+    return np.argmax(mode_times, axis=1) + 1
+
+def tripOrderNums(person_ids):
+    """Order number of each trip within consecutive runs of the same person (1 for the first trip of each run)"""
+
+    person_ids = pd.Series(person_ids)
+    runs = (person_ids != person_ids.shift()).cumsum()
+
+    return person_ids.groupby(runs).cumcount().values + 1
+
+def summarizeJourneys(df_persons, df_trips, trip_modes, dest_district_codes, dest_region_codes, student_activities):
+    """Summarize the main journey of each person of an HTS, vectorized over all trips of the survey
+
+    The main journey is the first trip to work or education (education has preference for mainly students or when
+    the person has no work trip), otherwise the longest trip (in DeclaredTripTime). Trips are considered in the order
+    of df_trips. trip_modes, dest_district_codes and dest_region_codes are aligned with the rows of df_trips.
+    Returns one row per person, ordered by PersonID."""
+
+    trips = pd.DataFrame({
+        "PersonID": df_trips["PersonID"].values,
+        "DestPurpose": df_trips["DestPurpose"].values,
+        "DeclaredTripTime": df_trips["DeclaredTripTime"].values,
+        "CrowFliesTripDist": df_trips["CrowFliesTripDist"].values,
+        "DestTownCode": df_trips["DestTownCode"].values,
+        "DestState": df_trips["DestState"].values,
+        "DestDistrictCode": np.asarray(dest_district_codes),
+        "DestRegionCode": np.asarray(dest_region_codes),
+        "JourneyMainMode": np.asarray(trip_modes),
+    })
+    trips_by_person = trips.groupby("PersonID", sort=True)
+
+    # Home attributes and activity of each person (first record if repeated)
+    persons = df_persons.drop_duplicates(subset=["PersonID"]).set_index("PersonID")
+    persons = persons.reindex(trips_by_person.size().index)
+
+    has_work_trip = (trips["DestPurpose"] == "4").groupby(trips["PersonID"]).any()
+    has_edu_trip = (trips["DestPurpose"] == "5").groupby(trips["PersonID"]).any()
+    mainly_student = persons["Activity"].isin(student_activities)
+    active = has_work_trip | has_edu_trip
+
+    # Give preference to work as main journey, unless mainly student with education trips (or no work trips)
+    main_purpose = pd.Series(np.where(has_work_trip & (~mainly_student | ~has_edu_trip), "4", "5"),
+                             index=has_work_trip.index)
+
+    # Take only the first trip of the main journey, or the longest trip if no work or education trips
+    is_main_purpose = trips["DestPurpose"].values == trips["PersonID"].map(main_purpose).values
+    first_primary = pd.Series(trips.index[is_main_purpose], index=trips["PersonID"].values[is_main_purpose])
+    first_primary = first_primary.groupby(level=0).min()
+    longest = trips_by_person["DeclaredTripTime"].idxmax()
+    main_index = first_primary.reindex(longest.index).where(active, longest).astype(int)
+    main_trips = trips.loc[main_index.values].set_index(main_index.index)
+
+    # Relation of the primary location to home
+    relation = np.select([np.trunc(main_trips["DeclaredTripTime"].astype(float)) <= 5, # works/studies at residence
+                          main_trips["DestTownCode"] == persons["TownCode"], # works/studies at the same town
+                          main_trips["DestDistrictCode"] == persons["DistrictCode"], # at the same district
+                          main_trips["DestRegionCode"] == persons["RegionCode"]], # at the same region
+                         ['6', '4', '1', '2'],
+                         default='3') # at another region
+
+    df_summary = pd.DataFrame({
+        "PersonID": main_trips.index.values,
+        "PrimaryLocRelationHome": np.where(active, relation, '88'),
+        "JourneyMainMode": main_trips["JourneyMainMode"].values,
+        "DeclaredJourneyTime": main_trips["DeclaredTripTime"].values,
+        "PrimaryLocTownCode": np.where(active, main_trips["DestTownCode"], persons["TownCode"]),
+        "PrimaryLocDistrictCode": np.where(active, main_trips["DestDistrictCode"], persons["DistrictCode"]),
+        "PrimaryLocStateName": np.where(active, main_trips["DestState"], 'Česko'),
+        "PrimaryLocCrowFliesTripDist": np.where(active, main_trips["CrowFliesTripDist"], 0),
+        "HasWorkTrip": has_work_trip.values,
+        "HasEducationTrip": has_edu_trip.values,
+    })
+
+    return df_summary
+
+def sampleDistrictGates(df_district_gates, all_district_codes, random):
+    """Draw a synthetic gate for each district code, weighted by the candidate gates of the district
+
+    all_district_codes is a list of series of district codes. Gates are drawn district by district (in district code
+    order) and, within each district, series by series in their row order, which is the same random stream as drawing
+    each of them with random.choice(gates, p=probs). Codes without candidate gates get nan."""
+
+    all_gates = [np.full(len(district_codes), np.nan, dtype=object) for district_codes in all_district_codes]
+    all_rows = [pd.Series(np.asarray(district_codes)).groupby(np.asarray(district_codes), sort=False).indices
+                for district_codes in all_district_codes]
+
+    for district_code, df_gates in df_district_gates.groupby("KOD_ORP", sort=True):
+        gates = df_gates["GATEosm_id"].values
+        cdf = df_gates["Probability"].values.cumsum()
+        cdf /= cdf[-1]
+        for district_ind, district_rows in enumerate(all_rows):
+            rows = district_rows.get(district_code)
+            if rows is not None:
+                all_gates[district_ind][rows] = gates[cdf.searchsorted(random.random_sample(len(rows)), side='right')]
+
+    return all_gates
+
+def odMatrix(df_od):
+    """Sparse OD matrix of an OD dataframe (OriginID, DestID, Weight) as CSR rows per origin zone
+
+    Returns a dictionary with the zone IDs (zone index -> zone ID), the zone index of each zone ID, the CSR row
+    pointers and destination zone indices, and the weights normalized per origin together with their cumulative sum
+    (the last cumulative weight of each non-empty row is exactly 1). Repeated OD pairs are summed."""
+
+    origin_ids = df_od["OriginID"].values.astype(str)
+    dest_ids = df_od["DestID"].values.astype(str)
+    zone_ids = np.unique(np.concatenate([origin_ids, dest_ids]))
+
+    df_pairs = pd.DataFrame({"Origin": np.searchsorted(zone_ids, origin_ids),
+                             "Dest": np.searchsorted(zone_ids, dest_ids),
+                             "Weight": df_od["Weight"].values.astype(float)})
+    df_pairs = df_pairs.groupby(["Origin", "Dest"], sort=True)["Weight"].sum().reset_index()
+    origins = df_pairs["Origin"].values
+
+    indptr = np.zeros(len(zone_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(origins, minlength=len(zone_ids)), out=indptr[1:])
+
+    totals = np.bincount(origins, weights=df_pairs["Weight"].values, minlength=len(zone_ids))
+    weights = df_pairs["Weight"].values / totals[origins]
+    cum_weights = pd.Series(weights).groupby(origins).cumsum().to_numpy(copy=True)
+    row_ends = indptr[1:][indptr[1:] > indptr[:-1]]
+    cum_weights[row_ends - 1] = 1.0
+
+    return {"zone_ids": zone_ids,
+            "zone_index": {zone_id: zone_ind for zone_ind, zone_id in enumerate(zone_ids)},
+            "indptr": indptr,
+            "dest_indices": df_pairs["Dest"].values,
+            "weights": weights,
+            "cum_weights": cum_weights}
+
 def calcCityHTSJourneyTimes(trip_data):
     """Journey main mode estimated by the longest trip (in time)"""
     journeyTimes = pd.DataFrame(columns=['on foot', 'bike', 'city public transport',
@@ -1,7 +1,6 @@
 from tqdm import tqdm
 import pandas as pd
 import numpy as np
-import xml.etree.ElementTree as ET
 import geopy.distance
 import os
 from data import commonFunctions
@@ -21,6 +20,7 @@ def configure(context):
     context.config("CzechiaHTS_persons_descr_file")
     context.config("CzechiaHTS_trips_descr_file")
     context.config("CzechiaHTS_households_descr_file")
+    context.config("cache_path")
 
 def validate(context):
     data_path = context.config("data_path")
@@ -92,6 +92,10 @@ def execute(context):
 
     print("Reading Household Travel Survey (HTS) and supporting files")
 
+    # Lookup workbooks and codebooks are parsed only once (see commonFunctions.readLookupSheet)
+    cache_path = context.config("cache_path")
+    generalizations_file = "%s/%s" % (context.config("data_path"), context.config("generalizations_file"))
+
     df_CzechiaHTS_p = pd.read_csv("%s/HTS/%s" %  (context.config("data_path"), context.config("hts_CzechiaHTS_persons_file")),
                            encoding="utf8", dtype=str)
     df_CzechiaHTS_h = pd.read_csv("%s/HTS/%s" %  (context.config("data_path"), context.config("hts_CzechiaHTS_households_file")),
@@ -104,39 +108,30 @@ def execute(context):
                              encoding="utf8", dtype=str)
     df_CityHTS_t = pd.read_csv("%s/HTS/%s" %  (context.config("data_path"), context.config("hts_CityHTS_trips_file")),
                              encoding="utf8", dtype=str, delimiter=',')
-    df_codes = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("territory_codes_file")),
-                             header=0,
-                             # encoding="cp1250",
-                             dtype=str)
-    df_age = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                           header=None, skiprows=1, sheet_name='Person Age', dtype=str)
-    df_car_avail = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                                 header=None, skiprows=1, sheet_name='Person AvailCar', dtype=str)
-    df_bike_avail = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                                  header=None, skiprows=1, sheet_name='Person AvailBike', dtype=str)
-    df_pt_subs = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                               header=None, skiprows=1, sheet_name='Person PtSubscription', dtype=str)
-    df_driving_id = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                               header=None, skiprows=1, sheet_name='Person DrivingLicense', dtype=str)
-    df_edu = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                                       header=None, skiprows=1, sheet_name='Person Education', dtype=str)
-    df_activity_CzechiaHTS = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                                       header=None, skiprows=1, sheet_name='Person Activity (CzechiaHTS)', dtype=str)
-    df_activity_CityHTS = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                                       header=None, skiprows=1, sheet_name='Person Activity (CityHTS)', dtype=str)
-    df_trip_mode_times = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                                       header=None, skiprows=1, sheet_name='Trip ModeTimes (Numerical)', dtype=str)
-    df_journey_t = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                                       header=None, skiprows=1, sheet_name='Person DeclaredTripTime', dtype=str)
-    df_trip_purpose = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                                    header=None, skiprows=1, sheet_name='Trip Purpose', dtype=str)
-
-    descr_CzechiaHTS_persons = ET.parse("%s/HTS/%s" % (context.config("data_path"),
-                                            context.config("CzechiaHTS_persons_descr_file"))).getroot()
-    descr_CzechiaHTS_households = ET.parse("%s/HTS/%s" % (context.config("data_path"),
-                                               context.config("CzechiaHTS_households_descr_file"))).getroot()
-    descr_CzechiaHTS_trips = ET.parse("%s/HTS/%s" % (context.config("data_path"),
-                                          context.config("CzechiaHTS_trips_descr_file"))).getroot()
+    df_codes = commonFunctions.readLookupSheet("%s/%s" % (context.config("data_path"),
+                                                          context.config("territory_codes_file")),
+                                               cache_path, header=0)
+    df_age = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'Person Age', skiprows=1)
+    df_car_avail = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'Person AvailCar', skiprows=1)
+    df_bike_avail = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'Person AvailBike', skiprows=1)
+    df_pt_subs = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'Person PtSubscription', skiprows=1)
+    df_driving_id = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'Person DrivingLicense', skiprows=1)
+    df_edu = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'Person Education', skiprows=1)
+    df_activity_CzechiaHTS = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'Person Activity (CzechiaHTS)', skiprows=1)
+    df_activity_CityHTS = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'Person Activity (CityHTS)', skiprows=1)
+    df_trip_mode_times = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'Trip ModeTimes (Numerical)', skiprows=1)
+    df_journey_t = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'Person DeclaredTripTime', skiprows=1)
+    df_trip_purpose = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'Trip Purpose', skiprows=1)
+
+    descr_CzechiaHTS_persons = commonFunctions.readCodebook("%s/HTS/%s" % (context.config("data_path"),
+                                                            context.config("CzechiaHTS_persons_descr_file")),
+                                                            cache_path)
+    descr_CzechiaHTS_households = commonFunctions.readCodebook("%s/HTS/%s" % (context.config("data_path"),
+                                                               context.config("CzechiaHTS_households_descr_file")),
+                                                               cache_path)
+    descr_CzechiaHTS_trips = commonFunctions.readCodebook("%s/HTS/%s" % (context.config("data_path"),
+                                                          context.config("CzechiaHTS_trips_descr_file")),
+                                                          cache_path)
 
     # Select only the necessary data
     df_CzechiaHTS_p_reduced = df_CzechiaHTS_p[['P_ID',
@@ -305,14 +300,12 @@ def execute(context):
                                desc="For CzechiaHTS, some attributes are in text, changing to numbers"):
         df = df.copy()
         cols = df.columns
-        for variable_children in descrs[ind].findall("variable"):
-            column_name = variable_children.get('code')
-            if column_name in cols and variable_children.get('type') == 'factor' and column_name in df.columns:
+        for column_name, variable_type, factors in descrs[ind]:
+            if column_name in cols and variable_type == 'factor' and column_name in df.columns:
                 codes = []
-                for variable_child in variable_children.findall('factor'):
-                    code = variable_child.get('code')
+                for name, code in factors:
                     codes.append(code)
-                    df[column_name].replace(variable_child.get('name'), code, inplace=True)
+                    df[column_name].replace(name, code, inplace=True)
                 assert len(np.unique(df[column_name].dropna())) == len(codes)
         dfs[ind] = df
     df_CzechiaHTS_p_reduced, df_CzechiaHTS_h_reduced, df_CzechiaHTS_t_reduced = dfs[:]
@@ -606,26 +599,12 @@ def execute(context):
     df_CzechiaHTS_t["DestDistrictCode"] = df_CzechiaHTS_t["DestDistrictCode"].replace({'1000': '1100'})
 
     # Generate TripOrderNum for each trip of each person for CityHTS data
-    TripOrderNums = pd.DataFrame(columns=['TripID', 'TripOrderNum'])
-    last_personID = None
-    for _, trip_data in tqdm(df_CityHTS_t.sort_values(by=['TripID']).iterrows(), total=len(df_CityHTS_t), ascii=True,
-                             desc="Generating TripOrderNum for each trip of each person for CityHTS data"):
-        personID = trip_data['PersonID']
-        tripID = trip_data['TripID']
-        if personID != last_personID:
-            order_num = 1
-            last_personID = personID
-        else:
-            order_num += 1
-        to_append = pd.Series([tripID, order_num], index=TripOrderNums.columns)
-        TripOrderNums = TripOrderNums.append(to_append, ignore_index=True)
-
-    df_CityHTS_t = pd.merge(df_CityHTS_t, TripOrderNums, on='TripID')
+    df_CityHTS_t = df_CityHTS_t.sort_values(by=['TripID'])
+    df_CityHTS_t['TripOrderNum'] = commonFunctions.tripOrderNums(df_CityHTS_t['PersonID'])
 
     # Update TripOrderNum for each trip of each person for CzechiaHTS data (in case any trip had been deleted)
     df_CzechiaHTS_t = df_CzechiaHTS_t.sort_values(by=["PersonID", "TripOrderNum"])
-    trips_per_person = df_CzechiaHTS_t.groupby("PersonID").size().reset_index(name="count")["count"].values
-    df_CzechiaHTS_t["TripOrderNum"] = np.hstack([np.arange(1, n + 1) for n in trips_per_person])
+    df_CzechiaHTS_t["TripOrderNum"] = df_CzechiaHTS_t.groupby("PersonID").cumcount().values + 1
 
     # Remove persons (and all their trips) with inconsistent data
     dfs = {"persons": [df_CzechiaHTS_ph, df_CityHTS_ph], "trips": [df_CzechiaHTS_t, df_CityHTS_t]}
@@ -838,134 +817,17 @@ def execute(context):
     # e) PrimaryLocDistrictCodes for each person (the trip to primary location)
     # f) PrimaryLocCrowFliesTripDist for each person (the trip to primary location)
     # g) JourneyMainMode for each person
-    PrimaryLocRelationHomes = pd.DataFrame(columns=['PersonID', 'PrimaryLocRelationHome'])
-    JourneyMainModes = pd.DataFrame(columns=['PersonID', 'JourneyMainMode'])
-    DeclaredJourneyTimes = pd.DataFrame(columns=['PersonID', 'DeclaredJourneyTime'])
-    PrimaryLocTownCodes = pd.DataFrame(columns=['PersonID', 'PrimaryLocTownCode'])
-    PrimaryLocStateNames = pd.DataFrame(columns=['PersonID', 'PrimaryLocStateName'])
-    PrimaryLocDistrictCodes = pd.DataFrame(columns=['PersonID', 'PrimaryLocDistrictCode'])
-    PrimaryLocCrowFliesTripDists = pd.DataFrame(columns=['PersonID', 'PrimaryLocCrowFliesTripDist'])
-    HasWorkTrips = pd.DataFrame(columns=['PersonID', 'HasWorkTrip'])
-    HasEducationTrips = pd.DataFrame(columns=['PersonID', 'HasEducationTrip'])
+    print("Generating missing data (i.e. add columns) to match CzechiaHTS with Census data")
     max_DeclaredTripTime = df_CzechiaHTS_t['DeclaredTripTime'].max()
-    for person_id, trips_data in tqdm(df_CzechiaHTS_t.groupby('PersonID'), total=len(df_CzechiaHTS_ph), ascii=True,
-                               desc="Generating missing data (i.e. add columns) to match CzechiaHTS with Census data"):
-        person_row = df_CzechiaHTS_ph.loc[df_CzechiaHTS_ph['PersonID'] == person_id]
-        home_town_code = person_row.iloc[0]['TownCode']
-        home_district_code = person_row.iloc[0]['DistrictCode']
-        home_region_code = person_row.iloc[0]['RegionCode']
-
-        if person_row.iloc[0]['Activity'] in ('3', '8'):
-            mainly_student = True
-        else:
-            mainly_student = False
-        has_work_trip = False
-        has_edu_trip = False
-        if "4" in trips_data['DestPurpose'].array:
-            has_work_trip = True
-        if "5" in trips_data['DestPurpose'].array:
-            has_edu_trip = True
-
-        if has_work_trip or has_edu_trip:
-            if (not mainly_student or (mainly_student and not has_edu_trip)) and has_work_trip:
-                # Give preference to work as main journey
-                trip_data = trips_data.loc[trips_data['DestPurpose'] == '4']
-            else:
-                # Give preference to education as main journey
-                trip_data = trips_data.loc[trips_data['DestPurpose'] == '5']
-
-            trip_data = trip_data.iloc[0] # take only the first trip of the main journey
-            dest_town_code = trip_data['DestTownCode']
-            dest_state_name = trip_data['DestState']
-            dest_district_code = trip_data['DestDistrictCode']
-            dest_row = df_codes.loc[df_codes['KOD_ORP_CSU'] == dest_district_code]
-            dest_region_code = dest_row.iloc[0]['KOD_KRAJ']
-            if int(trip_data['DeclaredTripTime']) <= 5:
-                # If works/studies at residence (if it takes 5 minutes or less)
-                to_append = pd.Series([person_id, '6'], index=PrimaryLocRelationHomes.columns)
-                PrimaryLocRelationHomes = PrimaryLocRelationHomes.append(to_append, ignore_index=True)
-            elif dest_town_code == home_town_code:
-                # If works/studies at the same town
-                to_append = pd.Series([person_id, '4'], index=PrimaryLocRelationHomes.columns)
-                PrimaryLocRelationHomes = PrimaryLocRelationHomes.append(to_append, ignore_index=True)
-            elif dest_district_code == home_district_code:
-                # If works/studies at the same district
-                to_append = pd.Series([person_id, '1'], index=PrimaryLocRelationHomes.columns)
-                PrimaryLocRelationHomes = PrimaryLocRelationHomes.append(to_append, ignore_index=True)
-            elif dest_region_code == home_region_code:
-                # If works/studies at the same region
-                to_append = pd.Series([person_id, '2'], index=PrimaryLocRelationHomes.columns)
-                PrimaryLocRelationHomes = PrimaryLocRelationHomes.append(to_append, ignore_index=True)
-            else:
-                # If works/studies at another region
-                to_append = pd.Series([person_id, '3'], index=PrimaryLocRelationHomes.columns)
-                PrimaryLocRelationHomes = PrimaryLocRelationHomes.append(to_append, ignore_index=True)
-
-            DeclaredTripTime = trip_data['DeclaredTripTime']
-            CrowFliesTripDist = trip_data['CrowFliesTripDist']
-            trip_main_mode = trip_data['TripMainMode']
-            to_append = pd.Series([person_id, trip_main_mode], index=JourneyMainModes.columns)
-            JourneyMainModes = JourneyMainModes.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, DeclaredTripTime], index=DeclaredJourneyTimes.columns)
-            DeclaredJourneyTimes = DeclaredJourneyTimes.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, dest_town_code], index=PrimaryLocTownCodes.columns)
-            PrimaryLocTownCodes = PrimaryLocTownCodes.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, dest_district_code], index=PrimaryLocDistrictCodes.columns)
-            PrimaryLocDistrictCodes = PrimaryLocDistrictCodes.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, dest_state_name], index=PrimaryLocStateNames.columns)
-            PrimaryLocStateNames = PrimaryLocStateNames.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, CrowFliesTripDist], index=PrimaryLocCrowFliesTripDists.columns)
-            PrimaryLocCrowFliesTripDists = PrimaryLocCrowFliesTripDists.append(to_append, ignore_index=True)
-
-            if has_work_trip:
-                to_append = pd.Series([person_id, True], index=HasWorkTrips.columns)
-                HasWorkTrips = HasWorkTrips.append(to_append, ignore_index=True)
-            else:
-                to_append = pd.Series([person_id, False], index=HasWorkTrips.columns)
-                HasWorkTrips = HasWorkTrips.append(to_append, ignore_index=True)
-            if has_edu_trip:
-                to_append = pd.Series([person_id, True], index=HasEducationTrips.columns)
-                HasEducationTrips = HasEducationTrips.append(to_append, ignore_index=True)
-            else:
-                to_append = pd.Series([person_id, False], index=HasEducationTrips.columns)
-                HasEducationTrips = HasEducationTrips.append(to_append, ignore_index=True)
-        else:
-            # No work and school trip, treat as not economically active people
-            to_append = pd.Series([person_id, '88'], index=PrimaryLocRelationHomes.columns)
-            PrimaryLocRelationHomes = PrimaryLocRelationHomes.append(to_append, ignore_index=True)
-
-            # Select as the main trip the longest one
-            trip_data = trips_data.loc[trips_data['DeclaredTripTime'] == max(trips_data['DeclaredTripTime'])]
-            trip_data = trip_data.iloc[0]  # take only the first trip of the main journey
-            DeclaredTripTime = trip_data['DeclaredTripTime']
-            trip_main_mode = trip_data['TripMainMode']
-
-            to_append = pd.Series([person_id, trip_main_mode], index=JourneyMainModes.columns)
-            JourneyMainModes = JourneyMainModes.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, DeclaredTripTime], index=DeclaredJourneyTimes.columns)
-            DeclaredJourneyTimes = DeclaredJourneyTimes.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, home_town_code], index=PrimaryLocTownCodes.columns)
-            PrimaryLocTownCodes = PrimaryLocTownCodes.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, home_district_code], index=PrimaryLocDistrictCodes.columns)
-            PrimaryLocDistrictCodes = PrimaryLocDistrictCodes.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, 'Česko'], index=PrimaryLocStateNames.columns)
-            PrimaryLocStateNames = PrimaryLocStateNames.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, 0], index=PrimaryLocCrowFliesTripDists.columns)
-            PrimaryLocCrowFliesTripDists = PrimaryLocCrowFliesTripDists.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, False], index=HasWorkTrips.columns)
-            HasWorkTrips = HasWorkTrips.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, False], index=HasEducationTrips.columns)
-            HasEducationTrips = HasEducationTrips.append(to_append, ignore_index=True)
-
-    df_CzechiaHTS_ph = pd.merge(PrimaryLocRelationHomes, df_CzechiaHTS_ph, on='PersonID')
-    df_CzechiaHTS_ph = pd.merge(JourneyMainModes, df_CzechiaHTS_ph, on='PersonID')
-    df_CzechiaHTS_ph = pd.merge(DeclaredJourneyTimes, df_CzechiaHTS_ph, on='PersonID')
-    df_CzechiaHTS_ph = pd.merge(PrimaryLocTownCodes, df_CzechiaHTS_ph, on='PersonID')
-    df_CzechiaHTS_ph = pd.merge(PrimaryLocDistrictCodes, df_CzechiaHTS_ph, on='PersonID')
-    df_CzechiaHTS_ph = pd.merge(PrimaryLocStateNames, df_CzechiaHTS_ph, on='PersonID')
-    df_CzechiaHTS_ph = pd.merge(PrimaryLocCrowFliesTripDists, df_CzechiaHTS_ph, on='PersonID')
-    df_CzechiaHTS_ph = pd.merge(HasWorkTrips, df_CzechiaHTS_ph, on='PersonID')
-    df_CzechiaHTS_ph = pd.merge(HasEducationTrips, df_CzechiaHTS_ph, on='PersonID')
+    df_codes_ORP = df_codes.drop_duplicates(subset=['KOD_ORP_CSU']).set_index('KOD_ORP_CSU')
+    df_journeys = commonFunctions.summarizeJourneys(
+        df_CzechiaHTS_ph,
+        df_CzechiaHTS_t,
+        df_CzechiaHTS_t['TripMainMode'].values,
+        df_CzechiaHTS_t['DestDistrictCode'].values,
+        df_CzechiaHTS_t['DestDistrictCode'].map(df_codes_ORP['KOD_KRAJ']).values,
+        ('3', '8'))
+    df_CzechiaHTS_ph = pd.merge(df_journeys, df_CzechiaHTS_ph, on='PersonID')
 
     alg_groups = pd.Series(df_journey_t[0][:-2].to_list())
     input_groups = pd.Series([0, 15, 30, 45, 60, 90, 90 + max_DeclaredTripTime + 1])
@@ -981,161 +843,21 @@ def execute(context):
     # f) PrimaryLocStateName for each person (the trip to primary location)
     # g) JourneyMainMode for each person
     # h) TripMainMode for each trip of each person
-    PrimaryLocRelationHomes = pd.DataFrame(columns=['PersonID', 'PrimaryLocRelationHome'])
-    JourneyMainModes = pd.DataFrame(columns=['PersonID', 'JourneyMainMode'])
-    DeclaredJourneyTimes = pd.DataFrame(columns=['PersonID', 'DeclaredJourneyTime'])
-    PrimaryLocTownCodes = pd.DataFrame(columns=['PersonID', 'PrimaryLocTownCode'])
-    PrimaryLocStateNames = pd.DataFrame(columns=['PersonID', 'PrimaryLocStateName'])
-    PrimaryLocDistrictCodes = pd.DataFrame(columns=['PersonID', 'PrimaryLocDistrictCode'])
-    PrimaryLocCrowFliesTripDists = pd.DataFrame(columns=['PersonID', 'PrimaryLocCrowFliesTripDist'])
+    print("Generating missing data (i.e. add columns) to match CityHTS with Census data")
     max_DeclaredTripTime = df_CityHTS_t['DeclaredTripTime'].max()
-    TripMainModes = pd.DataFrame(columns=['TripID', 'TripMainMode'])
-    HasWorkTrips = pd.DataFrame(columns=['PersonID', 'HasWorkTrip'])
-    HasEducationTrips = pd.DataFrame(columns=['PersonID', 'HasEducationTrip'])
-    df_group = df_CityHTS_t.groupby('PersonID')
-    for person_id, trips_data in tqdm(df_group, total=len(df_group), ascii=True,
-                                      desc="Generating missing data (i.e. add columns) "
-                                           "to match CityHTS with Census data"):
-        person_row = df_CityHTS_ph.loc[df_CityHTS_ph['PersonID'] == person_id]
-        home_town_code = person_row.iloc[0]['TownCode']
-        home_district_code = person_row.iloc[0]['DistrictCode']
-        home_region_code = person_row.iloc[0]['RegionCode']
-        for _, trip_data in trips_data.iterrows():
-            trip_id = trip_data["TripID"]
-            time_modes = trip_data[[
-                'TimeFoot', 'TimeBike', 'TimeMHD', 'TimeRegionalBus', 'TimeRegionalTrain', 'TimeDriverCar',
-                'TimePassengerCar', 'TimeOther',
-            ]]
-            main_mode = pd.to_numeric(time_modes).idxmax()
-            to_append = pd.Series([trip_id, str(list(time_modes.keys()).index(main_mode) + 1)],
-                                  index=TripMainModes.columns)
-
-            assert trip_id not in TripMainModes['TripID']
-
-            TripMainModes = TripMainModes.append(to_append, ignore_index=True)
-
-        if person_row.iloc[0]['Activity'] == '2':
-            mainly_student = True
-        else:
-            mainly_student = False
-        has_work_trip = False
-        has_edu_trip = False
-        if "4" in trips_data['DestPurpose'].array:
-            has_work_trip = True
-        if "5" in trips_data['DestPurpose'].array:
-            has_edu_trip = True
-
-        if has_work_trip or has_edu_trip:
-            if (not mainly_student or (mainly_student and not has_edu_trip)) and has_work_trip:
-                # Give preference to work as main journey
-                trip_data = trips_data.loc[trips_data['DestPurpose'] == '4']
-            else:
-                # Give preference to education as main journey
-                trip_data = trips_data.loc[trips_data['DestPurpose'] == '5']
-
-            trip_data = trip_data.iloc[0] # take only the first trip of the main journey
-            dest_town_code = trip_data['DestTownCode']
-            dest_state_name = trip_data['DestState']
-            dest_row = df_codes.loc[df_codes['KOD_OBEC'] == dest_town_code]
-            try:
-                dest_district_code = dest_row.iloc[0]['KOD_ORP_CSU']
-                dest_region_code = dest_row.iloc[0]['KOD_KRAJ']
-            except IndexError:
-                dest_district_code = '0'
-                dest_region_code = '0'
-
-            if int(trip_data['DeclaredTripTime']) <= 5:
-                # If works/studies at residence (if it takes 5 minutes or less)
-                to_append = pd.Series([person_id, '6'], index=PrimaryLocRelationHomes.columns)
-                PrimaryLocRelationHomes = PrimaryLocRelationHomes.append(to_append, ignore_index=True)
-            elif dest_town_code == home_town_code:
-                # If works/studies at the same town
-                to_append = pd.Series([person_id, '4'], index=PrimaryLocRelationHomes.columns)
-                PrimaryLocRelationHomes = PrimaryLocRelationHomes.append(to_append, ignore_index=True)
-            elif dest_district_code == home_district_code:
-                # If works/studies at the same district
-                to_append = pd.Series([person_id, '1'], index=PrimaryLocRelationHomes.columns)
-                PrimaryLocRelationHomes = PrimaryLocRelationHomes.append(to_append, ignore_index=True)
-            elif dest_region_code == home_region_code:
-                # If works/studies at the same region
-                to_append = pd.Series([person_id, '2'], index=PrimaryLocRelationHomes.columns)
-                PrimaryLocRelationHomes = PrimaryLocRelationHomes.append(to_append, ignore_index=True)
-            else:
-                # If works/studies at another region
-                to_append = pd.Series([person_id, '3'], index=PrimaryLocRelationHomes.columns)
-                PrimaryLocRelationHomes = PrimaryLocRelationHomes.append(to_append, ignore_index=True)
-            journeyTimes = trip_data[['TimeFoot', 'TimeBike', 'TimeMHD', 'TimeRegionalBus',
-                                     'TimeRegionalTrain', 'TimeDriverCar', 'TimePassengerCar', 'TimeOther']]
-            DeclaredTripTime = trip_data['DeclaredTripTime']
-            CrowFliesTripDist = trip_data['CrowFliesTripDist']
-            main_mode = pd.to_numeric(journeyTimes).idxmax()
-            to_append = pd.Series([person_id, list(journeyTimes.keys()).index(main_mode) + 1],
-                                  index=JourneyMainModes.columns)
-            JourneyMainModes = JourneyMainModes.append(to_append, ignore_index=True)
-
-            to_append = pd.Series([person_id, DeclaredTripTime], index=DeclaredJourneyTimes.columns)
-            DeclaredJourneyTimes = DeclaredJourneyTimes.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, dest_town_code], index=PrimaryLocTownCodes.columns)
-            PrimaryLocTownCodes = PrimaryLocTownCodes.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, dest_district_code], index=PrimaryLocDistrictCodes.columns)
-            PrimaryLocDistrictCodes = PrimaryLocDistrictCodes.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, dest_state_name], index=PrimaryLocStateNames.columns)
-            PrimaryLocStateNames = PrimaryLocStateNames.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, CrowFliesTripDist], index=PrimaryLocCrowFliesTripDists.columns)
-            PrimaryLocCrowFliesTripDists = PrimaryLocCrowFliesTripDists.append(to_append, ignore_index=True)
-
-            if has_work_trip:
-                to_append = pd.Series([person_id, True], index=HasWorkTrips.columns)
-                HasWorkTrips = HasWorkTrips.append(to_append, ignore_index=True)
-            else:
-                to_append = pd.Series([person_id, False], index=HasWorkTrips.columns)
-                HasWorkTrips = HasWorkTrips.append(to_append, ignore_index=True)
-            if has_edu_trip:
-                to_append = pd.Series([person_id, True], index=HasEducationTrips.columns)
-                HasEducationTrips = HasEducationTrips.append(to_append, ignore_index=True)
-            else:
-                to_append = pd.Series([person_id, False], index=HasEducationTrips.columns)
-                HasEducationTrips = HasEducationTrips.append(to_append, ignore_index=True)
-        else:
-            # Not economically active people
-            to_append = pd.Series([person_id, '88'], index=PrimaryLocRelationHomes.columns)
-            PrimaryLocRelationHomes = PrimaryLocRelationHomes.append(to_append, ignore_index=True)
-
-            # Select as the main trip the longest one
-            trip_data = trips_data.loc[trips_data['DeclaredTripTime'] == max(trips_data['DeclaredTripTime'])]
-            trip_data = trip_data.iloc[0]  # take only the first trip of the main journey
-            DeclaredTripTime = trip_data['DeclaredTripTime']
-            journeyTimes = trip_data[['TimeFoot', 'TimeBike', 'TimeMHD', 'TimeRegionalBus',
-                                      'TimeRegionalTrain', 'TimeDriverCar', 'TimePassengerCar', 'TimeOther']]
-            main_mode = pd.to_numeric(journeyTimes).idxmax()
-            to_append = pd.Series([person_id, list(journeyTimes.keys()).index(main_mode) + 1],
-                                  index=JourneyMainModes.columns)
-            JourneyMainModes = JourneyMainModes.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, DeclaredTripTime], index=DeclaredJourneyTimes.columns)
-            DeclaredJourneyTimes = DeclaredJourneyTimes.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, home_town_code], index=PrimaryLocTownCodes.columns)
-            PrimaryLocTownCodes = PrimaryLocTownCodes.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, home_district_code], index=PrimaryLocDistrictCodes.columns)
-            PrimaryLocDistrictCodes = PrimaryLocDistrictCodes.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, 'Česko'], index=PrimaryLocStateNames.columns)
-            PrimaryLocStateNames = PrimaryLocStateNames.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, 0], index=PrimaryLocCrowFliesTripDists.columns)
-            PrimaryLocCrowFliesTripDists = PrimaryLocCrowFliesTripDists.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, False], index=HasWorkTrips.columns)
-            HasWorkTrips = HasWorkTrips.append(to_append, ignore_index=True)
-            to_append = pd.Series([person_id, False], index=HasEducationTrips.columns)
-            HasEducationTrips = HasEducationTrips.append(to_append, ignore_index=True)
-
-    df_CityHTS_ph = pd.merge(PrimaryLocRelationHomes, df_CityHTS_ph, on='PersonID')
-    df_CityHTS_ph = pd.merge(JourneyMainModes, df_CityHTS_ph, on='PersonID')
-    df_CityHTS_ph = pd.merge(DeclaredJourneyTimes, df_CityHTS_ph, on='PersonID')
-    df_CityHTS_ph = pd.merge(PrimaryLocTownCodes, df_CityHTS_ph, on='PersonID')
-    df_CityHTS_ph = pd.merge(PrimaryLocStateNames, df_CityHTS_ph, on='PersonID')
-    df_CityHTS_ph = pd.merge(PrimaryLocDistrictCodes, df_CityHTS_ph, on='PersonID')
-    df_CityHTS_ph = pd.merge(PrimaryLocCrowFliesTripDists, df_CityHTS_ph, on='PersonID')
-    df_CityHTS_t = pd.merge(TripMainModes, df_CityHTS_t, on='TripID')
-    df_CityHTS_ph = pd.merge(HasWorkTrips, df_CityHTS_ph, on='PersonID')
-    df_CityHTS_ph = pd.merge(HasEducationTrips, df_CityHTS_ph, on='PersonID')
+    trip_modes = commonFunctions.tripMainModes(df_CityHTS_t, ['TimeFoot', 'TimeBike', 'TimeMHD', 'TimeRegionalBus',
+                                                              'TimeRegionalTrain', 'TimeDriverCar', 'TimePassengerCar',
+                                                              'TimeOther'])
+    df_CityHTS_t['TripMainMode'] = trip_modes.astype(str)
+    df_codes_OBEC = df_codes.drop_duplicates(subset=['KOD_OBEC']).set_index('KOD_OBEC')
+    df_journeys = commonFunctions.summarizeJourneys(
+        df_CityHTS_ph,
+        df_CityHTS_t,
+        trip_modes,
+        df_CityHTS_t['DestTownCode'].map(df_codes_OBEC['KOD_ORP_CSU']).fillna('0').values,
+        df_CityHTS_t['DestTownCode'].map(df_codes_OBEC['KOD_KRAJ']).fillna('0').values,
+        ('2',))
+    df_CityHTS_ph = pd.merge(df_journeys, df_CityHTS_ph, on='PersonID')
 
     alg_groups = pd.Series(df_journey_t[0][:-2].to_list())
     input_groups = pd.Series([0, 15, 30, 45, 60, 90, 90 + max_DeclaredTripTime + 1])
@@ -1,4 +1,3 @@
-from tqdm import tqdm
 import pandas as pd
 import numpy as np
 import os
@@ -11,12 +10,11 @@ def configure(context):
     context.config("data_path")
     context.config("output_path")
     context.stage("data.hts.cleaned")
-    context.config("routes_file")
+    context.stage("data.spatial.gates")
 
 def validate(context):
     data_path = context.config("data_path")
     output_path = context.config("output_path")
-    routes_file = "%s/%s" % (context.config("data_path"), context.config("routes_file"))
 
     if not os.path.isdir(data_path):
         raise RuntimeError("Input directory must exist: %s" % data_path)
@@ -24,9 +22,6 @@ def validate(context):
     if not os.path.isdir(output_path):
         raise RuntimeError("Output directory must exist: %s" % output_path)
 
-    if not os.path.exists(routes_file):
-        raise RuntimeError("Input file must exist: %s" % routes_file)
-
 def execute(context):
     
     # Ignore header warning when reading excel files
@@ -73,16 +68,8 @@ def execute(context):
     df_trips_CzechiaHTS = df_trips_CzechiaHTS.copy()
     df_trips_CityHTS = df_trips_CityHTS.copy()
 
-    # Get the most suitable synthetic gates, distance and travel times to every town in Czechia
-    df_routes_gate = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("routes_file")),
-                                   header=0,
-                                   # encoding="cp1250",
-                                   dtype=str)[["State", "KOD_LAU2", "KOD_ORP", "GATEosm_id",
-                                               "Total_HourCostDrive", "Shape_Length", 'POPULATION_LAU2']]
-    df_routes_gate["Shape_Length"] = df_routes_gate["Shape_Length"].astype(np.float).astype(np.int)
-    df_routes_gate["Total_HourCostDrive"] = df_routes_gate["Total_HourCostDrive"].astype(np.float)
-    df_routes_gate['POPULATION_LAU2'] = df_routes_gate['POPULATION_LAU2'].fillna("0")
-    df_routes_gate['POPULATION_LAU2'] = df_routes_gate['POPULATION_LAU2'].astype('int')
+    # Get the most suitable synthetic gates for every town, state and district
+    df_town_gates, df_state_gates, df_district_gates = context.stage("data.spatial.gates")
 
     print("Filtering Household Travel Survey (HTS) data")
 
@@ -182,58 +169,34 @@ def execute(context):
                 # IF CzechiaHTS data
                 # Change the real town ID to synthetic gate ID if real town is not within Ustí nad Labem district
                 # Not necessary country/state because CzechiaHTS trips does not account country
-                df_groups = df_routes_gate.groupby("GATEosm_id")
-                for GATEosm_id, places_via_gate in tqdm(df_groups, total=len(df_groups), ascii=True,
-                                                        desc="Changing real town ID to synthetic gate ID, "
-                                                             "if zone is not within the district (for CzechiaHTS)"):
-                    cities_gate_ids = places_via_gate["KOD_LAU2"].dropna().values.tolist()
-
-                    df_persons.loc[((df_persons["DistrictCode"] != '4214')
-                                   & (df_persons["TownCode"].isin(cities_gate_ids))), "TownCode"] = GATEosm_id
+                print("Changing real town ID to synthetic gate ID, if zone is not within the district (for CzechiaHTS)")
+                town_gates = df_persons["TownCode"].map(df_town_gates["GATEosm_id"])
+                f = (df_persons["DistrictCode"] != '4214') & town_gates.notna()
+                df_persons.loc[f, "TownCode"] = town_gates[f]
 
-                    df_trips.loc[((df_trips["OriginDistrictCode"] != '4214')
-                                  & (df_trips["OriginTownCode"].isin(cities_gate_ids))), "OriginTownCode"] = GATEosm_id
+                town_gates = df_trips["OriginTownCode"].map(df_town_gates["GATEosm_id"])
+                f = (df_trips["OriginDistrictCode"] != '4214') & town_gates.notna()
+                df_trips.loc[f, "OriginTownCode"] = town_gates[f]
 
-                    df_trips.loc[((df_trips["DestDistrictCode"] != '4214')
-                                  & (df_trips["DestTownCode"].isin(cities_gate_ids))), "DestTownCode"] = GATEosm_id
+                town_gates = df_trips["DestTownCode"].map(df_town_gates["GATEosm_id"])
+                f = (df_trips["DestDistrictCode"] != '4214') & town_gates.notna()
+                df_trips.loc[f, "DestTownCode"] = town_gates[f]
 
                 # Change the real town ID to synthetic gate ID if town code is unknown (but known district code)
                 # Select (probabilistically) the most suitable gate
-                df_groups = df_routes_gate.groupby("KOD_ORP")
-                for district_code, df_region in tqdm(df_groups, total=len(df_groups), ascii=True,
-                                                     desc="Changing real town ID to synthetic gate ID,"
-                                                          " if the town code is unknown (for CzechiaHTS)"):
-
-                    gate_groups = df_region.groupby('GATEosm_id')[['GATEosm_id', 'POPULATION_LAU2']]
-                    gate_groups = gate_groups.agg('sum')
-                    try:
-                        prob_gates = gate_groups.get('POPULATION_LAU2')['POPULATION_LAU2']
-                    except KeyError:
-                        prob_gates = gate_groups.get('POPULATION_LAU2')
-                    prob_gates = prob_gates.map(lambda x: x / sum(prob_gates))
-                    gates = list(prob_gates.keys())
-                    probs = list(prob_gates)
-
-                    df_persons.loc[((pd.isnull(df_persons["TownCode"]))
-                                   & (df_persons["DistrictCode"] == district_code)),
-                                  "TownCode"] = \
-                        df_persons.loc[(pd.isnull(df_persons["TownCode"])
-                                       & (df_persons["DistrictCode"] == district_code)),
-                                      "TownCode"].map(lambda x: random.choice(gates, p=probs)).copy()
-
-                    df_trips.loc[(pd.isnull(df_trips["OriginTownCode"])
-                                  & (df_trips["OriginDistrictCode"] == district_code)),
-                                 "OriginTownCode"] = \
-                        df_trips.loc[(pd.isnull(df_trips["OriginTownCode"])
-                                      & (df_trips["OriginDistrictCode"] == district_code)),
-                                     "OriginTownCode"].map(lambda x: random.choice(gates, p=probs)).copy()
-
-                    df_trips.loc[(pd.isnull(df_trips["DestTownCode"])
-                                  & (df_trips["DestDistrictCode"] == district_code)),
-                                 "DestTownCode"] = \
-                        df_trips.loc[(pd.isnull(df_trips["DestTownCode"])
-                                      & (df_trips["DestDistrictCode"] == district_code)),
-                                     "DestTownCode"].map(lambda x: random.choice(gates, p=probs)).copy()
+                print("Changing real town ID to synthetic gate ID, if the town code is unknown (for CzechiaHTS)")
+                f_persons = pd.isnull(df_persons["TownCode"])
+                f_origins = pd.isnull(df_trips["OriginTownCode"])
+                f_dests = pd.isnull(df_trips["DestTownCode"])
+                persons_gates, origins_gates, dests_gates = commonFunctions.sampleDistrictGates(
+                    df_district_gates,
+                    [df_persons.loc[f_persons, "DistrictCode"],
+                     df_trips.loc[f_origins, "OriginDistrictCode"],
+                     df_trips.loc[f_dests, "DestDistrictCode"]],
+                    random)
+                df_persons.loc[f_persons, "TownCode"] = persons_gates
+                df_trips.loc[f_origins, "OriginTownCode"] = origins_gates
+                df_trips.loc[f_dests, "DestTownCode"] = dests_gates
             else:
                 # If CityHTS data
                 # Change the real cadastral area ID to the town ID if cadastral area is unknown but town code is known
@@ -249,27 +212,15 @@ def execute(context):
                                     & (df_trips["DestTownCode"].isin(cities_usti_district))), "DestTownCode"].copy()
 
                 # Change the real cadastral area IDs to synthetic gate ID if the town code is unknown
-                df_groups = df_routes_gate.groupby("GATEosm_id")
-                for GATEosm_id, places_via_gate in tqdm(df_groups, total=len(df_groups), ascii=True,
-                                                        desc="Changing real cadastral area ID to synthetic gateID,"
-                                                             " if the town code is unknown (for CityHTS)"):
-
-                    cities_gate_ids = places_via_gate["KOD_LAU2"].dropna().values.tolist()
-                    countries_gate_name = places_via_gate["State"].drop_duplicates().values.tolist()
-
-                    f = (((df_trips["OriginCadastralAreaCode"] == "0")
-                                    & (df_trips["OriginState"].isin(countries_gate_name)))
-                                   | ((df_trips["OriginCadastralAreaCode"] != "0")
-                                      & (df_trips["OriginCadastralAreaCode"].isin(cities_gate_ids))))
-                    df_trips.loc[f, "OriginCadastralAreaCode"] = GATEosm_id
-                    df_trips.loc[f, "OriginTownCode"] = GATEosm_id
-
-                    f = (((df_trips["DestCadastralAreaCode"] == "0")
-                                    & (df_trips["DestState"].isin(countries_gate_name)))
-                                   | ((df_trips["DestCadastralAreaCode"] != "0")
-                                      & (df_trips["DestCadastralAreaCode"].isin(cities_gate_ids))))
-                    df_trips.loc[f, "DestCadastralAreaCode"] = GATEosm_id
-                    df_trips.loc[f, "DestTownCode"] = GATEosm_id
+                # (cadastral area is then the town code, or unknown and the gate is given by the state)
+                print("Changing real cadastral area ID to synthetic gateID, if the town code is unknown (for CityHTS)")
+                for place in ["Origin", "Dest"]:
+                    unknown_areas = df_trips[place + "CadastralAreaCode"] == "0"
+                    gates = df_trips[place + "CadastralAreaCode"].map(df_town_gates["GATEosm_id"]).where(~unknown_areas)
+                    gates = gates.fillna(df_trips[place + "State"].map(df_state_gates["GATEosm_id"]).where(unknown_areas))
+                    f = gates.notna()
+                    df_trips.loc[f, place + "CadastralAreaCode"] = gates[f]
+                    df_trips.loc[f, place + "TownCode"] = gates[f]
 
         ### Code below only if considering peope living in the near areas out of the district
         # if df_ind == 0:
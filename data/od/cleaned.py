@@ -8,13 +8,12 @@ def configure(context):
     context.config("data_path")
     context.stage("data.spatial.zones")
     context.stage("data.hts.filtered")
-    context.config("routes_file")
+    context.stage("data.spatial.gates")
     context.config("output_path")
 
 def validate(context):
     data_path = context.config("data_path")
     output_path = context.config("output_path")
-    routes_file = "%s/%s" % (context.config("data_path"), context.config("routes_file"))
 
     if not os.path.isdir(data_path):
         raise RuntimeError("Input directory must exist: %s" % data_path)
@@ -22,9 +21,6 @@ def validate(context):
     if not os.path.isdir(output_path):
         raise RuntimeError("Output directory must exist: %s" % output_path)
 
-    if not os.path.exists(routes_file):
-        raise RuntimeError("Input file must exist: %s" % routes_file)
-
 def execute(context):
     
     # Ignore header warning when reading excel files
@@ -33,11 +29,9 @@ def execute(context):
     print("Compute OD proportions between zones")
 
     # Get gates' artificial zones
-    zone_id_gates = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("routes_file")),
-                                   header=0,
-                                  # encoding="cp1250",
-                                  dtype=str)[["GATEosm_id"]].drop_duplicates().dropna().astype(int)
-    zone_id_gates = set(np.unique(zone_id_gates["GATEosm_id"]))
+    df_town_gates, df_state_gates = context.stage("data.spatial.gates")[:2]
+    zone_id_gates = pd.concat([df_town_gates["GATEosm_id"], df_state_gates["GATEosm_id"]]).dropna().astype(int)
+    zone_id_gates = set(np.unique(zone_id_gates))
 
     # Get zones and HTS
     df_zones_municipalities, df_zones_cadastral_city = context.stage("data.spatial.zones")[:2]
@@ -145,4 +139,8 @@ def execute(context):
     df_education.to_csv("%s/ODs/od_edu.csv" % context.config("output_path"))
     commonFunctions.toXML(df_education, "%s/ODs/od_edu.xml" % context.config("output_path"))
 
-    return df_work, df_education
+    # Sparse OD matrices (CSR rows per origin zone) for sampling and analysis without filtering the long dataframes
+    od_work = commonFunctions.odMatrix(df_work)
+    od_education = commonFunctions.odMatrix(df_education)
+
+    return df_work, df_education, od_work, od_education
@@ -0,0 +1,52 @@
+import numpy as np
+import os
+from data import commonFunctions
+import warnings
+
+def configure(context):
+    context.config("data_path")
+    context.config("routes_file")
+    context.config("cache_path")
+
+def validate(context):
+    data_path = context.config("data_path")
+    routes_file = "%s/%s" % (context.config("data_path"), context.config("routes_file"))
+
+    if not os.path.isdir(data_path):
+        raise RuntimeError("Input directory must exist: %s" % data_path)
+
+    if not os.path.exists(routes_file):
+        raise RuntimeError("Input file must exist: %s" % routes_file)
+
+def execute(context):
+
+    # Ignore header warning when reading excel files
+    warnings.filterwarnings('ignore', category=UserWarning, module='openpyxl')
+
+    print("Building the routing index of towns and states to synthetic gates")
+
+    # Get the most suitable synthetic gates and distances to every town in Czechia (and to neighbour states)
+    df_routes_gate = commonFunctions.readLookupSheet("%s/%s" % (context.config("data_path"),
+                                                                context.config("routes_file")),
+                                                     context.config("cache_path"), header=0)
+    df_routes_gate = df_routes_gate[["State", "KOD_LAU2", "KOD_ORP", "GATEosm_id", "Shape_Length", "POPULATION_LAU2"]]
+    df_routes_gate["Shape_Length"] = df_routes_gate["Shape_Length"].astype(np.float).astype(np.int)
+    df_routes_gate["POPULATION_LAU2"] = df_routes_gate["POPULATION_LAU2"].fillna("0").astype('int')
+
+    # Town code -> gate (nan if the town has no gate, i.e. within the district) and distance to Ustí city
+    df_town_gates = df_routes_gate.dropna(subset=["KOD_LAU2"]).drop_duplicates(subset=["KOD_LAU2"])
+    df_town_gates = df_town_gates.set_index("KOD_LAU2")[["GATEosm_id", "Shape_Length"]]
+
+    # State name -> gate and distance to Ustí city
+    # The gate of a state is the first gate (in gate ID order) with places of that state, as when going through gates
+    df_state_gates = df_routes_gate.dropna(subset=["GATEosm_id"]).sort_values(by="GATEosm_id", kind="mergesort")
+    df_state_gates = df_state_gates.drop_duplicates(subset=["State"]).set_index("State")[["GATEosm_id"]]
+    df_state_gates["Shape_Length"] = df_routes_gate.drop_duplicates(subset=["State"]).set_index("State")["Shape_Length"]
+
+    # District code -> candidate gates weighted by the population of the towns using each gate
+    df_district_gates = df_routes_gate.dropna(subset=["KOD_ORP", "GATEosm_id"])
+    df_district_gates = df_district_gates.groupby(["KOD_ORP", "GATEosm_id"])["POPULATION_LAU2"].sum().reset_index()
+    df_district_gates["Probability"] = df_district_gates["POPULATION_LAU2"] / \
+                                       df_district_gates.groupby("KOD_ORP")["POPULATION_LAU2"].transform("sum")
+
+    return df_town_gates, df_state_gates, df_district_gates[["KOD_ORP", "GATEosm_id", "Probability"]]
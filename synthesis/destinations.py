@@ -20,13 +20,13 @@ def configure(context):
     context.config("facilities_osm_file")
     context.config("facilities_area_file")
     context.config("buildings_occupancy_file")
-    context.config("routes_file")
+    context.config("cache_path")
+    context.stage("data.spatial.gates")
 
 def validate(context):
     data_path = context.config("data_path")
     output_path = context.config("output_path")
     generalizations_file = "%s/%s" % (context.config("data_path"), context.config("generalizations_file"))
-    routes_file = "%s/%s" % (context.config("data_path"), context.config("routes_file"))
     facilities_edu_file = "%s/Facilities/%s" % (context.config("data_path"),
                                                 context.config("facilities_edu_file"))
     facilities_work_home_file = "%s/Facilities/%s" % (context.config("data_path"),
@@ -45,9 +45,6 @@ def validate(context):
     if not os.path.exists(generalizations_file):
         raise RuntimeError("Input file must exist: %s" % generalizations_file)
 
-    if not os.path.exists(routes_file):
-        raise RuntimeError("Input file must exist: %s" % routes_file)
-
     if not os.path.exists(facilities_edu_file):
         raise RuntimeError("Input file must exist: %s" % facilities_edu_file)
 
@@ -99,25 +96,21 @@ def execute(context):
 
     print("Reading Facilities Files")
 
-    # Get inputs
-    df_zones_gates = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("routes_file")),
-                                   header=0,
-                                   # encoding="cp1250",
-                                   dtype=str)[["GATEosm_id"]].drop_duplicates().dropna().astype(int)
-    df_zones_gates = df_zones_gates.rename(columns={'GATEosm_id': 'ZoneID'}).astype(str)
+    # Get inputs (lookup workbooks are parsed only once, see commonFunctions.readLookupSheet)
+    cache_path = context.config("cache_path")
+    generalizations_file = "%s/%s" % (context.config("data_path"), context.config("generalizations_file"))
+    df_town_gates, df_state_gates = context.stage("data.spatial.gates")[:2]
+    df_zones_gates = pd.concat([df_town_gates["GATEosm_id"], df_state_gates["GATEosm_id"]]).dropna().astype(int)
+    df_zones_gates = df_zones_gates.drop_duplicates().astype(str).to_frame(name='ZoneID')
 
     df_obec_zones, df_ku_zones, df_zsj_zones, df_outer_zones = context.stage("data.spatial.zones")
     df_zones_gates = df_outer_zones[df_outer_zones["ZoneID"].isin(df_zones_gates['ZoneID'])]
 
-    df_purpose = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                           header=None, skiprows=1, sheet_name='Purpose FacilityPurpose',
-                               dtype=str)
+    df_purpose = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'Purpose FacilityPurpose', skiprows=1)
     df_purpose = df_purpose.astype(str)
-    df_usage = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                           header=None, skiprows=1, sheet_name='ActivitySector FacilityUsage', dtype=str)
+    df_usage = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'ActivitySector FacilityUsage', skiprows=1)
     df_usage = df_usage.astype(str)
-    df_edu_place = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("generalizations_file")),
-                                 header=None, skiprows=1, sheet_name='EducationPlace FacilityType', dtype=str)
+    df_edu_place = commonFunctions.readLookupSheet(generalizations_file, cache_path, 'EducationPlace FacilityType', skiprows=1)
 
     # Define which attributes will be necessary
     all_cols = ["BasicSettlementCode", "CadastralAreaCode", "TownCode",
@@ -248,10 +241,8 @@ def execute(context):
 
         # Get home and work places
         required_purposes = {"1", "4"}
-        ids = df_facilities_work_home["FacilityPurpose"].apply(
-                lambda x: True if (type(x) == tuple and x == ("99",) or len(set(x).intersection(required_purposes)))
-                                   or (type(x) != tuple and x == "99" or x in required_purposes) > 0
-                else False)
+        ids = commonFunctions.categoryFilter(commonFunctions.categoryMasks(df_facilities_work_home["FacilityPurpose"]),
+                                             required_purposes)
         df_facilities_work_home = df_facilities_work_home[ids]
 
         # Define facilities attributes
@@ -484,10 +475,8 @@ def execute(context):
 
         # Define work and home location facilities and attributes from Facilities Census
         required_purposes = {"1", "4"}
-        ids = df_facilities_osm["FacilityPurpose"].apply(
-            lambda x: True if (type(x) == tuple and x == ("99",) or len(set(x).intersection(required_purposes)))
-                              or (type(x) != tuple and x == "99" or x in required_purposes) > 0
-            else False)
+        ids = commonFunctions.categoryFilter(commonFunctions.categoryMasks(df_facilities_osm["FacilityPurpose"]),
+                                             required_purposes)
         df_facilities_osm_work_home = df_facilities_osm[ids]
 
         # Match home and work locations between Facility Census and OpenStreetMaps
@@ -526,40 +515,21 @@ def execute(context):
                                                        unmatched_osm],
                                                       axis=0, ignore_index=True, sort=False)
 
-        # Write down what each facility offers based on their facility purposes
-        required_purposes = {"1"}
-        df_facilities_work_home_secondary["offers_home"] = df_facilities_work_home_secondary["FacilityPurpose"].apply(
-            lambda x: True if x == ("99",) or len(set(x).intersection(required_purposes)) > 0
-            else False)
-
-        required_purposes = {"2"}
-        df_facilities_work_home_secondary["offers_freetime"] = df_facilities_work_home_secondary["FacilityPurpose"].apply(
-            lambda x: True if x == ("99",) or len(set(x).intersection(required_purposes)) > 0
-            else False)
-
-        required_purposes = {"3"}
-        df_facilities_work_home_secondary["offers_shopping"] = df_facilities_work_home_secondary["FacilityPurpose"].apply(
-            lambda x: True if x == ("99",) or len(set(x).intersection(required_purposes)) > 0
-            else False)
-
-        required_purposes = {"4"}
-        df_facilities_work_home_secondary["offers_work"] = df_facilities_work_home_secondary["FacilityPurpose"].apply(
-            lambda x: True if x == ("99",) or len(set(x).intersection(required_purposes)) > 0
-            else False)
-
+        # Write down what each facility offers based on their facility purposes (only the tuple of the wildcard code
+        # offers everything, not the text of it)
+        purpose_masks = commonFunctions.categoryMasks(df_facilities_work_home_secondary["FacilityPurpose"],
+                                                      text_wildcard=False)
+        df_facilities_work_home_secondary["offers_home"] = commonFunctions.categoryFilter(purpose_masks, {"1"})
+        df_facilities_work_home_secondary["offers_freetime"] = commonFunctions.categoryFilter(purpose_masks, {"2"})
+        df_facilities_work_home_secondary["offers_shopping"] = commonFunctions.categoryFilter(purpose_masks, {"3"})
+        df_facilities_work_home_secondary["offers_work"] = commonFunctions.categoryFilter(purpose_masks, {"4"})
         df_facilities_work_home_secondary["offers_education"] = False
-
-        required_purposes = {"6"}
-        df_facilities_work_home_secondary["offers_errands"] = df_facilities_work_home_secondary["FacilityPurpose"].apply(
-            lambda x: True if x == ("99",) or len(set(x).intersection(required_purposes)) > 0
-            else False)
+        df_facilities_work_home_secondary["offers_errands"] = commonFunctions.categoryFilter(purpose_masks, {"6"})
 
         # Get the number of workplaces and visitors per FacilityType
-        df_buildings_occupancy = pd.read_excel("%s/Facilities/%s" % (context.config("data_path"),
-                                                          context.config("buildings_occupancy_file")),
-                                 header=0,
-                                 # encoding="cp1250",
-                                 dtype='str')[["type", "workers", "visitors"]].drop_duplicates()
+        df_buildings_occupancy = commonFunctions.readLookupSheet("%s/Facilities/%s" % (
+            context.config("data_path"), context.config("buildings_occupancy_file")),
+            cache_path, header=0)[["type", "workers", "visitors"]].drop_duplicates()
         df_buildings_occupancy.columns = ["FacilityType", "WorkPlacesPerArea", "VisitorsPerArea"]
         df_facilities_work_home_secondary = pd.merge(df_facilities_work_home_secondary, df_buildings_occupancy,
                                                      on="FacilityType", how="left")
@@ -711,4 +681,14 @@ def execute(context):
 
     print("Saved all_locations files")
 
+    # Coordinates of the facilities (centroid if the facility geometry is an area/polygon), computed once for all
+    # stages assigning persons/agents to facilities
+    centroids = df_facilities.geometry.centroid
+    df_facilities["x"] = centroids.x.values.astype(np.float64)
+    df_facilities["y"] = centroids.y.values.astype(np.float64)
+
+    # Categories with multiple values per facility as bitmasks, to filter facilities with bitwise operations
+    for category in ["FacilityPurpose", "FacilityUsage", "EducationPlace"]:
+        df_facilities[category + "Mask"] = commonFunctions.categoryMasks(df_facilities[category])
+
     return df_facilities
@@ -0,0 +1,48 @@
+import heapq
+import numpy as np
+
+class CapacityHeap:
+    """Max-heap of facilities by available capacity, giving the same facility as np.argmax(caps) (i.e. the lowest index
+    among the facilities with the highest available capacity) without scanning all facilities"""
+
+    def __init__(self, caps):
+
+        # Initialize class (caps is updated in place when consuming capacity)
+        self.caps = caps
+        # Entries are (-capacity, index), so ties are popped by lowest index as in np.argmax
+        self.heap = [(-cap, index) for index, cap in enumerate(np.asarray(caps).tolist())]
+        heapq.heapify(self.heap)
+
+    def update(self, index):
+        """Register the current capacity of a facility changed outside the heap, older entries become stale"""
+
+        heapq.heappush(self.heap, (-self.caps[index].item(), index))
+
+    def consume(self, index, amount = 1):
+        """Reduce the available capacity of a facility"""
+
+        self.caps[index] -= amount
+        self.update(index)
+
+    def argmax(self):
+        """Index of the facility with the highest available capacity (lowest index if tied)"""
+
+        # Drop stale entries, i.e. those whose capacity is not the current capacity of their facility
+        while -self.heap[0][0] != self.caps[self.heap[0][1]]:
+            heapq.heappop(self.heap)
+
+        return self.heap[0][1]
+
+    def assign(self, count, amount = 1):
+        """Indices of the facilities assigned to count consecutive agents, each one taking the facility with the
+        highest available capacity and reducing it by amount (as calling argmax and consume count times)"""
+
+        indices = np.zeros(count, dtype = int)
+        for i in range(count):
+            index = self.argmax()
+            self.caps[index] -= amount
+            # The valid top entry is replaced by the reduced capacity of the same facility
+            heapq.heapreplace(self.heap, (-self.caps[index].item(), index))
+            indices[i] = index
+
+        return indices
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+
+# Capacities of the facilities tracked when assigning persons/agents to them
+CAPACITY_TYPES = ("Inhabitants", "WorkPlaces", "StudyPlaces", "Visitors")
+
+class CapacityLedger:
+    """Available capacities of all facilities, one array per capacity type, where each facility is identified by its
+    integer index (position) in the facilities dataframe"""
+
+    def __init__(self, df_facilities, capacity_types = CAPACITY_TYPES):
+
+        # Initialize class (capacities are copied so that the facilities dataframe is not modified)
+        self.location_ids = pd.Index(df_facilities["LocationID"].values)
+        if not self.location_ids.is_unique:
+            raise RuntimeError("Facilities must have unique LocationID to be tracked in the capacity ledger")
+        self.capacities = {capacity_type: df_facilities[capacity_type].values.astype(np.float64)
+                           for capacity_type in capacity_types}
+
+    def indices(self, location_ids):
+        """Integer indices of the facilities with the given LocationIDs"""
+
+        indices = self.location_ids.get_indexer(location_ids)
+        if np.any(indices < 0):
+            raise RuntimeError("Unknown LocationID in the capacity ledger: %s" %
+                               np.asarray(location_ids)[indices < 0][0])
+
+        return indices
+
+    def get(self, capacity_type, indices):
+        """Available capacities of the facilities (a copy if indices is an array)"""
+
+        return self.capacities[capacity_type][indices]
+
+    def set(self, capacity_type, indices, values):
+        """Overwrite the available capacities of the facilities"""
+
+        self.capacities[capacity_type][indices] = values
+
+    def decrement(self, capacity_type, index, amount = 1):
+        """Reduce the available capacity of a facility and return the remaining capacity"""
+
+        capacities = self.capacities[capacity_type]
+        capacities[index] -= amount
+
+        return capacities[index]
+
+    def snapshot(self):
+        """Copy of all available capacities, to restore them later"""
+
+        return {capacity_type: capacities.copy() for capacity_type, capacities in self.capacities.items()}
+
+    def restore(self, snapshot):
+        """Restore the available capacities of a snapshot (arrays are updated in place, keeping their views valid)"""
+
+        for capacity_type, capacities in snapshot.items():
+            self.capacities[capacity_type][:] = capacities
@@ -0,0 +1,185 @@
+import numpy as np
+
+class RingSearchIndex:
+    """Grid index of facilities to find the facility with available capacity whose distance to a point is the closest
+    to a given distance (i.e. search in a ring/annulus around the point), removing facilities once exhausted"""
+
+    def __init__(self, coordinates, caps, cell_size = None):
+
+        # Initialize class (caps is updated in place when consuming capacity)
+        self.coordinates = np.asarray(coordinates, dtype = float).reshape(-1, 2)
+        self.caps = caps
+        self.num_facilities = len(self.coordinates)
+
+        if self.num_facilities > 0:
+            self.mins = self.coordinates.min(axis = 0)
+            self.maxs = self.coordinates.max(axis = 0)
+        else:
+            self.mins = np.zeros(2)
+            self.maxs = np.zeros(2)
+
+        if cell_size is None:
+            # Around 4 facilities per cell if they were uniformly spread over their bounding box
+            extent = np.maximum(self.maxs - self.mins, 1.0)
+            cell_size = max(np.sqrt(extent[0] * extent[1] / max(self.num_facilities, 1)) * 2, 1.0)
+        self.cell_size = float(cell_size)
+        self.shape = (np.floor((self.maxs - self.mins) / self.cell_size) + 1).astype(int)
+
+        # Facilities sorted by cell (CSR-like), live facilities are those with at least 1 available capacity
+        cells = np.floor((self.coordinates - self.mins) / self.cell_size).astype(int)
+        self.cells = cells[:, 0] * self.shape[1] + cells[:, 1]
+        self.order = np.argsort(self.cells, kind = "mergesort")
+        self.cell_starts = np.searchsorted(self.cells[self.order], np.arange(self.shape[0] * self.shape[1] + 1))
+
+        self.live = np.asarray(self.caps) >= 1
+        self.cell_live = np.bincount(self.cells[self.live], minlength = self.shape[0] * self.shape[1])
+        self.num_live = int(np.count_nonzero(self.live))
+
+    def consume(self, index, amount = 1):
+        """Reduce the available capacity of a facility, removing it from the search if exhausted"""
+
+        self.caps[index] -= amount
+        if self.live[index] and self.caps[index] < 1:
+            self.live[index] = False
+            self.cell_live[self.cells[index]] -= 1
+            self.num_live -= 1
+
+    def _ring_cells(self, point, inner_radius, outer_radius):
+        """Cells (with live facilities) intersecting the ring between inner_radius and outer_radius around point"""
+
+        x0, y0 = self.mins
+        s = self.cell_size
+
+        # Small margin so that facilities exactly on the ring borders are never skipped
+        inner_radius = max(inner_radius - 1e-6 * s, 0)
+        outer_radius = outer_radius + 1e-6 * s
+
+        # Columns (x) of cells within the outer radius, for each row (y) of cells near the point
+        rows = np.arange(max(int(np.floor((point[1] - outer_radius - y0) / s)), 0),
+                         min(int(np.floor((point[1] + outer_radius - y0) / s)), self.shape[1] - 1) + 1)
+        if len(rows) == 0:
+            return rows
+        row_min_dy = np.maximum(np.maximum(y0 + rows * s - point[1], point[1] - (y0 + (rows + 1) * s)), 0)
+        row_max_dy = np.maximum(np.abs(y0 + rows * s - point[1]), np.abs(y0 + (rows + 1) * s - point[1]))
+        outer_dx = np.sqrt(np.maximum(outer_radius**2 - row_min_dy**2, 0))
+        starts = np.maximum(np.floor((point[0] - outer_dx - x0) / s).astype(int), 0)
+        ends = np.minimum(np.floor((point[0] + outer_dx - x0) / s).astype(int), self.shape[0] - 1) + 1
+
+        # Columns of cells fully inside the inner radius are skipped
+        inner_dx = np.sqrt(np.maximum(inner_radius**2 - row_max_dy**2, 0))
+        inner_starts = np.floor((point[0] - inner_dx - x0) / s).astype(int) + 1
+        inner_ends = np.ceil((point[0] + inner_dx - x0) / s).astype(int) - 1
+        inner_starts = np.clip(inner_starts, starts, ends)
+        inner_ends = np.clip(np.maximum(inner_ends, inner_starts), starts, ends)
+
+        columns = np.concatenate([_ranges(starts, inner_starts), _ranges(inner_ends, ends)])
+        cell_rows = np.concatenate([np.repeat(rows, np.maximum(inner_starts - starts, 0)),
+                                    np.repeat(rows, np.maximum(ends - inner_ends, 0))])
+        cells = columns * self.shape[1] + cell_rows
+
+        return cells[self.cell_live[cells] > 0]
+
+    def closest_to_distance(self, point, distance):
+        """Index of the live facility whose distance to point is the closest to distance (lowest index if tied),
+        or -1 if all facilities are exhausted"""
+
+        if self.num_live == 0:
+            return -1
+
+        point = np.asarray(point, dtype = float)
+        if not (np.isfinite(distance) and np.all(np.isfinite(point))):
+            # Unknown distance or point, all costs are undefined so keep the first live facility
+            return np.flatnonzero(self.live)[0]
+        reach = np.sqrt(np.sum(np.maximum(np.abs(point - self.mins), np.abs(self.maxs - point))**2))
+
+        delta = self.cell_size
+        while True:
+            inner_radius = max(distance - delta, 0)
+            outer_radius = distance + delta
+            cells = self._ring_cells(point, inner_radius, outer_radius)
+
+            candidates = self.order[_ranges(self.cell_starts[cells], self.cell_starts[cells + 1])]
+            candidates = candidates[self.live[candidates]]
+            if len(candidates) > 0:
+                distances = np.sqrt(np.sum((self.coordinates[candidates] - point)**2, axis = 1))
+                costs = np.abs(distances - distance)
+                best_cost = costs.min()
+                # Every facility with a cost up to delta is in the ring, so the best one is known
+                if best_cost <= delta or (inner_radius == 0 and outer_radius >= reach):
+                    return candidates[costs == best_cost].min()
+
+            if inner_radius == 0 and outer_radius >= reach:
+                return -1
+            delta *= 2
+
+    def closest_k_to_distance(self, point, distance, k):
+        """Indices and costs of the (up to) k live facilities whose distance to point is the closest to distance,
+        sorted by cost (and by index if tied)"""
+
+        empty = (np.zeros(0, dtype = int), np.zeros(0))
+        if self.num_live == 0 or k < 1:
+            return empty
+
+        point = np.asarray(point, dtype = float)
+        if not (np.isfinite(distance) and np.all(np.isfinite(point))):
+            return empty
+        reach = np.sqrt(np.sum(np.maximum(np.abs(point - self.mins), np.abs(self.maxs - point))**2))
+
+        delta = self.cell_size
+        while True:
+            inner_radius = max(distance - delta, 0)
+            outer_radius = distance + delta
+            cells = self._ring_cells(point, inner_radius, outer_radius)
+            covered = inner_radius == 0 and outer_radius >= reach
+
+            candidates = self.order[_ranges(self.cell_starts[cells], self.cell_starts[cells + 1])]
+            candidates = candidates[self.live[candidates]]
+            distances = np.sqrt(np.sum((self.coordinates[candidates] - point)**2, axis = 1))
+            costs = np.abs(distances - distance)
+            # Every facility with a cost up to delta is in the ring, so the k best are known once k of them are found
+            if np.count_nonzero(costs <= delta) >= k or covered:
+                order = np.lexsort((candidates, costs))[:k]
+                return candidates[order], costs[order]
+
+            delta *= 2
+
+    def farthest_within_distance(self, point, distance):
+        """Index of the live facility farthest from point within distance (lowest index if tied), or -1 if there is
+        no live facility within distance"""
+
+        if self.num_live == 0:
+            return -1
+
+        point = np.asarray(point, dtype = float)
+        if not (np.isfinite(distance) and np.all(np.isfinite(point))):
+            return -1
+
+        # Search in rings of growing width from distance towards point
+        delta = self.cell_size
+        while True:
+            inner_radius = max(distance - delta, 0)
+            cells = self._ring_cells(point, inner_radius, distance)
+
+            candidates = self.order[_ranges(self.cell_starts[cells], self.cell_starts[cells + 1])]
+            candidates = candidates[self.live[candidates]]
+            if len(candidates) > 0:
+                distances = np.sqrt(np.sum((self.coordinates[candidates] - point)**2, axis = 1))
+                candidates, distances = candidates[distances <= distance], distances[distances <= distance]
+                # Every facility within distance and farther than inner_radius is in the ring
+                if len(candidates) > 0 and distances.max() >= inner_radius:
+                    return candidates[distances == distances.max()].min()
+
+            if inner_radius == 0:
+                return -1
+            delta *= 2
+
+def _ranges(starts, ends):
+    """Concatenation of np.arange(start, end) for each pair of starts and ends"""
+
+    lengths = np.maximum(ends - starts, 0)
+    total = lengths.sum()
+    if total == 0:
+        return np.zeros(0, dtype = int)
+    offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+
+    return offsets + np.arange(total)
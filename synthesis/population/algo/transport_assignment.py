@@ -0,0 +1,198 @@
+import heapq
+import collections
+import time
+import numpy as np
+
+def auction_assignment(indptr, facilities, costs, capacities, epsilon = 1.0, scaling = 5.0):
+    """Assign each agent to one of its candidate facilities minimizing the total cost without exceeding the capacity
+    of the facilities, by a forward/reverse auction with epsilon scaling (Bertsekas & Castanon) where each facility
+    has capacity identical slots
+
+    Candidates of agent i are facilities[indptr[i]:indptr[i + 1]] with costs[indptr[i]:indptr[i + 1]] (CSR-like).
+    Agents that cannot get any candidate with capacity are assigned -1 (overflow).
+    The total cost is within num_agents * epsilon of the optimal one.
+    Returns the assignment and a report with the cost of the assignment, the dual bound and runtime."""
+
+    start_time = time.perf_counter()
+
+    indptr = np.asarray(indptr, dtype = int)
+    facilities = np.asarray(facilities, dtype = int)
+    costs = np.asarray(costs, dtype = float)
+    capacities = np.floor(np.nan_to_num(np.asarray(capacities, dtype = float), posinf = len(indptr)))
+    num_agents = len(indptr) - 1
+    num_facilities = len(capacities)
+    overflow = num_facilities
+
+    # Candidates with capacity of each agent (CSR-like), the overflow taking any number of agents being the last one.
+    # Benefits are negative costs, overflowing is worse than any candidate so it is only chosen when candidates have
+    # not enough capacity
+    available = capacities[facilities] >= 1
+    entry_agents = np.repeat(np.arange(num_agents), np.diff(indptr))
+    counts = np.bincount(entry_agents[available], minlength = num_agents)
+    agent_starts = np.concatenate([[0], np.cumsum(counts + 1)]).astype(int)
+    is_overflow = np.zeros(agent_starts[-1], dtype = bool)
+    is_overflow[agent_starts[1:] - 1] = True
+    agent_facilities = np.full(agent_starts[-1], overflow, dtype = int)
+    agent_facilities[~is_overflow] = facilities[available]
+    agent_benefits = np.full(agent_starts[-1], -(2.0 * (float(np.max(costs)) if len(costs) > 0 else 0.0) + 1.0))
+    agent_benefits[~is_overflow] = -costs[available]
+
+    # Slots of each facility, a facility never holds more agents than those having it as candidate. The overflow has
+    # a single slot standing for all its slots, always at zero price
+    degrees = np.bincount(agent_facilities, minlength = num_facilities + 1)
+    num_slots = np.append(np.minimum(np.maximum(capacities, 0), degrees[:-1]), 1).astype(int)
+    slot_starts = np.concatenate([[0], np.cumsum(num_slots)]).astype(int)
+    slot_facilities = np.repeat(np.arange(num_facilities + 1), num_slots)
+
+    # Agents having each facility as candidate (transposed CSR)
+    owners = np.repeat(np.arange(num_agents), np.diff(agent_starts))
+    order = np.argsort(agent_facilities, kind = "mergesort")
+    facility_starts = np.concatenate([[0], np.cumsum(degrees)]).astype(int)
+    facility_agents = owners[order]
+    facility_benefits = agent_benefits[order]
+
+    slot_prices = np.zeros(slot_starts[-1])
+    slot_agents = np.full(slot_starts[-1], -1, dtype = int)
+    agent_slots = np.full(num_agents, slot_starts[-1] - 1, dtype = int)
+    held_benefits = np.zeros(num_agents)
+    num_bids = 0
+
+    # Each phase with decreasing epsilon keeps the slot prices of the previous one (warm start)
+    phase_epsilon = max(-agent_benefits.min() / scaling, epsilon) if num_agents > 0 else epsilon
+    while True:
+        num_bids += _forward_auction(agent_starts, agent_facilities, agent_benefits, slot_starts, slot_prices,
+                                     slot_agents, agent_slots, phase_epsilon)
+        held_benefits = agent_benefits[agent_starts[1:] - 1].copy()
+        held = agent_facilities == slot_facilities[agent_slots][owners]
+        held_benefits[owners[held]] = agent_benefits[held]
+        num_bids += _reverse_auction(facility_starts, facility_agents, facility_benefits, slot_facilities,
+                                     slot_prices, slot_agents, agent_slots, held_benefits, phase_epsilon)
+
+        if phase_epsilon <= epsilon:
+            break
+        phase_epsilon = max(phase_epsilon / scaling, epsilon)
+
+    # Cost of the assignment and dual bound (with prices shifted by the lowest price of the held slots), the gap
+    # bounds how far the assignment is from the optimal one
+    lowest_price = slot_prices[agent_slots].min() if num_agents > 0 else 0.0
+    dual_prices = np.maximum(slot_prices - lowest_price, 0)
+    facility_prices = np.zeros(num_facilities + 1)
+    facility_prices[num_slots > 0] = np.minimum.reduceat(dual_prices, slot_starts[:-1][num_slots > 0])
+    dual = float(np.sum(dual_prices))
+    if num_agents > 0:
+        profits = agent_benefits - facility_prices[agent_facilities]
+        dual += float(np.maximum.reduceat(profits, agent_starts[:-1]).sum())
+    cost = -float(held_benefits.sum())
+    gap = max(cost + dual, 0.0)
+
+    assignment = slot_facilities[agent_slots]
+    assignment[assignment == overflow] = -1
+
+    report = dict(
+        cost = cost,
+        bound = -dual,
+        gap = gap,
+        relative_gap = gap / max(abs(cost), 1.0),
+        overflow = int(np.count_nonzero(assignment < 0)),
+        bids = num_bids,
+        runtime = time.perf_counter() - start_time
+    )
+
+    return assignment, report
+
+def _forward_auction(agent_starts, agent_facilities, agent_benefits, slot_starts, slot_prices, slot_agents,
+                     agent_slots, epsilon):
+    """Forward auction from the given slot prices: all agents are released and bid for the cheapest slot of their
+    best candidate until all are assigned (slot prices and holders are updated in place)"""
+
+    num_facilities = len(slot_starts) - 2
+    overflow = num_facilities
+    overflow_slot = slot_starts[-1] - 1
+
+    # Entries of the slot heaps are (price, agent holding the slot or -1 if free), a sorted list being a heap
+    slots = [sorted((price, -1) for price in slot_prices[slot_starts[facility]:slot_starts[facility + 1]].tolist())
+             for facility in range(num_facilities)]
+    prices = np.zeros(num_facilities + 1)
+    prices[:-1] = [facility_slots[0][0] if len(facility_slots) > 0 else np.inf for facility_slots in slots]
+    num_bids = 0
+
+    queue = collections.deque(range(len(agent_slots)))
+    while queue:
+        agent = queue.popleft()
+        candidates = agent_facilities[agent_starts[agent]:agent_starts[agent + 1]]
+        values = agent_benefits[agent_starts[agent]:agent_starts[agent + 1]] - prices[candidates]
+        num_bids += 1
+
+        best = np.argmax(values)
+        facility = candidates[best]
+        if facility == overflow:
+            continue
+        best_value = values[best]
+        values[best] = -np.inf
+
+        # The second best is another facility or the next cheapest slot of the same facility
+        second_value = values.max()
+        facility_slots = slots[facility]
+        if len(facility_slots) > 1:
+            second_value = max(second_value, best_value + prices[facility] -
+                               min(price for price, _ in facility_slots[1:3]))
+        # The bid raises the price so that the agent is indifferent (up to epsilon) to its second best
+        bid = prices[facility] + best_value - second_value + epsilon
+
+        # The cheapest slot of the facility is taken, outbidding the agent holding it (if any)
+        _, outbid_agent = heapq.heapreplace(facility_slots, (bid, agent))
+        if outbid_agent >= 0:
+            queue.append(outbid_agent)
+        prices[facility] = facility_slots[0][0]
+
+    # Back to the slot arrays (slots of a facility are interchangeable, so their order does not matter)
+    for facility, facility_slots in enumerate(slots):
+        slot_prices[slot_starts[facility]:slot_starts[facility + 1]] = [price for price, _ in facility_slots]
+        slot_agents[slot_starts[facility]:slot_starts[facility + 1]] = [agent for _, agent in facility_slots]
+    slot_agents[overflow_slot] = -1
+    agent_slots[:] = overflow_slot
+    held = slot_agents >= 0
+    agent_slots[slot_agents[held]] = np.flatnonzero(held)
+
+    return num_bids
+
+def _reverse_auction(facility_starts, facility_agents, facility_benefits, slot_facilities, slot_prices, slot_agents,
+                     agent_slots, held_benefits, epsilon):
+    """Reverse auction: free slots are lowered to the lowest price of the held slots (lambda), attracting agents
+    holding other slots if worth it, so that the prices are (up to epsilon) optimal dual prices"""
+
+    if len(agent_slots) == 0:
+        return 0
+    overflow_slot = len(slot_prices) - 1
+    lowest_price = slot_prices[agent_slots].min()
+    num_bids = 0
+
+    queue = collections.deque(np.flatnonzero((slot_agents < 0) & (slot_prices > lowest_price)).tolist())
+    while queue:
+        slot = queue.popleft()
+        facility = slot_facilities[slot]
+        agents = facility_agents[facility_starts[facility]:facility_starts[facility + 1]]
+        benefits = facility_benefits[facility_starts[facility]:facility_starts[facility + 1]]
+        # Value of the slot for each agent, i.e. its benefit minus the profit of the slot the agent holds
+        values = benefits - (held_benefits[agents] - slot_prices[agent_slots[agents]])
+        num_bids += 1
+
+        best = np.argmax(values)
+        if values[best] - epsilon <= lowest_price:
+            slot_prices[slot] = lowest_price
+            continue
+        values[best] = -np.inf
+
+        # The agent moves to the slot, releasing its previous slot (the overflow is never exhausted)
+        agent = agents[best]
+        previous_slot = agent_slots[agent]
+        if previous_slot != overflow_slot:
+            slot_agents[previous_slot] = -1
+            if slot_prices[previous_slot] > lowest_price:
+                queue.append(previous_slot)
+        slot_agents[slot] = agent
+        slot_prices[slot] = max(lowest_price, values.max() - epsilon)
+        agent_slots[agent] = slot
+        held_benefits[agent] = benefits[best]
+
+    return num_bids
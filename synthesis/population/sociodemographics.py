@@ -1,6 +1,5 @@
 import pandas as pd
 import numpy as np
-from tqdm import tqdm
 import os
 from data import commonFunctions
 import warnings
@@ -10,13 +9,12 @@ def configure(context):
     context.stage("synthesis.population.matched")
     context.stage("synthesis.population.sampled")
     context.stage("data.hts.cleaned")
-    context.config("routes_file")
+    context.stage("data.spatial.gates")
     context.config("output_path")
 
 def validate(context):
     data_path = context.config("data_path")
     output_path = context.config("output_path")
-    routes_file = "%s/%s" % (context.config("data_path"), context.config("routes_file"))
 
     if not os.path.isdir(data_path):
         raise RuntimeError("Input directory must exist: %s" % data_path)
@@ -24,9 +22,6 @@ def validate(context):
     if not os.path.isdir(output_path):
         raise RuntimeError("Output directory must exist: %s" % output_path)
 
-    if not os.path.exists(routes_file):
-        raise RuntimeError("Input file must exist: %s" % routes_file)
-
 def execute(context):
 
     # Ignore warning when working on slices of dataframes
@@ -65,13 +60,9 @@ def execute(context):
     all_df_matching = context.stage("synthesis.population.matched")
     all_df_persons = context.stage("synthesis.population.sampled")
     all_df_hts = list(context.stage("data.hts.cleaned"))
-    df_routes_gate = pd.read_excel("%s/%s" % (context.config("data_path"), context.config("routes_file")),
-                                   header=0,
-                                   # encoding="cp1250",
-                                   dtype=str)[["State", "KOD_LAU2", "Shape_Length", "GATEosm_id"]]
 
-    # Get distance of Czech towns to Ustí city
-    df_routes_gate["Shape_Length"] = df_routes_gate["Shape_Length"].astype(np.float).astype(np.int)
+    # Get the synthetic gate and distance to Ustí city of Czech towns and other states
+    df_town_gates, df_state_gates = context.stage("data.spatial.gates")[:2]
 
     # Get both HTS data
     all_df_hts[0] = all_df_hts[0].rename(columns={'ActivityCzechiaHTS': 'Activity'}).copy()
@@ -133,47 +124,30 @@ def execute(context):
         # Change the following if starting/leaving the district and going/coming to/from an outer area:
         # a) PrimaryLocCrowFliesTripDist for each person that lives and travels (primarily) to outside the area
 
-        all_outside_towns = set(df_persons["TownCode"].dropna())
-        all_outside_towns.update(set(df_persons["PrimaryLocTownCode"].dropna()))
-        all_outside_towns.difference_update(set(cities_usti_district))
-        all_outside_towns.difference_update({"0"})
-
-        for town_code in all_outside_towns:
-            town_dist = df_routes_gate.loc[df_routes_gate["KOD_LAU2"] == town_code, "Shape_Length"]
-            town_dist = town_dist.values[0]
-            persons_inds = (df_persons["TownCode"] == town_code) \
-                            | (df_persons["PrimaryLocTownCode"] == town_code)
-            df_persons.loc[persons_inds, "PrimaryLocCrowFliesTripDist"] = \
-                df_persons.loc[persons_inds, "PrimaryLocCrowFliesTripDist"] - town_dist
-            negative_dist_persons = ((df_persons["TownCode"] == town_code)
-                                     | (df_persons["PrimaryLocTownCode"] == town_code)) \
-                                     & (df_persons["PrimaryLocCrowFliesTripDist"] < town_dist)
-            df_persons.loc[negative_dist_persons, "PrimaryLocCrowFliesTripDist"] = town_dist
-
-        all_outside_states = set(df_persons["PrimaryLocStateName"].dropna()) - set(['Česko'])
-
-        for state_name in all_outside_states:
-            state_dist = df_routes_gate.loc[df_routes_gate["State"] == state_name, "Shape_Length"]
-            state_dist = state_dist.values[0]
-
-            persons_inds = (df_persons["PrimaryLocStateName"] == state_name)
-            df_persons.loc[persons_inds, "PrimaryLocCrowFliesTripDist"] = \
-                df_persons.loc[persons_inds, "PrimaryLocCrowFliesTripDist"] - state_dist
-
-            negative_dist_persons = (df_persons["PrimaryLocStateName"] == state_name) \
-                                    & (df_persons["PrimaryLocCrowFliesTripDist"] < state_dist)
-            df_persons.loc[negative_dist_persons, "PrimaryLocCrowFliesTripDist"] = state_dist
+        # Subtract the distance to the outside town of home and then of the primary location (if different)
+        crow_flies_dist = df_persons["PrimaryLocCrowFliesTripDist"]
+        outside_towns = ~df_persons["TownCode"].isin(cities_usti_district) & (df_persons["TownCode"] != "0")
+        town_dist = df_persons["TownCode"].map(df_town_gates["Shape_Length"]).where(outside_towns)
+        crow_flies_dist = crow_flies_dist.mask(town_dist.notna(), np.maximum(crow_flies_dist - town_dist, town_dist))
+
+        outside_towns = ~df_persons["PrimaryLocTownCode"].isin(cities_usti_district) \
+                        & (df_persons["PrimaryLocTownCode"] != "0") \
+                        & (df_persons["PrimaryLocTownCode"] != df_persons["TownCode"])
+        town_dist = df_persons["PrimaryLocTownCode"].map(df_town_gates["Shape_Length"]).where(outside_towns)
+        crow_flies_dist = crow_flies_dist.mask(town_dist.notna(), np.maximum(crow_flies_dist - town_dist, town_dist))
+
+        # Subtract the distance to the outside state of the primary location
+        outside_states = df_persons["PrimaryLocStateName"] != 'Česko'
+        state_dist = df_persons["PrimaryLocStateName"].map(df_state_gates["Shape_Length"]).where(outside_states)
+        crow_flies_dist = crow_flies_dist.mask(state_dist.notna(), np.maximum(crow_flies_dist - state_dist, state_dist))
+
+        df_persons["PrimaryLocCrowFliesTripDist"] = \
+            crow_flies_dist.astype(df_persons["PrimaryLocCrowFliesTripDist"].dtype)
 
         # Change the real town ID to synthetic gate ID if zone is not within the district
-        df_groups = df_routes_gate.groupby("GATEosm_id")
-        desc = "Change the real town ID to synthetic gate ID if zone is not within the district for df_ind: " + str(df_ind)
-        for GATEosm_id, places_via_gate in tqdm(df_groups, total=len(df_groups), ascii=True,
-                                                desc=desc):
-            cities_gate_ids = places_via_gate["KOD_LAU2"].dropna().values.tolist()
-
-            home_out_inds = (df_persons["DistrictCode"] != '4214') \
-                            & (df_persons["TownCode"].isin(cities_gate_ids))
-            df_persons.loc[home_out_inds, "BasicSettlementCode"] = GATEosm_id
+        town_gates = df_persons["TownCode"].map(df_town_gates["GATEosm_id"])
+        home_out_inds = (df_persons["DistrictCode"] != '4214') & town_gates.notna()
+        df_persons.loc[home_out_inds, "BasicSettlementCode"] = town_gates[home_out_inds]
 
         if df_ind == 0:
             # CzechiaHTS data
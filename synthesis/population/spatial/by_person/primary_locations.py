@@ -1,19 +1,27 @@
 import sys
+import multiprocessing as mp
 
 from tqdm import tqdm
 import pandas as pd
 import numpy as np
 import os
-import shapely.geometry as geo
+import shapely.vectorized
+import zlib
 import geopandas as gpd
 from sklearn.neighbors import KDTree
 from data import commonFunctions
+from synthesis.population.algo.ring_search import RingSearchIndex
+from synthesis.population.algo.capacity_heap import CapacityHeap
+from synthesis.population.algo.capacity_ledger import CapacityLedger
+from synthesis.population.algo.transport_assignment import auction_assignment
 
 # Define globals
-SAMPLE_SIZE = 1000
 DIST_POINTS = 5000
 ALL_FACILITY_USAGES = {'0', '1', '2', '3', '4', '5', '6', '7', '8', '9'}
 ALL_EDUCATION_PLACES = {'0', '1', '2', '3', '4'}
+PURPOSE_CAPACITIES = {"home": "Inhabitants", "work": "WorkPlaces", "education": "StudyPlaces"}
+ZONE_POINTS = dict() # Random points sampled inside zones without facilities, per zone and seed
+PRIMARY_CANDIDATES = 16 # Candidate facilities per person/agent (closest to its crow flies distance) in transport solver
 
 def configure(context):
     context.config("data_path")
@@ -25,6 +33,8 @@ def configure(context):
     context.stage("synthesis.population.sampled")
     context.stage("synthesis.population.trips")
     context.config("processes")
+    context.config("random_seed")
+    context.config("primary_solver")
     context.stage("data.hts.cleaned")
     context.config("output_path")
 
@@ -42,279 +52,344 @@ def validate(context):
     if not os.path.exists(generalizations_file):
         raise RuntimeError("Input file must exist: %s" % generalizations_file)
 
-def assign_agents(df_persons, commute_coordinates, commute_caps, purpose, progress):
+def person_arrays(df_persons):
+    """Home coordinates, crow flies distances and activities of persons/agents, or None if their home is not known"""
 
-    if "HomeX" in df_persons.columns:
-        # If known where is the home location, ordering based on the primary location distance from home and capacities
-        home_coordinates = df_persons[["HomeX", "HomeY"]].values
-        commute_distances = df_persons["PrimaryLocCrowFliesTripDist"].values
+    if "HomeX" not in df_persons.columns:
+        return None
+
+    home_coordinates = df_persons[["HomeX", "HomeY"]].values
+    commute_distances = df_persons["PrimaryLocCrowFliesTripDist"].values
+    try:
+        activities = df_persons["Activity"].values
+    except KeyError:
         try:
-            activities = df_persons["Activity"].values
+            activities = df_persons["ActivityCityHTS"].values
         except KeyError:
-            try:
-                activities = df_persons["ActivityCityHTS"].values
-            except KeyError:
-                activities = df_persons["ActivityCzechiaHTS"].values
+            activities = df_persons["ActivityCzechiaHTS"].values
+
+    return home_coordinates, commute_distances, activities
+
+def assign_agents(arguments):
+    """Assign the persons/agents of one zone to the locations of the zone, used by worker processes since each zone
+    only has its own persons/agents and locations"""
+
+    num_persons, commute_coordinates, commute_caps, purpose, persons, solver = arguments
+
+    if persons is not None:
+        # If known where is the home location, ordering based on the primary location distance from home and capacities
+        home_coordinates, commute_distances, activities = persons
+        if solver == "transport":
+            return transport_primary_ordering(home_coordinates, commute_coordinates, activities, commute_caps,
+                                              commute_distances, purpose)
         indices,commute_caps = heuristic_primary_ordering(home_coordinates, commute_coordinates, activities,
-                                                          commute_caps, commute_distances, purpose, progress)
-        return indices,commute_caps
+                                                          commute_caps, commute_distances, purpose)
+        return indices,commute_caps,None
     else:
         # If not know where is the home location, ordering only based on the capacities
-        num_persons = len(df_persons["PersonID"])
-        indices,commute_caps = heuristic_home_ordering(num_persons, commute_caps, progress)
-        return indices,commute_caps
+        # (without distances all assignments have the same cost, so there is nothing to optimize)
+        indices,commute_caps = heuristic_home_ordering(num_persons, commute_caps)
+        return indices,commute_caps,None
 
-def heuristic_home_ordering(num_persons, home_caps, progress):
-    indices = []
+def heuristic_home_ordering(num_persons, home_caps):
 
-    for _ in range(0, num_persons):
-        # Select the home location with the highest number of available capacity
-        # (i.e. the highest number of inhabitants not assigned yet)
-        index = np.argmax(home_caps)
-        # Reduce the number of available capacity (i.e. number of inhabitants not assigned yet)
-        home_caps[index] -= 1
-        indices.append(index)
-        progress.update(1)
+    # Select each time the home location with the highest number of available capacity
+    # (i.e. the highest number of inhabitants not assigned yet) and reduce it, as repeating np.argmax(home_caps)
+    indices = list(CapacityHeap(home_caps).assign(num_persons))
 
     return indices, home_caps
 
 def heuristic_primary_ordering(home_coordinates, commute_coordinates, activities, commute_caps, commute_distances,
-                               purpose, progress):
+                               purpose):
 
     indices = []
 
+    # Index of the facilities that answers which facility with available capacity has the distance from home
+    # closest to the crow flies distance (searching in a ring around home), exhausted facilities are removed from it
+    facility_index = RingSearchIndex(commute_coordinates, commute_caps)
+    # Heap of the facilities by available capacity, only built once all facilities are exhausted
+    exhausted_heap = None
+
     for home_coordinate, commute_distance, activity in zip(home_coordinates, commute_distances, activities):
-        # Calculate the distance of the filtered facilities to home location
-        distances = np.sqrt(np.sum((commute_coordinates - home_coordinate)**2, axis = 1))
-        # Set up the cost as the difference between the facility distance (from home location) with the crow flies distance
-        costs = np.abs(distances - commute_distance)
-        # For those facilities that don't have available capacity yet, set their cost as infinite
-        costs[commute_caps < 1] = np.inf
-        if min(costs) == np.inf:
+        # Choose the facility with available capacity and lowest cost, i.e. the lowest difference between the facility
+        # distance (from home location) and the crow flies distance
+        index = facility_index.closest_to_distance(home_coordinate, commute_distance)
+        if index < 0:
             # If all filtered facilities have no available capacity, distribute evenly new assignments among them
-            index = np.argmax(commute_caps)
-        else:
-            # If at least one filtered facility with available capacity, choose the one with lowest cost
-            index = np.argmin(costs)
+            if exhausted_heap is None:
+                exhausted_heap = CapacityHeap(commute_caps)
+            index = exhausted_heap.argmax()
         # Reduce the number of available capacity (i.e. number of persons not assigned yet)
         # For people with education trips but not mainly students (i.e. parents taking kids to school), don't reduce
         if purpose != "education" or activity == '2':
-            commute_caps[index] -= 1
+            facility_index.consume(index)
+            if exhausted_heap is not None:
+                exhausted_heap.update(index)
         indices.append(index)
-        progress.update(1)
 
     return indices,commute_caps
 
-def impute_diff_zone_locations(df_persons, df_zones, df_locations, purpose):
+def transport_primary_ordering(home_coordinates, commute_coordinates, activities, commute_caps, commute_distances,
+                               purpose):
+    """Assign the persons/agents of a zone minimizing the total difference between the facility distance (from home
+    location) and the crow flies distance, as an optimal transport problem over the closest candidate facilities"""
+
+    # Only persons/agents reducing the available capacity compete for the facilities
+    # (i.e. not persons with education trips but not mainly students, as parents taking kids to school)
+    if purpose != "education":
+        consuming = np.ones(len(home_coordinates), dtype = bool)
+    else:
+        consuming = np.asarray(activities) == '2'
+    positions = np.flatnonzero(consuming)
+
+    # Candidate facilities (with available capacity) of each person/agent, as CSR arrays
+    facility_index = RingSearchIndex(commute_coordinates, commute_caps)
+    candidates = [facility_index.closest_k_to_distance(home_coordinates[position], commute_distances[position],
+                                                       PRIMARY_CANDIDATES) for position in positions]
+    indptr = np.concatenate([[0], np.cumsum([len(facilities) for facilities, _ in candidates])]).astype(int)
+    facilities = np.concatenate([facilities for facilities, _ in candidates] + [np.zeros(0, dtype = int)])
+    costs = np.concatenate([costs for _, costs in candidates] + [np.zeros(0)])
+
+    # Persons/agents not competing take the facility (with available capacity) closest to their crow flies distance
+    indices = np.full(len(home_coordinates), -1, dtype = int)
+    for position in np.flatnonzero(~consuming):
+        indices[position] = facility_index.closest_to_distance(home_coordinates[position], commute_distances[position])
+
+    assignment, report = auction_assignment(indptr, facilities, costs, commute_caps)
+
+    # Reduce the number of available capacity of the assigned facilities
+    assigned = assignment >= 0
+    indices[positions[assigned]] = assignment[assigned]
+    np.subtract.at(commute_caps, assignment[assigned], 1)
+
+    # Persons/agents without candidate with enough capacity (or facility with available capacity at all)
+    # are assigned by the heuristic
+    remaining = np.flatnonzero(indices < 0)
+    if len(remaining) > 0:
+        remaining_indices,commute_caps = heuristic_primary_ordering(home_coordinates[remaining],
+                                                                    commute_coordinates,
+                                                                    np.asarray(activities)[remaining],
+                                                                    commute_caps,
+                                                                    commute_distances[remaining],
+                                                                    purpose)
+        indices[remaining] = remaining_indices
+
+    return list(indices),commute_caps,report
+
+def sample_zone_points(zone_id, shape, num_points, random_seed):
+    """Uniformly distributed random points inside the shape of a zone, cached per zone and seed since the same zones
+    are sampled for home, work and education of every facility usage"""
+
+    key = (zone_id, num_points, random_seed)
+    if key not in ZONE_POINTS:
+        # Stream of random numbers of the zone independent of the order in which zones are sampled
+        random = np.random.RandomState([random_seed, zlib.crc32(str(zone_id).encode())])
+        minx, miny, maxx, maxy = shape.bounds
+        # Share of the bounding box inside the zone, to draw enough candidates for all points in (usually) one go
+        inside_ratio = max(shape.area / max((maxx - minx) * (maxy - miny), 1e-9), 1e-3)
+
+        points = np.zeros((0, 2))
+        while len(points) < num_points:
+            num_candidates = int(np.ceil((num_points - len(points)) / inside_ratio * 1.1)) + 10
+            candidates = random.random_sample(size=(num_candidates, 2))
+            candidates[:, 0] = minx + candidates[:, 0] * (maxx - minx)
+            candidates[:, 1] = miny + candidates[:, 1] * (maxy - miny)
+            inside = shapely.vectorized.contains(shape, candidates[:, 0], candidates[:, 1])
+            points = np.concatenate([points, candidates[inside]])
+
+        ZONE_POINTS[key] = points[:num_points]
+
+    return ZONE_POINTS[key]
+
+def impute_diff_zone_locations(df_persons, df_zones, df_locations, purpose, random_seed, capacity_ledger, processes,
+                               solver = "heuristic", solver_reports = None, pool = None):
 
     df_counts = df_persons[["ZoneID"]].groupby("ZoneID").size().reset_index(name="count")
     df_zones = pd.merge(df_zones, df_counts, on = "ZoneID", how = "inner").drop_duplicates(subset=["ZoneID"])
     df_impute = df_zones[["ZoneID", "count", "geometry"]].values
 
-    person_dfs = []
+    # Positions of the persons/agents and of the filtered facilities of each zone
+    person_positions = df_persons.groupby("ZoneID").indices
+    location_positions = df_locations.groupby("ZoneID").indices if df_locations is not None else dict()
+    persons = person_arrays(df_persons)
 
-    all_counts = sum([zone_count for zone_count in df_counts["count"]])
-
-    progress = tqdm(df_impute, position=0, leave=False, total=all_counts, ascii=True)
-    progress.set_description("Sampling coordinates for different zones")
-    for zone_id, count, shape in progress:
+    # Prepare the assignment of each zone, each one owning the capacities of the facilities in the zone
+    zones = []
+    arguments = []
+    for zone_id, count, shape in df_impute:
         if count > 0:
             # If at least one person/agent to be assigned location
-            points = []
-            ids = []
-
-            if df_locations is None or np.count_nonzero(df_locations["ZoneID"] == zone_id) == 0:
-                no_facilities = True
+            if zone_id not in location_positions:
                 # When no filtered facility in certain zone,
                 # assign people/agents to random points inside the zone of the primary location
-                minx, miny, maxx, maxy = shape.bounds
-                num_points = int(shape.area / DIST_POINTS) # 1 point per 5 square kilometres (time consuming process)
-                counter = 0
-                while len(points) < num_points:
-                    candidates = np.random.random(size=(SAMPLE_SIZE, 2))
-                    candidates[:, 0] = minx + candidates[:, 0] * (maxx - minx)
-                    candidates[:, 1] = miny + candidates[:, 1] * (maxy - miny)
-                    candidates = [geo.Point(*point) for point in candidates]
-                    candidates = [(str(zone_id) + "_" + str(ind), point) for ind, point in enumerate(candidates)
-                                  if shape.contains(point)]
-                    candidatesIDs, candidates = zip(*candidates)
-                    counter += len(candidates)
-                    points += candidates
-                    ids += candidatesIDs
-                    progress.set_postfix({'Status': "ZoneID: " + zone_id +
-                                                    " - Generated " + str(counter) + " of " + str(num_points)})
-
-                points, ids = points[:num_points], ids[:num_points]
-                points = np.array([np.array([point.x, point.y]) for point in points])
+                num_points = int(shape.area / DIST_POINTS) # 1 point per 5 square kilometres
+                points = sample_zone_points(zone_id, shape, num_points, random_seed)
                 ids = np.array([str(zone_id) + "_" + str(ind) for ind in range(len(points))])
                 caps = np.array([float('inf') for _ in range(len(points))])
+                facility_indices = None
             else:
                 # When there are filtered facilities in the zone, assign agents/people to them
-                no_facilities = False
-                df_zone_locations = df_locations[df_locations["ZoneID"] == zone_id]
-
-                points = pd.DataFrame(columns=['x', 'y'])
-                locations = df_zone_locations['geometry']
-                counter = 0
-                for point in locations.geometry:
-                    counter += 1
-                    try:
-                        points = pd.concat([points, pd.DataFrame(data={'x': [point.x], 'y': [point.y]})],
-                                           sort=False)
-                    except AttributeError:
-                        # If facility's geometry is an area/polygon, use its centroid
-                        points = pd.concat([points, pd.DataFrame(data={'x': [point.centroid.x],
-                                                                       'y': [point.centroid.y]})], sort=False)
-
-                    progress.set_postfix({'Status': "ZoneID: " + zone_id +
-                                                    " - Retrieved " + str(counter) + " of " + str(len(locations))})
-                points = points.values
+                df_zone_locations = df_locations.iloc[location_positions[zone_id]]
+                points = np.column_stack([df_zone_locations["x"].values, df_zone_locations["y"].values])
                 ids = df_zone_locations["LocationID"].values
-                # Define which attribute to use as capacity of the facility
-                if purpose == "home":
-                    caps = df_zone_locations["Inhabitants"].values
-                elif purpose == "work":
-                    caps = df_zone_locations["WorkPlaces"].values
-                else:
-                    caps = df_zone_locations["StudyPlaces"].values
+                # Get the available capacities of the facilities from the ledger
+                facility_indices = capacity_ledger.indices(ids)
+                caps = capacity_ledger.get(PURPOSE_CAPACITIES[purpose], facility_indices)
 
-            f = df_persons["ZoneID"] == zone_id
+            f = person_positions[zone_id]
+            zone_persons = None if persons is None else tuple(values[f] for values in persons)
+            zones.append((zone_id, f, points, ids, facility_indices))
+            arguments.append((len(f), points, caps, purpose, zone_persons, solver))
 
-            # Assign the locations (either real ones or random points when none available)
-            indices,caps = assign_agents(df_persons[f], points, caps, purpose, progress)
+    all_counts = sum([zone_count for zone_count in df_counts["count"]])
 
-            df_persons.loc[f, "x"] = points[indices, 0]
-            df_persons.loc[f, "y"] = points[indices, 1]
-            df_persons.loc[f, "LocationID"] = ids[indices]
+    progress = tqdm(total=all_counts, position=0, leave=False, ascii=True)
+    progress.set_description("Sampling coordinates for different zones")
 
-            assert not df_persons[f].isnull().any()['x']
-            assert not df_persons[f].isnull().any()['y']
+    all_positions = []
+    all_x, all_y, all_ids = [], [], []
+
+    # Assign the locations (either real ones or random points when none available) of zones in parallel, in the pool
+    # of worker processes of the stage (if any)
+    if pool is None or len(arguments) < 2:
+        results = map(assign_agents, arguments)
+    else:
+        results = pool.imap(assign_agents, arguments, chunksize=max(len(arguments) // (processes * 4), 1))
 
-            person_dfs.append(df_persons[f])
+    for (zone_id, f, points, ids, facility_indices), (indices, caps, report) in zip(zones, results):
+        all_positions.append(f)
+        all_x.append(points[indices, 0])
+        all_y.append(points[indices, 1])
+        all_ids.append(ids[indices])
 
-            if no_facilities is False:
-                # If there were filtered facilities in the zone, update their available capacities
-                indx = pd.Series(ids).apply(lambda x:
-                                            df_locations["LocationID"].index[df_locations["LocationID"]
-                                                                             == x].values[0]).tolist()
+        if facility_indices is not None:
+            # If there were filtered facilities in the zone, update their available capacities
+            capacity_ledger.set(PURPOSE_CAPACITIES[purpose], facility_indices, caps)
 
-                if purpose == "home":
-                    df_locations.at[indx, "Inhabitants"] = caps
-                elif purpose == "work":
-                    df_locations.at[indx, "WorkPlaces"] = caps
-                else:
-                    df_locations.at[indx, "StudyPlaces"] = caps
+        if report is not None and solver_reports is not None:
+            # Optimality gap and runtime of the zone solved as optimal transport problem
+            report.update({"ZoneID": zone_id, "Purpose": purpose, "Persons": len(f), "Facilities": len(points)})
+            solver_reports.append(report)
 
+        progress.set_postfix({'Status': "ZoneID: " + zone_id})
+        progress.update(len(f))
+
+    progress.close()
     sys.stdout.write("\r") # Clean tqdm progress
 
-    if len(person_dfs) > 0:
-        return pd.concat(person_dfs), df_locations
+    if len(all_positions) > 0:
+        df_return = df_persons.iloc[np.concatenate(all_positions)].copy()
+        df_return["x"] = np.concatenate(all_x)
+        df_return["y"] = np.concatenate(all_y)
+        df_return["LocationID"] = np.concatenate(all_ids)
+
+        assert not df_return["x"].isnull().any()
+        assert not df_return["y"].isnull().any()
+
+        return df_return
     else:
-        return pd.DataFrame(), df_locations
+        return pd.DataFrame()
+
+def preallocate_locations(num_persons):
+    """Arrays of the locations assigned to persons/agents, filled by collect_locations at the Position of each one"""
+
+    return dict(
+        x = np.full(num_persons, np.nan),
+        y = np.full(num_persons, np.nan),
+        LocationID = np.empty(num_persons, dtype = object),
+        assigned = np.zeros(num_persons, dtype = bool)
+    )
+
+def collect_locations(locations, df_assigned):
+    """Store the locations assigned to persons/agents (with their Position) in the preallocated arrays"""
+
+    positions = df_assigned["Position"].values
+    locations["x"][positions] = df_assigned["x"].values
+    locations["y"][positions] = df_assigned["y"].values
+    locations["LocationID"][positions] = df_assigned["LocationID"].values
+    locations["assigned"][positions] = True
+
+def assigned_locations(df_persons, locations):
+    """Dataframe of the persons/agents with their assigned locations"""
+
+    assigned = locations["assigned"]
+    df_locations = df_persons.loc[assigned, ["PersonID"]].copy()
+    df_locations["x"] = locations["x"][assigned]
+    df_locations["y"] = locations["y"][assigned]
+    df_locations["LocationID"] = locations["LocationID"][assigned]
+
+    return df_locations
 
-def impute_primary_locations_same_zone(hts_trips, df_ag, df_candidates, purpose):
+def radius_sampler(hts_trips):
+    """Histogram (of 500 bins) of the crow flies distance of the HTS trips, to sample a radius for each person/agent"""
+
+    hist, bins = np.histogram(hts_trips["PrimaryLocCrowFliesTripDist"], weights = hts_trips["Weight"], bins = 500)
+    bin_midpoints = bins[:-1] + np.diff(bins)/2
+    cdf = np.cumsum(hist)
+    cdf = cdf / cdf[-1]
+
+    return bin_midpoints, cdf
+
+def impute_primary_locations_same_zone(hts_radius_sampler, df_ag, df_candidates, purpose, capacity_ledger):
 
     with tqdm(total=len(df_ag), desc="Sampling coordinates same zones",
               leave=False, position=0, ascii=True) as progress:
 
-        hts_trip = hts_trips.copy()
+        df_agents = df_ag.copy()
 
         # Assign a given radius to each person based on a histogram of all trips
         # from the chosen HTS survey (CityHTS or CzechiaHTS)
-        hist_cp, bins_cp = np.histogram(hts_trip["PrimaryLocCrowFliesTripDist"], weights = hts_trip["Weight"], bins = 500)
-
-        df_agents = df_ag.copy()
-        df_agents_cp = df_agents
-
-        home_coordinates_cp = list(zip(df_agents_cp["HomeX"], df_agents_cp["HomeY"]))
-
-        dest_coordinates = pd.DataFrame(columns=['x', 'y'])
-        dest_cap = []
-        if purpose == "work":
-            locations_cap = df_candidates[['geometry', "WorkPlaces"]]
-        else:
-            locations_cap = df_candidates[['geometry', "StudyPlaces"]]
-        for _,location in locations_cap.iterrows():
-            point = location['geometry']
-            if purpose == "work":
-                dest_cap.append(location['WorkPlaces'])
-            else:
-                dest_cap.append(location['StudyPlaces'])
-
-
-            try:
-                dest_coordinates = pd.concat([dest_coordinates, pd.DataFrame(data={'x': [point.x], 'y': [point.y]})],
-                                             sort=False)
-            except AttributeError:
-               # If an area/polygon, get the centroid
-               dest_coordinates = pd.concat([dest_coordinates, pd.DataFrame(data={'x': [point.centroid.x],
-                                                                                  'y': [point.centroid.y]})],
-                                            sort=False)
-
-        # Order the facilities based on the proximity to the assigned radius
-        bin_midpoints = bins_cp[:-1] + np.diff(bins_cp)/2
-        cdf = np.cumsum(hist_cp)
-        cdf = cdf / cdf[-1]
-        values = np.random.rand(len(df_agents_cp))
+        bin_midpoints, cdf = hts_radius_sampler
+        values = np.random.rand(len(df_agents))
         value_bins = np.searchsorted(cdf, values)
-        random_from_cdf_cp = bin_midpoints[value_bins] # in meters
-
-        tree = KDTree(dest_coordinates)
-        indices_cp, distances_cp = tree.query_radius(home_coordinates_cp, r=random_from_cdf_cp,
-                                                     return_distance = True, sort_results=True)
-
-        for i in range(len(indices_cp)):
-            l = indices_cp[i]
-            if len(l) == 0:
-                # In some cases no facility was found for certain persons within the given radius,
-                # assign the nearest facility
-                dist, ind = tree.query(np.array(home_coordinates_cp[i]).reshape(1,-1), 2,
-                                       return_distance = True, sort_results=True)
-                fac = ind[0][1]
-                indices_cp[i] = [fac]
-                distances_cp[i] = [dist[0][1]]
+        radii = bin_midpoints[value_bins] # in meters
+
+        home_coordinates = df_agents[["HomeX", "HomeY"]].values
+        dest_coordinates = np.column_stack([df_candidates["x"].values, df_candidates["y"].values])
+
+        # Get the available capacities of the facilities from the ledger
+        capacity_type = PURPOSE_CAPACITIES[purpose]
+        dest_indices = capacity_ledger.indices(df_candidates["LocationID"].values)
+        dest_cap = capacity_ledger.get(capacity_type, dest_indices)
+
+        # Index of the facilities that answers which facility with available capacity is the farthest within the
+        # radius (i.e. the closest to the radius), exhausted facilities are removed from it
+        facility_index = RingSearchIndex(dest_coordinates, dest_cap)
+
+        indices = np.zeros(len(df_agents), dtype = int)
+        no_facility = np.zeros(len(df_agents), dtype = bool)
+        for i, (home_coordinate, radius) in enumerate(zip(home_coordinates, radii)):
+            index = facility_index.farthest_within_distance(home_coordinate, radius)
+            if index < 0:
+                no_facility[i] = True
             else:
-                # When found facilities, remove those with no available capacity and go to the next nearest one
-                for indice_cp in l:
-                    # If found a nearest facility with available capacity, stop checking and decrease its capacity
-                    if dest_cap[indice_cp] >= 1:
-                        dest_cap[indice_cp] -= 1
-                        break
-                    else:
-                        indices_cp[i] = indices_cp[i][1:]
-                else:
-                    # If found facilities but none with available capacity, assign the nearest facility
-                    dist, ind = tree.query(np.array(home_coordinates_cp[i]).reshape(1, -1), 2,
-                                           return_distance=True, sort_results=True)
-                    fac = ind[0][1]
-                    indices_cp[i] = [fac]
-                    distances_cp[i] = [dist[0][1]]
+                # If found a facility with available capacity, decrease its capacity
+                facility_index.consume(index)
+                indices[i] = index
 
             progress.update()
 
-
-        indices_cp = [l[-1] for l in indices_cp]
-        distances_cp = [d[-1] for d in distances_cp]
-
-        df_return_cp = df_agents_cp.copy()
-        df_return_cp["x"] = dest_coordinates.iloc[indices_cp]["x"].values
-        df_return_cp["y"] = dest_coordinates.iloc[indices_cp]["y"].values
-        df_return_cp["LocationID"] = df_candidates.iloc[indices_cp]["LocationID"].values
+        if np.any(no_facility):
+            # In some cases no facility (with available capacity) was found for certain persons within the given
+            # radius, assign the second nearest facility
+            tree = KDTree(dest_coordinates)
+            nearest = tree.query(home_coordinates[no_facility], min(2, len(dest_coordinates)),
+                                 return_distance = False, sort_results = True)
+            indices[no_facility] = nearest[:, -1]
 
         # Update the available capacities of the facilities
-        if purpose == "home":
-            df_candidates["Inhabitants"] = dest_cap
-        elif purpose == "work":
-            df_candidates["WorkPlaces"] = dest_cap
-        else:
-            df_candidates["StudyPlaces"] = dest_cap
+        capacity_ledger.set(capacity_type, dest_indices, dest_cap)
 
-        df_return = df_return_cp
-        assert len(df_return) == len(df_agents)
+        df_return = df_agents
+        df_return["x"] = dest_coordinates[indices, 0]
+        df_return["y"] = dest_coordinates[indices, 1]
+        df_return["LocationID"] = df_candidates["LocationID"].values[indices]
+
+        assert len(df_return) == len(df_ag)
 
     sys.stdout.write("\r")  # Clean tqdm progress
 
-    return df_return, df_candidates
+    return df_return
 
 
 def execute(context):
@@ -322,6 +397,11 @@ def execute(context):
     # Ignore warning when working on slices of dataframes
     pd.options.mode.chained_assignment = None
 
+    random_seed = context.config("random_seed")
+    processes = context.config("processes")
+    primary_solver = context.config("primary_solver")
+    solver_reports = []
+
     # Get zones and their area coordinates
     df_zones_municipalities, df_zones_cadastral_city, \
     df_zones_zsj_city, df_zones_gates = context.stage("data.spatial.zones")
@@ -342,6 +422,9 @@ def execute(context):
     df_facilities["WorkPlaces"] = df_facilities["WorkPlaces"].astype(float)
     df_facilities["StudyPlaces"] = df_facilities["StudyPlaces"].astype(float)
 
+    # Available capacities of all facilities, reduced as persons/agents are assigned to them
+    capacity_ledger = CapacityLedger(df_facilities)
+
     # Get the attributes of the population
     df_commute = context.stage("synthesis.population.sociodemographics")[["PersonID",
                                                                           "PrimaryLocCrowFliesTripDist",
@@ -385,203 +468,174 @@ def execute(context):
                      ]].copy()
     df_hhl.rename(columns={"BasicSettlementCode": "ZoneID"}, inplace=True)
 
-    # Define home locations
-    df_home, df_home_facilities = impute_diff_zone_locations(df_hhl,
-                                                             df_zones_home,
-                                                             df_home_facilities,
-                                                             "home")
-    df_home = df_home[["PersonID", "x", "y", "LocationID"]]
-
-    # Enhance the home locations with population data
-    df_hhl = context.stage("synthesis.population.sampled")
-    df_hhl = pd.concat(df_hhl)
-    df_home = pd.merge(df_hhl, df_home, on=["PersonID"], how="left")
-    df_home = pd.merge(df_home, df_households[["PersonID"]], on=["PersonID"], how='left')
-    df_home = df_home.copy()
-    assert len(df_households) == len(df_home)
-
-    # Update the number of available inhabitants
-    df_facilities["Inhabitants"].update(df_home_facilities["Inhabitants"])
-
-    print("Imputing different zone work locations ...")
-
-    # Enhance the persons/agents who have work trips with home data
-    df_work_zones = pd.merge(df_work_zones, df_home.rename({"x": "HomeX", "y": "HomeY"}, axis=1))
-
-    # Select only persons/agents that work on a different zone than their home zone
-    df_work_different_zone = df_work_zones.copy()
-    df_work_different_zone = df_work_different_zone[df_work_different_zone["WorkID"]
-                                                    != df_work_different_zone["HomeID"]]
-    df_work_different_zone.rename(columns={"WorkID": "ZoneID"}, inplace=True)
-
-    # Filter the facilities to be assigned according to activity sector the person works and facility usage of facilities
-    for build_usage in ALL_FACILITY_USAGES:
-        print(" For facility usage", build_usage)
-        required_usages = {build_usage}
-        ids = df_work_locations["FacilityUsage"].apply(
-                lambda x: True if (type(x) == tuple and x == ("99",) or len(set(x).intersection(required_usages)))
-                                   or (type(x) != tuple and x == "99" or x in required_usages) > 0
-                else False)
-        filtered_df_work_locations = df_work_locations[ids]
-
-        required_sectors = {build_usage}
-        try:
-            # If already a single dataframe, filter facilities and avoid reassigning already assigned persons/agents
-            ids = df_work_different_zone["ActivitySector"].apply(
-                lambda x: True if (type(x) == tuple and x == ("99",) or len(set(x).intersection(required_sectors)))
-                                   or (type(x) != tuple and x == "99" or x in required_sectors) > 0
-                else False)
-            filtered_df_work_different_zone = df_work_different_zone[(ids)
-                                                                     & ~(df_work_different_zone["PersonID"].isin(df_work["PersonID"]))]
-        except NameError:
-            ids = df_work_different_zone["ActivitySector"].apply(
-                lambda x: True if (type(x) == tuple and x == ("99",) or len(set(x).intersection(required_sectors)))
-                                   or (type(x) != tuple and x == "99" or x in required_sectors) > 0
-                else False)
-            filtered_df_work_different_zone = df_work_different_zone[ids]
-
-        if len(filtered_df_work_different_zone) > 0:
-            # Define the work locations
-            df_work_diff_zone, filtered_df_work_locations = impute_diff_zone_locations(filtered_df_work_different_zone,
-                                                                                       df_zones_primary,
-                                                                                       filtered_df_work_locations,
-                                                                                       "work")
-            df_work_diff_zone = df_work_diff_zone[["PersonID", "x", "y", "LocationID"]]
-
-            # Update the available capacities of work locations
-            df_facilities["WorkPlaces"].update(filtered_df_work_locations["WorkPlaces"])
-
-            # Merge the assigned facilities for each facility usage to a single dataframe
-            try:
-                df_work = df_work.append(df_work_diff_zone, sort=False)
-            except NameError:
-                df_work = df_work_diff_zone.copy()
-
-    assert len(df_work_different_zone) == len(df_work)
-
-    print("Imputing same zone work locations ...")
-
-    df_work_same_zone = df_work_zones.copy()
-    df_work_same_zone = df_work_same_zone[df_work_same_zone["WorkID"] == df_work_same_zone["HomeID"]]
-
-    # Get both HTS data
-    all_df_hts_persons = context.stage("data.hts.cleaned")[:2]
-    all_df_hts_trips = context.stage("data.hts.cleaned")[2:]
-
-    for df_ind in range(0, len(all_df_hts_persons)):
-        print(" For HTS", df_ind)
-        df_hts_persons = all_df_hts_persons[df_ind]
-        df_hts_trips = all_df_hts_trips[df_ind]
-
-        df_hts = pd.merge(df_hts_trips, df_hts_persons, on=["PersonID"])
-        hts_trips_work = df_hts[df_hts["DestPurpose"] == '4']
-
-        # Select only trips with same zone (if CzechiaHTS town codes and if CityHTS cadastral area)
-        if df_ind == 0:
-            # If in the municipalities around Ustí city
-            hts_trips_work = hts_trips_work[(hts_trips_work["OriginTownCode"] == hts_trips_work["DestTownCode"])]
-        else:
-            # If within Ustí city
-            hts_trips_work = hts_trips_work[hts_trips_work["OriginCadastralAreaCode"]
-                                            == hts_trips_work["DestCadastralAreaCode"]]
-
-        # Filter the facilities to be assigned according to activity sector the person works and facility usage of facilities
-        for build_usage in ALL_FACILITY_USAGES:
-            print("     For facility usage", build_usage)
-
-            required_usages = {build_usage}
-            ids = df_work_locations["FacilityUsage"].apply(
-                lambda x: True if (type(x) == tuple and x == ("99",) or len(set(x).intersection(required_usages)))
-                                   or (type(x) != tuple and x == "99" or x in required_usages) > 0
-                else False)
-            filtered_df_work_locations = df_work_locations[ids]
-
-            required_sectors = {build_usage}
-            ids = df_work_same_zone["ActivitySector"].apply(
-                lambda x: True if (type(x) == tuple and x == ("99",) or len(set(x).intersection(required_sectors)))
-                                   or (type(x) != tuple and x == "99" or x in required_sectors) > 0
-                else False)
-
+    # Worker processes of the different zone assignments, created once for all purposes
+    if processes < 1:
+        processes = mp.cpu_count()
+    pool = mp.Pool(processes) if processes > 1 else None
+    try:
+        # Define home locations
+        df_home = impute_diff_zone_locations(df_hhl,
+                                             df_zones_home,
+                                             df_home_facilities,
+                                             "home",
+                                             random_seed,
+                                             capacity_ledger,
+                                             processes,
+                                             primary_solver,
+                                             solver_reports,
+                                             pool)
+        df_home = df_home[["PersonID", "x", "y", "LocationID"]]
+
+        # Enhance the home locations with population data
+        df_hhl = context.stage("synthesis.population.sampled")
+        df_hhl = pd.concat(df_hhl)
+        df_home = pd.merge(df_hhl, df_home, on=["PersonID"], how="left")
+        df_home = pd.merge(df_home, df_households[["PersonID"]], on=["PersonID"], how='left')
+        df_home = df_home.copy()
+        assert len(df_households) == len(df_home)
+
+        print("Imputing different zone work locations ...")
+
+        # Enhance the persons/agents who have work trips with home data
+        df_work_zones = pd.merge(df_work_zones, df_home.rename({"x": "HomeX", "y": "HomeY"}, axis=1))
+        df_work_zones["ActivitySectorMask"] = commonFunctions.categoryMasks(df_work_zones["ActivitySector"])
+
+        # Each person/agent is assigned once, with the first facility usage matching the activity sector the person
+        # works
+        facility_usages = sorted(ALL_FACILITY_USAGES)
+        df_work_zones["Bucket"] = commonFunctions.categoryBuckets(df_work_zones["ActivitySectorMask"].values,
+                                                                  facility_usages)
+        df_work_zones["Position"] = np.arange(len(df_work_zones))
+        work_assignment = preallocate_locations(len(df_work_zones))
+
+        # Filter the facilities to be assigned according to facility usage of facilities, once per facility usage
+        all_filtered_df_work_locations = [df_work_locations[commonFunctions.categoryFilter(
+            df_work_locations["FacilityUsageMask"].values, {build_usage})] for build_usage in facility_usages]
+
+        # Select only persons/agents that work on a different zone than their home zone
+        df_work_different_zone = df_work_zones.copy()
+        df_work_different_zone = df_work_different_zone[df_work_different_zone["WorkID"]
+                                                        != df_work_different_zone["HomeID"]]
+        df_work_different_zone.rename(columns={"WorkID": "ZoneID"}, inplace=True)
+        work_buckets = df_work_different_zone.groupby("Bucket").indices
+
+        for bucket, build_usage in enumerate(facility_usages):
+            print(" For facility usage", build_usage)
+
+            if bucket in work_buckets:
+                # Define the work locations
+                df_work_diff_zone = impute_diff_zone_locations(df_work_different_zone.iloc[work_buckets[bucket]],
+                                                               df_zones_primary,
+                                                               all_filtered_df_work_locations[bucket],
+                                                               "work",
+                                                               random_seed,
+                                                               capacity_ledger,
+                                                               processes,
+                                                               primary_solver,
+                                                               solver_reports,
+                                                               pool)
+                collect_locations(work_assignment, df_work_diff_zone)
+
+        assert len(df_work_different_zone) == np.count_nonzero(work_assignment["assigned"])
+
+        print("Imputing same zone work locations ...")
+
+        df_work_same_zone = df_work_zones.copy()
+        df_work_same_zone = df_work_same_zone[df_work_same_zone["WorkID"] == df_work_same_zone["HomeID"]]
+
+        # Get both HTS data
+        all_df_hts_persons = context.stage("data.hts.cleaned")[:2]
+        all_df_hts_trips = context.stage("data.hts.cleaned")[2:]
+
+        for df_ind in range(0, len(all_df_hts_persons)):
+            print(" For HTS", df_ind)
+            df_hts_persons = all_df_hts_persons[df_ind]
+            df_hts_trips = all_df_hts_trips[df_ind]
+
+            df_hts = pd.merge(df_hts_trips, df_hts_persons, on=["PersonID"])
+            hts_trips_work = df_hts[df_hts["DestPurpose"] == '4']
+
+            # Select only trips with same zone (if CzechiaHTS town codes and if CityHTS cadastral area)
             if df_ind == 0:
                 # If in the municipalities around Ustí city
-                filtered_df_work_same_zone = df_work_same_zone[(ids)
-                    & ~(df_work_same_zone["PersonID"].isin(df_work["PersonID"])) & (df_work_same_zone["TownCode"] != '554804')]
+                hts_trips_work = hts_trips_work[(hts_trips_work["OriginTownCode"] == hts_trips_work["DestTownCode"])]
+                hts_df_work_same_zone = df_work_same_zone[df_work_same_zone["TownCode"] != '554804']
             else:
                 # If within Ustí city
-                filtered_df_work_same_zone = df_work_same_zone[(ids)
-                    & ~(df_work_same_zone["PersonID"].isin(df_work["PersonID"])) & (df_work_same_zone["TownCode"] == '554804')]
-
-            if len(filtered_df_work_same_zone) > 0 and len(hts_trips_work) > 0:
-                # Define work locations
-                work_locations, filtered_df_work_locations = impute_primary_locations_same_zone(hts_trips_work,
-                                                                                                filtered_df_work_same_zone,
-                                                                                                filtered_df_work_locations,
-                                                                                                "work")
-                work_locations = work_locations[["PersonID", "x", "y", "LocationID"]]
-
-                # Update the available capacities of work locations
-                df_facilities["WorkPlaces"].update(filtered_df_work_locations["WorkPlaces"])
-
-                # Merge the assigned facilities for each facility usage to a single dataframe
-                df_work = df_work.append(work_locations, sort=False)
-
-    assert len(df_work_different_zone) + len(df_work_same_zone) == len(df_work)
-
-    print("Imputing different zone education locations ...")
-
-    # Enhance the persons/agents who have education trips with home data
-    df_education_zones = pd.merge(df_education_zones, df_home.rename({"x": "HomeX", "y": "HomeY"}, axis=1))
-
-    # Select only persons/agents that have a edution trip on a different zone than their home zone
-    df_education_different_zone = df_education_zones.copy()
-    df_education_different_zone = df_education_different_zone[df_education_different_zone["EducationID"]
-                                                              != df_education_different_zone["HomeID"]]
-    df_education_different_zone.rename(columns={"EducationID": "ZoneID"}, inplace=True)
-
-    # Filter the facilities to be assigned according to age the person and education place of facilities
-    for education_place in ALL_EDUCATION_PLACES:
-        print(" For education place", education_place)
-        required_type = {education_place}
-        ids = df_education_locations["EducationPlace"].apply(
-                lambda x: True if (type(x) == tuple and x == ("99",) or len(set(x).intersection(required_type)))
-                                   or (type(x) != tuple and x == "99" or x in required_type) > 0
-                else False)
-        filtered_df_education_locations = df_education_locations[ids]
-
-        try:
-            # If already a single dataframe, filter facilities and avoid reassigning already assigned persons/agents
-            ids = df_education_different_zone["EducationPlace"].apply(
-                lambda x: True if (type(x) == tuple and x == ("99",) or len(set(x).intersection(required_type)))
-                                   or (type(x) != tuple and x == "99" or x in required_type) > 0
-                else False)
-            filtered_df_education_different_zone = df_education_different_zone[(ids)
-                                                    & ~(df_education_different_zone["PersonID"].isin(df_education["PersonID"]))]
-        except NameError:
-            ids = df_education_different_zone["EducationPlace"].apply(
-                lambda x: True if (type(x) == tuple and x == ("99",) or len(set(x).intersection(required_type)))
-                                   or (type(x) != tuple and x == "99" or x in required_type) > 0
-                else False)
-            filtered_df_education_different_zone = df_education_different_zone[ids]
-
-        if len(filtered_df_education_different_zone) > 0:
-            # Define education locations
-            df_education_diff_zone, filtered_df_education_locations = impute_diff_zone_locations(
-                filtered_df_education_different_zone,
-                df_zones_primary,
-                filtered_df_education_locations,
-                "education")
-            df_education_diff_zone = df_education_diff_zone[["PersonID", "x", "y", "LocationID"]]
-
-            # Update the available capacities of study locations
-            df_facilities["StudyPlaces"].update(filtered_df_education_locations["StudyPlaces"])
-
-            # Merge the assigned facilities for each education place to a single dataframe
-            try:
-                df_education = df_education.append(df_education_diff_zone, sort=False)
-            except NameError:
-                df_education = df_education_diff_zone.copy()
-
-    assert len(df_education_different_zone) == len(df_education)
+                hts_trips_work = hts_trips_work[hts_trips_work["OriginCadastralAreaCode"]
+                                                == hts_trips_work["DestCadastralAreaCode"]]
+                hts_df_work_same_zone = df_work_same_zone[df_work_same_zone["TownCode"] == '554804']
+
+            # Distribution of the radius of same zone work trips, sampled for every facility usage
+            if len(hts_trips_work) > 0:
+                work_radius_sampler = radius_sampler(hts_trips_work)
+            work_buckets = hts_df_work_same_zone.groupby("Bucket").indices
+
+            for bucket, build_usage in enumerate(facility_usages):
+                print("     For facility usage", build_usage)
+
+                if bucket in work_buckets and len(hts_trips_work) > 0:
+                    # Define work locations
+                    work_locations = impute_primary_locations_same_zone(
+                        work_radius_sampler,
+                        hts_df_work_same_zone.iloc[work_buckets[bucket]],
+                        all_filtered_df_work_locations[bucket],
+                        "work",
+                        capacity_ledger)
+                    collect_locations(work_assignment, work_locations)
+
+        df_work = assigned_locations(df_work_zones, work_assignment)
+
+        assert len(df_work_different_zone) + len(df_work_same_zone) == len(df_work)
+
+        print("Imputing different zone education locations ...")
+
+        # Enhance the persons/agents who have education trips with home data
+        df_education_zones = pd.merge(df_education_zones, df_home.rename({"x": "HomeX", "y": "HomeY"}, axis=1))
+        df_education_zones["EducationPlaceMask"] = commonFunctions.categoryMasks(df_education_zones["EducationPlace"])
+
+        # Each person/agent is assigned once, with the first education place matching the one of the person
+        education_places = sorted(ALL_EDUCATION_PLACES)
+        df_education_zones["Bucket"] = commonFunctions.categoryBuckets(df_education_zones["EducationPlaceMask"].values,
+                                                                       education_places)
+        df_education_zones["Position"] = np.arange(len(df_education_zones))
+        education_assignment = preallocate_locations(len(df_education_zones))
+
+        # Filter the facilities to be assigned according to education place of facilities, once per education place
+        all_filtered_df_education_locations = [df_education_locations[commonFunctions.categoryFilter(
+            df_education_locations["EducationPlaceMask"].values, {education_place})]
+            for education_place in education_places]
+
+        # Select only persons/agents that have a edution trip on a different zone than their home zone
+        df_education_different_zone = df_education_zones.copy()
+        df_education_different_zone = df_education_different_zone[df_education_different_zone["EducationID"]
+                                                                  != df_education_different_zone["HomeID"]]
+        df_education_different_zone.rename(columns={"EducationID": "ZoneID"}, inplace=True)
+        education_buckets = df_education_different_zone.groupby("Bucket").indices
+
+        for bucket, education_place in enumerate(education_places):
+            print(" For education place", education_place)
+
+            if bucket in education_buckets:
+                # Define education locations
+                df_education_diff_zone = impute_diff_zone_locations(
+                    df_education_different_zone.iloc[education_buckets[bucket]],
+                    df_zones_primary,
+                    all_filtered_df_education_locations[bucket],
+                    "education",
+                    random_seed,
+                    capacity_ledger,
+                    processes,
+                    primary_solver,
+                    solver_reports,
+                    pool)
+                collect_locations(education_assignment, df_education_diff_zone)
+
+        assert len(df_education_different_zone) == np.count_nonzero(education_assignment["assigned"])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     print("Imputing same zone education locations ...")
 
@@ -606,55 +660,32 @@ def execute(context):
             # If in the municipalities around Ustí city
             hts_trips_education = hts_trips_education[hts_trips_education["OriginTownCode"]
                                                       == hts_trips_education["DestTownCode"]]
+            hts_df_education_same_zone = df_education_same_zone[df_education_same_zone["TownCode"] != '554804']
         else:
             # If within Ustí city
             hts_trips_education = hts_trips_education[hts_trips_education["OriginCadastralAreaCode"]
                                                       == hts_trips_education["DestCadastralAreaCode"]]
+            hts_df_education_same_zone = df_education_same_zone[df_education_same_zone["TownCode"] == '554804']
 
-        # Filter the facilities to be assigned according to age the person and education place of facilities
-        for education_place in ALL_EDUCATION_PLACES:
-            print("     For school type", education_place)
-
-            required_type = {education_place}
-            ids = df_education_locations["EducationPlace"].apply(
-                lambda x: True if (type(x) == tuple and x == ("99",) or len(set(x).intersection(required_type)))
-                                   or (type(x) != tuple and x == "99" or x in required_type) > 0
-                else False)
-            filtered_df_education_locations = df_education_locations[ids]
-
-            ids = df_education_same_zone["EducationPlace"].apply(
-                lambda x: True if (type(x) == tuple and x == ("99",) or len(set(x).intersection(required_type)))
-                                   or (type(x) != tuple and x == "99" or x in required_type) > 0
-                else False)
+        # Distribution of the radius of same zone education trips, sampled for every education place
+        if len(hts_trips_education) > 0:
+            education_radius_sampler = radius_sampler(hts_trips_education)
+        education_buckets = hts_df_education_same_zone.groupby("Bucket").indices
 
-            if df_ind == 0:
-                # If in the municipalities around Ustí city
-                filtered_df_education_same_zone = df_education_same_zone[(ids)
-                                                                    & ~(
-                    df_education_same_zone["PersonID"].isin(df_education["PersonID"])) & (
-                                                                            df_education_same_zone[
-                                                                                "TownCode"] != '554804')]
-            else:
-                # If within Ustí city
-                filtered_df_education_same_zone = df_education_same_zone[(ids)
-                                                                    & ~(
-                    df_education_same_zone["PersonID"].isin(df_education["PersonID"])) & (
-                                                                            df_education_same_zone[
-                                                                                "TownCode"] == '554804')]
+        for bucket, education_place in enumerate(education_places):
+            print("     For school type", education_place)
 
-            if len(filtered_df_education_same_zone) > 0 and len(hts_trips_education) > 0:
+            if bucket in education_buckets and len(hts_trips_education) > 0:
                 # Define education locations
-                education_locations, filtered_df_education_locations = impute_primary_locations_same_zone(
-                    hts_trips_education,
-                    filtered_df_education_same_zone,
-                    filtered_df_education_locations,
-                    # df_trips,
-                    "education")
-                education_locations = education_locations[["PersonID", "x", "y", "LocationID"]]
-                df_facilities["StudyPlaces"].update(filtered_df_education_locations["StudyPlaces"])
-
-                # Merge the assigned facilities for each education place to a single dataframe
-                df_education = df_education.append(education_locations, sort=False)
+                education_locations = impute_primary_locations_same_zone(
+                    education_radius_sampler,
+                    hts_df_education_same_zone.iloc[education_buckets[bucket]],
+                    all_filtered_df_education_locations[bucket],
+                    "education",
+                    capacity_ledger)
+                collect_locations(education_assignment, education_locations)
+
+    df_education = assigned_locations(df_education_zones, education_assignment)
 
     assert len(df_education_different_zone) + len(df_education_same_zone) == len(df_education)
 
@@ -693,6 +724,12 @@ def execute(context):
     commonFunctions.toXML(df_education, "%s/Locations/locations_edu.xml" % context.config("output_path"))
     df_education.to_file("%s/Locations/locations_edu.gpkg" % context.config("output_path"), driver = "GPKG")
 
+    if len(solver_reports) > 0:
+        # Optimality gap and runtime per zone of the optimal transport solver
+        df_reports = pd.DataFrame(solver_reports)[["ZoneID", "Purpose", "Persons", "Facilities", "cost", "bound",
+                                                   "gap", "relative_gap", "overflow", "bids", "runtime"]]
+        df_reports.to_csv("%s/Locations/convergence_primary.csv" % context.config("output_path"), index=False)
+
     print("Saved primary locations")
 
     return df_home, df_work, df_education
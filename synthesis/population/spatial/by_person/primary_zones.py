@@ -1,4 +1,3 @@
-from tqdm import tqdm
 import pandas as pd
 import numpy as np
 
@@ -6,20 +5,57 @@ def configure(context):
     context.stage("data.od.cleaned")
     context.stage("synthesis.population.sociodemographics")
     context.stage("synthesis.population.trips")
+    context.config("random_seed")
 
 def validate(context):
 
     pass
 
+def sample_destination_zones(od_matrix, origin_ids, seed):
+    """Sample a destination zone for each origin zone ID with the weights of a sparse OD matrix (see odMatrix)
+
+    Origins are grouped once and the destinations of each origin are drawn in a single search over the cumulative
+    weights of its row. The draws of each origin come from its own generator, seeded by seed and the origin zone
+    index, so the zones sampled from an origin do not depend on the other origins."""
+
+    indptr = od_matrix["indptr"]
+
+    origin_ids = np.asarray(origin_ids).astype(str)
+    origins = pd.Series(origin_ids).map(od_matrix["zone_index"])
+    if origins.isna().any():
+        raise RuntimeError("No OD proportions for origin zones: %s" % set(origin_ids[origins.isna().values]))
+    origins = origins.values.astype(int)
+    if np.any(indptr[origins + 1] == indptr[origins]):
+        raise RuntimeError("No OD proportions for origin zones: %s"
+                           % set(origin_ids[indptr[origins + 1] == indptr[origins]]))
+
+    # Uniform draws grouped by origin, from the generator of each origin, searched within the row of the origin (its
+    # last cumulative weight is exactly 1, so every draw falls inside the row)
+    order = np.argsort(origins, kind="mergesort")
+    sorted_origins = origins[order]
+    unique_origins, starts, counts = np.unique(sorted_origins, return_index=True, return_counts=True)
+    entries = np.empty(len(origins), dtype=int)
+    for origin, start, count in zip(unique_origins, starts, counts):
+        draws = np.random.RandomState(list(seed) + [origin]).random_sample(count)
+        row_weights = od_matrix["cum_weights"][indptr[origin]:indptr[origin + 1]]
+        entries[start:start + count] = indptr[origin] + np.searchsorted(row_weights, draws, side="right")
+
+    dest_ids = np.empty(len(origins), dtype=object)
+    dest_ids[order] = od_matrix["zone_ids"][od_matrix["dest_indices"][entries]]
+
+    return dest_ids
+
 def execute(context):
 
     print("Prepare the primary zones of the population")
 
+    random_seed = context.config("random_seed")
+
     # Get population sociodemographics
     df_persons = pd.DataFrame(context.stage("synthesis.population.sociodemographics"), copy=True)
 
-    # Get OD proportions
-    df_work_od, df_education_od = context.stage("data.od.cleaned")
+    # Get OD proportions (sparse OD matrices)
+    od_work, od_education = context.stage("data.od.cleaned")[2:]
 
     df_persons = df_persons[["PersonID",
                              "ZoneID",
@@ -41,45 +77,14 @@ def execute(context):
                           ]]
 
     # Define the persons/agents' work zone given zones weight (from OD proportion as origin point of the trip)
-    df_work = []
-
-    for origin_id in tqdm(np.unique(df_persons["ZoneID"]), desc = "Sampling work zones", ascii=True):
-        f = (df_persons["ZoneID"] == origin_id) & df_persons["HasWorkTrip"]
-        df_origin = pd.DataFrame(df_persons[f][["PersonID", "ActivitySector"]], copy = True)
-        df_destination = df_work_od[df_work_od["OriginID"] == origin_id]
-
-        if len(df_origin) > 0:
-            counts = np.random.multinomial(len(df_origin), df_destination["Weight"].values)
-            indices = np.repeat(np.arange(len(df_destination)), counts)
-            df_origin["ZoneID"] = df_destination.iloc[indices]["DestID"].values
-            df_work.append(df_origin[["PersonID", "ZoneID", "ActivitySector",
-                                      ]])
-
-    # Merge each zone dataframe into one dataframe
-    try:
-        df_work = pd.concat(df_work)
-    except ValueError:
-        df_work = pd.DataFrame(columns=["PersonID", "ZoneID", "ActivitySector"])
-
-    # Define the persons/agents' work zone given zones weight (from OD proportion as origin point of the trip)
-    df_education = []
-
-    for origin_id in tqdm(np.unique(df_persons["ZoneID"]), desc = "Sampling education zones", ascii=True):
-        f = (df_persons["ZoneID"] == origin_id) & df_persons["HasEducationTrip"]
-        df_origin = pd.DataFrame(df_persons[f][["PersonID", "AgeGroup"]], copy = True)
-        df_destination = df_education_od[df_education_od["OriginID"] == origin_id]
-
-        if len(df_origin) > 0:
-            counts = np.random.multinomial(len(df_origin), df_destination["Weight"].values)
-            indices = np.repeat(np.arange(len(df_destination)), counts)
-            df_origin.loc[:, "ZoneID"] = df_destination.iloc[indices]["DestID"].values
-            df_education.append(df_origin[["PersonID", "ZoneID", "AgeGroup"]])
-
-    # Merge each zone dataframe into one dataframe
-    try:
-        df_education = pd.concat(df_education)
-    except ValueError:
-        df_education = pd.DataFrame(columns=["PersonID", "ZoneID", "AgeGroup"])
+    print("Sampling work zones")
+    df_work = df_persons.loc[df_persons["HasWorkTrip"], ["PersonID", "ZoneID", "ActivitySector"]].copy()
+    df_work["ZoneID"] = sample_destination_zones(od_work, df_work["ZoneID"].values, (random_seed, 0))
+
+    # Define the persons/agents' education zone given zones weight (from OD proportion as origin point of the trip)
+    print("Sampling education zones")
+    df_education = df_persons.loc[df_persons["HasEducationTrip"], ["PersonID", "ZoneID", "AgeGroup"]].copy()
+    df_education["ZoneID"] = sample_destination_zones(od_education, df_education["ZoneID"].values, (random_seed, 1))
 
     len_home = len(df_home)
     len_work = len(df_persons.loc[df_persons["HasWorkTrip"]])
@@ -10,50 +10,157 @@ class CustomDistanceSampler(rda.FeasibleDistanceSampler):
         self.distributions = distributions
 
     def sample_distances(self, problem):
-        distances = np.zeros((problem["size"] + 1))
+        return self.sample_distances_block(problem, 1)[0]
 
-        for index, (mode, travel_time) in enumerate(zip(problem["modes"], problem["travel_times"])):
-            mode_distribution = self.distributions[mode]
+    def sample_distances_block(self, problem, count):
+        distances = np.zeros((count, problem["size"] + 1))
+        number_of_trips = len(problem["modes"])
 
-            bound_index = np.count_nonzero(travel_time > mode_distribution["bounds"])
-            mode_distribution = mode_distribution["distributions"][bound_index]
+        # Quantile table (row of the tables) of the band of the travel time of each trip
+        rows = np.zeros(number_of_trips, dtype = int)
+        for index, (mode, travel_time) in enumerate(zip(problem["modes"], problem["travel_times"])):
+            mode_index = self.distributions["modes"][mode]
+            start, end = self.distributions["band_starts"][mode_index:mode_index + 2]
+            rows[index] = start + np.count_nonzero(travel_time > self.distributions["bounds"][start:end])
 
-            distances[index] = mode_distribution["values"][
-                np.count_nonzero(self.random.random_sample() > mode_distribution["cdf"])
-            ]
+        # Each sample picks a uniform random quantile of the table of its trip
+        quantiles = (self.random.random_sample((count, number_of_trips)) * self.distributions["tables"].shape[1]).astype(int)
+        distances[:, :number_of_trips] = self.distributions["tables"][rows, quantiles]
 
         return distances
 
 class CustomDiscretizationSolver(rda.DiscretizationSolver):
-    def __init__(self, data):
+    def __init__(self, data, rebuild_fraction = 0.5):
 
-        # Initialize available locations with capacity of at least one visitor
+        # Initialize available locations with capacity of at least one visitor (positions in data never change,
+        # exhausted locations are only marked as removed)
         self.data = data
-        self.indices = sklearn.neighbors.KDTree(self.data["locations"])
+        self.rebuild_fraction = rebuild_fraction
+        self.locations = np.asarray(self.data["locations"], dtype = float).reshape(-1, 2)
+        self.removed = np.zeros(len(self.locations), dtype = bool)
+        self.positions = {facility_index: index for index, facility_index in enumerate(self.data["facility_indices"])}
+
+        # Locations offering each purpose, other purposes (None) can go to any location
+        self.masks = {purpose: np.asarray(mask, dtype = bool) for purpose, mask in self.data.get("offers", dict()).items()}
+        self.masks[None] = np.ones(len(self.locations), dtype = bool)
+
+        self.indices = dict()
+        for purpose in self.masks.keys():
+            self.build(purpose)
+
+        # Number of indices rebuilt since initialized
+        self.rebuilds = 0
+
+    def build(self, purpose):
+
+        # Index the locations not removed offering the purpose, as [positions in data, KDTree, number removed since]
+        positions = np.flatnonzero(self.masks[purpose] & ~self.removed)
+        tree = sklearn.neighbors.KDTree(self.locations[positions]) if len(positions) > 0 else None
+        self.indices[purpose] = [positions, tree, 0]
+
+    def size(self, purpose = None):
+
+        # Number of locations not removed offering the purpose
+        positions, _, number_removed = self.indices[purpose]
+        return len(positions) - number_removed
 
     def update(self, location_index):
-        
-        # Remove index from the discretization solver
-        del self.data["identifiers"][location_index]
-        del self.data["locations"][location_index]
-        del self.data["capacities"][location_index]
-        self.indices = sklearn.neighbors.KDTree(self.data["locations"])
+
+        # Mark the location as removed (tombstone), the index of a purpose is only rebuilt once a fraction of its
+        # locations is removed, so that removing a location costs amortized logarithmic time
+        self.removed[location_index] = True
+
+        for purpose, mask in self.masks.items():
+            if mask[location_index]:
+                self.indices[purpose][2] += 1
+                if self.indices[purpose][2] > self.rebuild_fraction * len(self.indices[purpose][0]):
+                    self.build(purpose)
+                    self.rebuilds += 1
+
+    def query(self, locations, purpose = None):
+
+        # Indices of the closest locations (not removed) offering the purpose, for all locations in one call,
+        # querying more neighbours for those whose closest ones are removed
+        if purpose not in self.masks or self.size(purpose) == 0:
+            purpose = None
+        if self.size(purpose) == 0:
+            raise RuntimeError("No location with available visitors left")
+        positions, tree, _ = self.indices[purpose]
+
+        locations = np.asarray(locations, dtype = float).reshape(-1, 2)
+        indices = np.zeros(len(locations), dtype = int)
+        pending = np.arange(len(locations))
+
+        k = min(8, len(positions))
+        while len(pending) > 0:
+            neighbours = positions[tree.query(locations[pending], k = k, return_distance = False)]
+            live = ~self.removed[neighbours]
+            found = np.any(live, axis = 1)
+            first = np.argmax(live, axis = 1)
+
+            indices[pending[found]] = neighbours[found, first[found]]
+            pending = pending[~found]
+            k = min(4 * k, len(positions))
+
+        return indices
+
+    def consume(self, facility_index, amount = 1):
+
+        # Reduce the available visitors of the facility (index in the capacity ledger) and remove it once exhausted,
+        # unless already removed
+        remaining = self.data["capacity_ledger"].decrement("Visitors", facility_index, amount)
+        if remaining < 1 and remaining + amount >= 1:
+            self.update(self.positions[facility_index])
     
+    def release(self, facility_index, amount = 1):
+
+        # Give back available visitors to the facility (e.g. when solving a problem again) and add it back once
+        # available again, into the indices still holding it as removed or by rebuilding the other ones
+        remaining = self.data["capacity_ledger"].decrement("Visitors", facility_index, -amount)
+        if remaining >= 1 and remaining - amount < 1:
+            location_index = self.positions[facility_index]
+            self.removed[location_index] = False
+
+            for purpose, mask in self.masks.items():
+                if mask[location_index]:
+                    positions = self.indices[purpose][0]
+                    position = np.searchsorted(positions, location_index)
+                    if position < len(positions) and positions[position] == location_index:
+                        self.indices[purpose][2] -= 1
+                    else:
+                        self.build(purpose)
+                        self.rebuilds += 1
+
+    def exhausted(self, facility_indices):
+
+        # Whether any of the facilities (indices in the capacity ledger) has no available visitors anymore
+        return any(self.data["capacity_ledger"].get("Visitors", facility_index) < 1
+                   for facility_index in facility_indices)
+
     def solve(self, problem, locations):
-        discretized_locations = []
-        discretized_identifiers = []
-        discretized_indices = []
-
-        for location, purpose in zip(locations, problem["purposes"]):
-            index = self.indices.query(location.reshape(1, -1), return_distance = False)[0][0]
-
-            discretized_identifiers.append(self.data["identifiers"][index])
-            discretized_locations.append(self.data["locations"][index])
-            discretized_indices.append(index)
-
-        return dict(
-            valid = True,
-            locations = np.vstack(discretized_locations),
-            identifiers = discretized_identifiers,
-            indices = discretized_indices
-        )
+        return self.solve_batch([problem], [locations])[0]
+
+    def solve_batch(self, problems, all_locations):
+
+        # Locations of all problems are discretized together, with one query per purpose
+        sizes = [len(locations) for locations in all_locations]
+        locations = np.vstack(all_locations).reshape(-1, 2)
+        purposes = np.asarray([purpose for problem, size in zip(problems, sizes)
+                               for purpose in problem["purposes"][:size]], dtype = object)
+
+        indices = np.zeros(len(locations), dtype = int)
+        for purpose in set(purposes.tolist()):
+            f = purposes == purpose
+            indices[f] = self.query(locations[f], purpose)
+
+        results = []
+        for problem_indices in np.split(indices, np.cumsum(sizes)[:-1]):
+            results.append(dict(
+                valid = True,
+                locations = self.locations[problem_indices],
+                identifiers = [self.data["identifiers"][index] for index in problem_indices],
+                indices = problem_indices.tolist(),
+                facility_indices = [self.data["facility_indices"][index] for index in problem_indices]
+            ))
+
+        return results
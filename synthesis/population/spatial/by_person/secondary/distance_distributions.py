@@ -2,6 +2,21 @@ import numpy as np
 import pandas as pd
 
 BIN_SIZE = 20
+QUANTILES = 1024 # Resolution of the quantile tables (inverse CDFs) of the distributions
+
+# Resampling of the CrowFliesTripDist distribution per trip mode based on intervals of DeclaredTripTime
+# for adjustments when results not conforming (not at the moment)
+RESAMPLING_FACTORS = {
+    "1": 0.0,  # on foot
+    "2": 0.0,  # bike
+    "3": 0.0,  # city public transport
+    "4": 0.0,  # bus (except city public transport)
+    "5": 0.0,  # train (except city public transport)
+    "6": 0.0,  # auto-driver
+    "7": 0.0,  # auto-passenger
+    "8": 0.0,  # other
+    "999": 0.0  # Not identified
+}
 
 def configure(context):
     context.stage("data.hts.cleaned")
@@ -13,24 +28,37 @@ def validate(context):
 def calculate_bounds(values, BIN_SIZE):
     values = np.sort(values)
 
+    # Every bound closes a bin of BIN_SIZE values after the previous bound (values equal to a bound being skipped)
     bounds = []
-    current_count = 0
-    previous_bound = None
+    position = BIN_SIZE
 
-    for value in values:
-        if value == previous_bound:
-            continue
+    while position < len(values):
+        bounds.append(values[position])
 
-        if current_count < BIN_SIZE:
-            current_count += 1
+        if np.isnan(values[position]):
+            position += 1 + BIN_SIZE
         else:
-            current_count = 0
-            bounds.append(value)
-            previous_bound = value
+            position = np.searchsorted(values, values[position], side = "right") + BIN_SIZE
 
     bounds[-1] = np.inf
     return bounds
 
+def resample_cdf(cdf, factor):
+    if factor >= 0.0:
+        cdf = cdf * (1.0 + factor * np.arange(1, len(cdf) + 1) / len(cdf))
+    else:
+        cdf = cdf * (1.0 + abs(factor) - abs(factor) * np.arange(1, len(cdf) + 1) / len(cdf))
+
+    cdf /= cdf[-1]
+    return cdf
+
+def quantile_table(values, cdf):
+    """Values at QUANTILES evenly spaced cumulative probabilities (at the middle of each quantile), so that sampling
+    the distribution is taking the value of a uniform random index"""
+
+    quantiles = (np.arange(QUANTILES) + 0.5) / QUANTILES
+    return values[np.minimum(np.searchsorted(cdf, quantiles), len(values) - 1)]
+
 def execute(context):
 
     df_persons_CzechiaHTS, df_persons_CityHTS, df_trips_CzechiaHTS, df_trips_CityHTS = context.stage("data.hts.cleaned")
@@ -43,9 +71,9 @@ def execute(context):
 
     print("Defining distributions of CrowFliesTripDist for DeclaredTripTime intervals per trip mode")
 
-    # Define distributions of DeclaredTripTime per trip mode
+    # Define distributions of DeclaredTripTime per trip mode, as quantile tables of all bands of all modes in a single
+    # array (bands of mode m being rows band_starts[m]:band_starts[m + 1], with upper bounds in bounds)
     for (df_persons, df_trips) in [[df_persons_CzechiaHTS, df_trips_CzechiaHTS], [df_persons_CityHTS, df_trips_CityHTS]]:
-        distributions.append({})
         df_trips = pd.merge(df_trips, df_persons[["PersonID", "Weight"]])
         df = df_trips[["TripMainMode", "DeclaredTripTime", distance_column,
                        "Weight", "OriginPurpose", "DestPurpose"]].rename(columns={distance_column: "distance"})
@@ -59,6 +87,11 @@ def execute(context):
         # Calculate distributions of primary activities per trip mode
         modes = df["TripMainMode"].unique()
 
+        mode_indices = dict()
+        all_bounds = []
+        band_starts = [0]
+        tables = []
+
         for mode in modes:
             # First, calculate bounds by unique values
             f_mode = df["TripMainMode"] == mode
@@ -67,8 +100,6 @@ def execute(context):
             bounds = calculate_bounds(df[f_mode]["DeclaredTripTime"].values,
                                       min(BIN_SIZE, len(df[f_mode]["DeclaredTripTime"].values) - 1))
 
-            distributions[-1][mode] = dict(bounds = np.array(bounds), distributions = [])
-
             # Second, calculate distribution per band
             for lower_bound, upper_bound in zip([-np.inf] + bounds[:-1], bounds):
                 f_bound = (df["DeclaredTripTime"] > lower_bound) & (df["DeclaredTripTime"] <= upper_bound)
@@ -83,8 +114,20 @@ def execute(context):
 
                 cdf = np.cumsum(weights)
                 cdf /= cdf[-1]
+                cdf = resample_cdf(cdf, RESAMPLING_FACTORS[mode])
 
                 # Write distribution
-                distributions[-1][mode]["distributions"].append(dict(cdf = cdf, values = values, weights = weights))
+                tables.append(quantile_table(values, cdf))
+
+            mode_indices[mode] = len(mode_indices)
+            all_bounds.extend(bounds)
+            band_starts.append(len(all_bounds))
+
+        distributions.append(dict(
+            modes = mode_indices,
+            bounds = np.array(all_bounds),
+            band_starts = np.array(band_starts),
+            tables = np.vstack(tables)
+        ))
 
     return distributions
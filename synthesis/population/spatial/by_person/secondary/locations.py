@@ -2,14 +2,27 @@ import numpy as np
 import pandas as pd
 import os
 import sys
+import copy
+import time
+import multiprocessing as mp
 import shapely.geometry as geo
 import geopandas as gpd
 from tqdm import tqdm
-from synthesis.population.spatial.by_person.secondary.problems import find_assignment_problems
-from synthesis.population.spatial.by_person.secondary.rda import AssignmentSolver, DiscretizationErrorObjective, GravityChainSolver
+from synthesis.population.spatial.by_person.secondary.problems import find_assignment_problem_arrays, find_assignment_problem_batches, \
+    assignment_problem
+from synthesis.population.spatial.by_person.secondary.rda import AssignmentSolver, DiscretizationErrorObjective, GravityChainSolver, TELEMETRY_FIELDS
 from synthesis.population.spatial.by_person.secondary.components import CustomDistanceSampler, CustomDiscretizationSolver
+from synthesis.population.algo.capacity_ledger import CapacityLedger
 from data import commonFunctions
 
+# Define globals
+ITERATION_BINS = [0, 1, 2, 5, 10, 20, 100, 1000, 10000, np.inf] # Bins of the histograms of iterations per chain
+PURPOSE_OFFERS = {"2": "offers_freetime", # free time
+                  "3": "offers_shopping", # shopping
+                  "6": "offers_errands"} # errands
+PARTITIONS = 8 # Partitions of persons (by zone of residence) assigned independently, fixed so that the results do not
+               # depend on the number of processes
+
 def configure(context):
     context.stage("synthesis.population.trips")
     context.stage("synthesis.population.sociodemographics")
@@ -19,6 +32,9 @@ def configure(context):
     context.stage("synthesis.destinations")
     context.config("random_seed")
     context.config("output_path")
+    context.config("processes")
+    context.config("secondary_time_budget")
+    context.config("secondary_chain_time_budget")
 
 def validate(context):
     output_path = context.config("output_path")
@@ -45,6 +61,7 @@ def prepare_locations(context):
     for df_persons in all_df_persons:
         df_persons = df_persons[["PersonID",
                                  # "HouseholdID" # not at the moment
+                                 "BasicSettlementCode"
                                  ]]
         df_locations = pd.merge(df_home, df_persons, how = "right", on = ["PersonID",
                                                                          # "HouseholdID" # not at the moment
@@ -54,7 +71,8 @@ def prepare_locations(context):
         df_locations = df_locations[["PersonID",
                                      "1",  # home
                                      "4",  # work
-                                     "5"]  # education
+                                     "5",  # education
+                                     "BasicSettlementCode"]  # zone of residence
         ].sort_values(by="PersonID").copy()
         all_df_locations.append(df_locations)
 
@@ -64,8 +82,9 @@ def prepare_destinations(context):
 
     df_destinations = context.stage("synthesis.destinations")
     identifiers = df_destinations["LocationID"].values
-    locations = np.vstack(df_destinations["geometry"].centroid.apply(lambda x: np.array([x.x, x.y])).values)
-    capacities = df_destinations["Visitors"].values.astype(float)
+    locations = np.column_stack([df_destinations["x"].values, df_destinations["y"].values])
+    # Available visitors of all facilities, reduced as persons/agents are assigned to them
+    capacity_ledger = CapacityLedger(df_destinations, ("Visitors",))
 
     df_destinations = df_destinations.drop(["FacilityPurpose"], axis=1)
 
@@ -76,35 +95,133 @@ def prepare_destinations(context):
     data = dict(
         identifiers=identifiers[f].tolist(),
         locations=locations[f].tolist(),
-        capacities=capacities[f].tolist()
+        facility_indices=np.flatnonzero(f.values).tolist(),
+        capacity_ledger=capacity_ledger,
+        # Locations offering each secondary purpose
+        offers={purpose: (df_destinations[offers] == True).values[f.values] for purpose, offers in PURPOSE_OFFERS.items()}
     )
 
     return data
 
-def resample_cdf(cdf, factor):
-    if factor >= 0.0:
-        cdf = cdf * (1.0 + factor * np.arange(1, len(cdf) + 1) / len(cdf))
-    else:
-        cdf = cdf * (1.0 + abs(factor) - abs(factor) * np.arange(1, len(cdf) + 1) / len(cdf))
+def subset_destinations(destinations, f, capacity_ledger):
+    """Destinations selected by the mask f (over the locations of destinations), with the given capacity ledger"""
+
+    return dict(
+        identifiers=np.asarray(destinations["identifiers"], dtype=object)[f].tolist(),
+        locations=np.asarray(destinations["locations"], dtype=float).reshape(-1, 2)[f].tolist(),
+        facility_indices=np.asarray(destinations["facility_indices"], dtype=int)[f].tolist(),
+        capacity_ledger=capacity_ledger,
+        offers={purpose: mask[f] for purpose, mask in destinations["offers"].items()}
+    )
+
+def partition_persons(df_primary, number_of_partitions):
+    """Partition of each person by zone of residence, spreading the zones (largest first) over the partitions so that
+    they have a similar number of persons"""
+
+    zones = df_primary["BasicSettlementCode"].fillna("").astype(str)
+    zone_counts = zones.value_counts()
+    zone_counts = zone_counts.iloc[np.lexsort((zone_counts.index.values, -zone_counts.values))]
+
+    loads = np.zeros(number_of_partitions)
+    zone_partitions = dict()
+    for zone, count in zone_counts.items():
+        partition = np.argmin(loads)
+        zone_partitions[zone] = partition
+        loads[partition] += count
+
+    return zones.map(zone_partitions).values.astype(int)
+
+def partition_destinations(destinations, shares):
+    """Destinations of each partition, owning a quota of the available visitors proportional to its share of trips
+    (the remaining visitors of each facility going to the partitions in turn), so that partitions never compete for
+    the same visitors. Returns the destinations and quotas of each partition"""
+
+    capacity_ledger = destinations["capacity_ledger"]
+    facility_indices = np.asarray(destinations["facility_indices"], dtype=int)
+    number_of_partitions = len(shares)
+
+    visitors = np.floor(np.maximum(capacity_ledger.get("Visitors", facility_indices), 0))
+    quotas = np.floor(np.outer(shares, visitors))
+    remainders = visitors - quotas.sum(axis=0)
+    turns = (np.arange(number_of_partitions)[:, None] + np.arange(len(facility_indices))[None, :]) % number_of_partitions
+    quotas += turns < remainders
+
+    all_destinations = []
+    for quota in quotas:
+        # Each partition has its own ledger, only with its quota of visitors
+        partition_ledger = copy.deepcopy(capacity_ledger)
+        partition_ledger.set("Visitors", slice(None), 0.0)
+        partition_ledger.set("Visitors", facility_indices, quota)
+
+        all_destinations.append(subset_destinations(destinations, quota >= 1, partition_ledger))
+
+    return all_destinations, quotas
+
+def reconcile_destinations(df_locations, destinations, excess):
+    """Move the visits in excess of the available visitors of overdrawn facilities (visited more than available, e.g.
+    repeated in the chain of a person) to the closest facility with available visitors, the last visits being moved"""
+
+    capacity_ledger = destinations["capacity_ledger"]
+    facility_indices = np.asarray(destinations["facility_indices"], dtype=int)
+    available = capacity_ledger.get("Visitors", facility_indices) >= 1
+    overdrawn = np.flatnonzero(excess > 0)
+
+    if len(overdrawn) == 0 or not np.any(available):
+        return 0
+
+    discretization_solver = CustomDiscretizationSolver(subset_destinations(destinations, available, capacity_ledger))
+
+    location_ids = df_locations["LocationID"].values
+    number_of_moves = 0
+    for position in overdrawn:
+        rows = np.flatnonzero(location_ids == destinations["identifiers"][position])[-int(excess[position]):]
+
+        for row in rows:
+            point = df_locations.at[row, "geometry"]
+            result = discretization_solver.solve(dict(purposes=[df_locations.at[row, "DestPurpose"]]),
+                                                 np.array([[point.x, point.y]]))
+            df_locations.at[row, "LocationID"] = result["identifiers"][0]
+            df_locations.at[row, "geometry"] = geo.Point(result["locations"][0])
+
+            # The visit is given back to the overdrawn facility and taken from the new one
+            capacity_ledger.decrement("Visitors", facility_indices[position], -1)
+            discretization_solver.consume(result["facility_indices"][0])
+            number_of_moves += 1
+
+            if discretization_solver.size() == 0:
+                return number_of_moves
+
+    return number_of_moves
+
+def chain_deadline(deadline, chain_budget):
+    """Deadline of solving a single chain, chain_budget seconds from now within the overall deadline (None if none)"""
 
-    cdf /= cdf[-1]
-    return cdf
+    if chain_budget is None:
+        return deadline
 
-def resample_distributions(distributions, factors):
-    for mode, mode_distributions in distributions.items():
-        for distribution in mode_distributions["distributions"]:
-            distribution["cdf"] = resample_cdf(distribution["cdf"], factors[mode])
+    return min(time.perf_counter() + chain_budget, np.inf if deadline is None else deadline)
 
-def process(context, destinations, distance_distributions, arguments):
+def write_result(output, row_starts, index, result):
+    """Write the result of a problem into the output arrays"""
 
-    df_trips, df_primary, number_of_persons, random_seed = arguments
+    rows = slice(row_starts[index], row_starts[index + 1])
+    output["location_ids"][rows] = result["discretization"]["identifiers"]
+    output["coordinates"][rows] = result["discretization"]["locations"]
+    output["valid"][index] = result["valid"]
+    output["objectives"][index] = result["objective"]
+    output["facility_indices"][index] = result["discretization"]["facility_indices"]
+
+def process(arguments):
+
+    destinations, distance_distributions, df_trips, df_primary, number_of_persons, random_seed, \
+        time_budget, chain_time_budget, show_progress = arguments
 
     with tqdm(total=number_of_persons, desc="Assigning secondary locations to persons", ascii=True,
-              leave=False, miniters=1, position=0) as progress:
+              leave=False, miniters=1, position=0, disable=not show_progress) as progress:
 
         progress.set_description("Assigning secondary locations to persons")
-        # Set up RNG
-        random = np.random.RandomState(context.config("random_seed"))
+        # Set up RNG (each partition has its own seed)
+        random = np.random.RandomState(random_seed)
 
         # Set up distance sampler
         distance_sampler = CustomDistanceSampler(
@@ -146,59 +263,145 @@ def process(context, destinations, distance_distributions, arguments):
             maximum_iterations=20
         )
 
-        df_locations = []
-        df_convergence = []
+        # Problems as flat arrays, the results are written into arrays of their secondary activities
+        problems = find_assignment_problem_arrays(df_trips, df_primary)
+        number_of_problems = len(problems["sizes"])
+        row_starts = problems["row_starts"]
+        output = dict(
+            location_ids=np.empty(row_starts[-1], dtype=object),
+            coordinates=np.zeros((row_starts[-1], 2)),
+            valid=np.zeros(number_of_problems, dtype=bool),
+            objectives=np.zeros(number_of_problems),
+            facility_indices=[None] * number_of_problems
+        )
+
+        # Telemetry of each problem: solver iterations and time per component, main mode (of the longest trip),
+        # whether solved again or revisited and whether an index of the discretization solver was rebuilt
+        telemetry = {field: np.zeros(number_of_problems) for field in TELEMETRY_FIELDS}
+        main_modes = np.empty(number_of_problems, dtype=object)
+        resolved = np.zeros(number_of_problems, dtype=bool)
+        revisited = np.zeros(number_of_problems, dtype=int)
+        rebuilt = np.zeros(number_of_problems, dtype=bool)
+
+        # Time budgets (in seconds) of the partition and of each chain, if any
+        deadline = time.perf_counter() + time_budget if time_budget > 0 else None
+        chain_budget = chain_time_budget if chain_time_budget > 0 else None
+
+        assigned_person_ids = set()
 
-        last_person_id = None
+        # Problems of the same size are solved in batches, relaxing their chains together
+        batches = find_assignment_problem_batches(problems)
+        if deadline is not None:
+            # Short chains first, so that the budget left for the longest (hardest) ones is known
+            batches = sorted(batches, key=lambda batch: batch[0]["size"])
 
-        for problem in find_assignment_problems(df_trips, df_primary):
+        for batch in batches:
 
             # Define the secondary locations
-            result = assignment_solver.solve(problem)
-
-            for trip_index, (identifier, location, location_index) in enumerate(
-                    zip(result["discretization"]["identifiers"],
-                        result["discretization"]["locations"],
-                        result["discretization"]["indices"])):
-
-                # Decrease the available capacity of the assigned location
-                discretization_solver.data["capacities"][location_index] -= 1
-
-                if discretization_solver.data["capacities"][location_index] < 1:
-                    # If assigned location has no capacity anymore, remove it from the list of possible locations
-                    discretization_solver.update(location_index)
-
-                df_locations.append((
-                    problem["PersonID"],
-                    problem["TripIDs"][trip_index],
-                    problem["TripOrderNums"][trip_index],
-                    problem["modes"][trip_index],
-                    problem["purposes"][trip_index],
-                    identifier,
-                    geo.Point(location)
-                ))
-
-            df_convergence.append((
-                problem["PersonID"], result["valid"], problem["size"]
-            ))
-
-            if problem["PersonID"] != last_person_id:
-                last_person_id = problem["PersonID"]
-                progress.update()
-
-        df_locations = pd.DataFrame.from_records(df_locations, columns=["PersonID",
-                                                                        "TripID",
-                                                                        "TripOrderNum",
-                                                                        "TripMainMode",
-                                                                        "DestPurpose",
-                                                                        "LocationID", "geometry"])
-        df_locations = gpd.GeoDataFrame(df_locations, crs="epsg:5514")
-
-        df_convergence = pd.DataFrame.from_records(df_convergence, columns=["PersonID", "valid", "size"])
-
-    sys.stdout.write("\r")
+            results = assignment_solver.solve_batch(batch, deadline, chain_budget)
+
+            for problem, result in zip(batch, results):
+                index = problem["index"]
+                for field in TELEMETRY_FIELDS:
+                    telemetry[field][index] += result["telemetry"][field]
+
+                if discretization_solver.exhausted(result["discretization"]["facility_indices"]):
+                    # A location was exhausted by a previous problem of the batch, solve again without it
+                    result = assignment_solver.solve(problem, chain_deadline(deadline, chain_budget))
+                    resolved[index] = True
+                    for field in TELEMETRY_FIELDS:
+                        telemetry[field][index] += result["telemetry"][field]
+
+                # Decrease the available capacity of the assigned locations
+                # If assigned location has no capacity anymore, remove it from the list of possible locations
+                rebuilds = discretization_solver.rebuilds
+                for facility_index in result["discretization"]["facility_indices"]:
+                    discretization_solver.consume(facility_index)
+                rebuilt[index] = discretization_solver.rebuilds > rebuilds
+
+                write_result(output, row_starts, index, result)
+                main_modes[index] = problem["modes"][np.argmax(np.nan_to_num(
+                    np.asarray(problem["travel_times"], dtype=float), nan=-np.inf))]
+
+                if problem["PersonID"] not in assigned_person_ids:
+                    assigned_person_ids.add(problem["PersonID"])
+                    progress.update()
+
+        # Revisit the invalid chains (short ones first) with the time left, as long as their results improve
+        improved = deadline is not None
+        while improved and time.perf_counter() < deadline:
+            improved = False
+            invalid = np.flatnonzero(~output["valid"])
+
+            for index in invalid[np.argsort(problems["sizes"][invalid], kind="mergesort")]:
+                if time.perf_counter() >= deadline:
+                    break
+
+                # The locations of the chain are given back while solving it again
+                for facility_index in output["facility_indices"][index]:
+                    discretization_solver.release(facility_index)
+
+                result = assignment_solver.solve(assignment_problem(problems, index),
+                                                 chain_deadline(deadline, chain_budget))
+                revisited[index] += 1
+                for field in TELEMETRY_FIELDS:
+                    telemetry[field][index] += result["telemetry"][field]
+
+                if result["objective"] < output["objectives"][index]:
+                    write_result(output, row_starts, index, result)
+                    improved = True
+
+                for facility_index in output["facility_indices"][index]:
+                    discretization_solver.consume(facility_index)
+
+        # Secondary activities are in the order of the trips, as are the problems
+        trips, activity_trips = problems["trips"], problems["activity_trips"]
+        df_locations = pd.DataFrame({
+            "PersonID": trips["PersonID"][activity_trips],
+            "TripID": trips["TripID"][activity_trips],
+            "TripOrderNum": trips["TripOrderNum"][activity_trips],
+            "TripMainMode": trips["TripMainMode"][activity_trips],
+            "DestPurpose": problems["activity_purposes"],
+            "LocationID": output["location_ids"]
+        })
+        df_locations = gpd.GeoDataFrame(df_locations, geometry=gpd.points_from_xy(output["coordinates"][:, 0],
+                                                                                 output["coordinates"][:, 1]),
+                                        crs="epsg:5514")
 
-    return df_locations, df_convergence
+        df_convergence = pd.DataFrame({"PersonID": problems["person_ids"], "valid": output["valid"],
+                                       "size": problems["sizes"], "TripMainMode": main_modes,
+                                       "objective": output["objectives"], "resolved": resolved,
+                                       "revisited": revisited, "rebuilt": rebuilt})
+        for field in TELEMETRY_FIELDS:
+            df_convergence[field] = telemetry[field]
+
+    if show_progress:
+        sys.stdout.write("\r")
+
+    # Remaining visitors of the quota of the partition
+    return df_locations, df_convergence, destinations["capacity_ledger"].get("Visitors", slice(None))
+
+def telemetry_histograms(df_convergence):
+    """Telemetry of the chains by size and main mode: number of chains, success rate, means of the objective and of
+    the iterations and time of each component, and histograms of the iterations (number of chains per bin)"""
+
+    df_convergence = df_convergence.astype({"valid": bool, "resolved": bool, "revisited": int, "rebuilt": bool,
+                                            "objective": float})
+    keys = ["size", "TripMainMode"]
+
+    aggregations = dict(chains=("valid", "size"), valid=("valid", "mean"), objective=("objective", "mean"),
+                        resolved=("resolved", "sum"), revisited=("revisited", "sum"), rebuilt=("rebuilt", "sum"))
+    aggregations.update({field: (field, "mean") for field in TELEMETRY_FIELDS})
+    df_telemetry = df_convergence.groupby(keys).agg(**aggregations)
+
+    for field in ("assignment_iterations", "sampling_iterations", "relaxation_iterations"):
+        bins = pd.cut(df_convergence[field].astype(float), ITERATION_BINS, right=False)
+        df_histogram = pd.crosstab([df_convergence[key] for key in keys], bins)
+        df_histogram = df_histogram.reindex(columns=bins.cat.categories, fill_value=0)
+        df_histogram.columns = ["%s %s" % (field, interval) for interval in df_histogram.columns]
+        df_telemetry = df_telemetry.join(df_histogram)
+
+    return df_telemetry.fillna(0).reset_index()
 
 def execute(context):
 
@@ -222,39 +425,99 @@ def execute(context):
     destinations = prepare_destinations(context)
     hts_distance_distributions = context.stage("synthesis.population.spatial.by_person.secondary.distance_distributions")
 
-    for df_ind, (df_primary, hts_distributions) in enumerate(zip(all_df_primary, hts_distance_distributions)):
-        print(" For HTS", df_ind)
-
-        # Resample the CrowFliesTripDist distribution per trip mode based on intervals of DeclaredTripTime
-        # for adjustments when results not conforming (not at the moment)
-        resample_distributions(hts_distributions, {
-            "1": 0.0,  # on foot
-            "2": 0.0,  # bike
-            "3": 0.0,  # city public transport
-            "4": 0.0,  # bus (except city public transport)
-            "5": 0.0,  # train (except city public transport)
-            "6": 0.0,  # auto-driver
-            "7": 0.0,  # auto-passenger
-            "8": 0.0,  # other
-            "999": 0.0  # Not identified
-        })
-
-        random = np.random.RandomState(context.config("random_seed"))
-        random_seeds = random.randint(10000, size = 1)
-
-        df_hts_trips = df_trips[df_trips["PersonID"].isin(df_primary["PersonID"])]
-
-        unique_person_ids = df_hts_trips["PersonID"].unique()
-
-        number_of_persons = len(unique_person_ids)
-        batch = (df_hts_trips, df_primary, number_of_persons, random_seeds[0])
-
-        # Run algorithm in one single batch
-        df_hts_locations, df_hts_convergence = process(context, destinations, hts_distributions, batch)
-        df_locations = pd.concat([df_locations, df_hts_locations],
-                                 axis=0, ignore_index=True, sort=False)
-        df_convergence = pd.concat([df_convergence, df_hts_convergence],
-                                   axis=0, ignore_index=True, sort=False)
+    # Time budgets (in seconds) of the whole assignment and of each chain, 0 for none
+    time_budget = context.config("secondary_time_budget")
+    chain_time_budget = context.config("secondary_chain_time_budget")
+    start_time = time.perf_counter()
+    remaining_persons = sum(len(df_primary) for df_primary in all_df_primary)
+
+    # Worker processes of the partitions, created once for all HTS
+    processes = context.config("processes")
+    if processes < 1:
+        processes = mp.cpu_count()
+    pool = mp.Pool(processes) if processes > 1 else None
+    try:
+        for df_ind, (df_primary, hts_distributions) in enumerate(zip(all_df_primary, hts_distance_distributions)):
+            print(" For HTS", df_ind)
+
+            random = np.random.RandomState(context.config("random_seed"))
+            random_seeds = random.randint(10000, size = PARTITIONS)
+
+            df_hts_trips = df_trips[df_trips["PersonID"].isin(df_primary["PersonID"])]
+
+            # Partition the persons by zone of residence, each partition with a quota of the visitors proportional to
+            # its number of trips
+            person_partitions = partition_persons(df_primary, PARTITIONS)
+            trip_partitions = pd.Series(person_partitions, index=df_primary["PersonID"].values).reindex(
+                df_hts_trips["PersonID"].values).values
+            shares = np.bincount(trip_partitions.astype(int), minlength=PARTITIONS) / max(len(df_hts_trips), 1)
+            all_destinations, quotas = partition_destinations(destinations, shares)
+
+            partitions = []
+            arguments = []
+            for partition in range(PARTITIONS):
+                df_partition_trips = df_hts_trips[trip_partitions == partition]
+                number_of_persons = df_partition_trips["PersonID"].nunique()
+                if number_of_persons > 0:
+                    partitions.append((partition, number_of_persons))
+                    arguments.append((all_destinations[partition], hts_distributions, df_partition_trips,
+                                      df_primary[person_partitions == partition], number_of_persons,
+                                      random_seeds[partition]))
+
+            # Run algorithm for each partition in parallel (showing the progress of the partitions if sequential)
+            parallel = pool is not None and len(arguments) > 1
+
+            # The budget left is shared by the HTS by number of persons, and by the partitions of the HTS by number of
+            # persons as well, those running in parallel spending it at the same time
+            hts_time_budget = 0
+            if time_budget > 0:
+                hts_time_budget = ((time_budget - (time.perf_counter() - start_time)) * len(df_primary)
+                                   / remaining_persons)
+            remaining_persons -= len(df_primary)
+            concurrency = min(processes, len(arguments)) if parallel else 1
+            total_persons = max(sum(count for _, count in partitions), 1)
+            arguments = [argument + (max(hts_time_budget * concurrency * number_of_persons / total_persons, 1e-3)
+                                     if time_budget > 0 else 0, chain_time_budget, not parallel)
+                         for argument, (_, number_of_persons) in zip(arguments, partitions)]
+            progress = tqdm(total=sum(count for _, count in partitions), position=0, leave=False, ascii=True,
+                            disable=not parallel)
+            progress.set_description("Assigning secondary locations to partitions")
+
+            all_df_hts_locations = []
+            consumed = np.zeros(len(destinations["facility_indices"]))
+            if parallel:
+                results = pool.imap(process, arguments)
+            else:
+                results = map(process, arguments)
+
+            for (partition, number_of_persons), (df_hts_locations, df_hts_convergence, visitors) in \
+                    zip(partitions, results):
+                consumed += quotas[partition] - visitors[destinations["facility_indices"]]
+                all_df_hts_locations.append(df_hts_locations)
+                df_convergence = pd.concat([df_convergence, df_hts_convergence],
+                                           axis=0, ignore_index=True, sort=False)
+                progress.update(number_of_persons)
+
+            progress.close()
+
+            # Merge the visitors used by the partitions into the shared capacities, then reconcile the overdrawn ones
+            facility_indices = np.asarray(destinations["facility_indices"], dtype=int)
+            visitors = destinations["capacity_ledger"].get("Visitors", facility_indices)
+            excess = consumed - np.floor(np.maximum(visitors, 0))
+            destinations["capacity_ledger"].set("Visitors", facility_indices, visitors - consumed)
+
+            df_hts_locations = pd.concat(all_df_hts_locations, axis=0, ignore_index=True, sort=False)
+            number_of_moves = reconcile_destinations(df_hts_locations, destinations, excess)
+            if number_of_moves > 0:
+                print("  Moved", number_of_moves, "visits of overdrawn facilities")
+
+            df_hts_locations = df_hts_locations.sort_values(by=["PersonID", "TripOrderNum"], kind="mergesort")
+            df_locations = pd.concat([df_locations, df_hts_locations],
+                                     axis=0, ignore_index=True, sort=False)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     val = "{:.0%}".format(df_convergence["valid"].mean())
     print("Success rate:", val + ".",
@@ -262,10 +525,16 @@ def execute(context):
           "Consider increasing \"maximum_iterations\" in the \"AssignmentSolver\" "
           "and thresholds in the \"DiscretizationErrorObjective\".")
 
+    df_telemetry = telemetry_histograms(df_convergence)
+    print("Time per component:", ", ".join("%s %.1fs" % (field.replace("_time", ""), df_convergence[field].sum())
+                                           for field in TELEMETRY_FIELDS if field.endswith("_time")) + ".",
+          "See telemetry_secondary.csv for the iterations by chain size and mode.")
+
     print("Saving secondary locations")
 
     df_locations = gpd.GeoDataFrame(df_locations, crs="epsg:5514")
     df_convergence.to_csv("%s/Locations/convergence_secondary.csv" % context.config("output_path"))
+    df_telemetry.to_csv("%s/Locations/telemetry_secondary.csv" % context.config("output_path"))
     df_locations.to_csv("%s/Locations/locations_secondary.csv" % context.config("output_path"))
     commonFunctions.toXML(df_locations, "%s/Locations/locations_secondary.xml" % context.config("output_path"))
     df_locations.to_file("%s/Locations/locations_secondary.gpkg" % context.config("output_path"), driver="GPKG")
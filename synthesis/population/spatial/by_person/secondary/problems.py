@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 
 # Define globals
 FIELDS = ["PersonID", "TripID", "TripOrderNum", "OriginPurpose", "DestPurpose", "TripMainMode", "DeclaredTripTime"]
@@ -10,91 +11,135 @@ LOCATION_FIELDS = ["PersonID",
                    "4", # work
                    "5"] # location
 
-def find_bare_assignment_problems(df):
-    problem = None
+def point_coordinates(points):
+    """Coordinates of shapely points, NaN for missing points (e.g. None or NaN)"""
 
-    for row in df[FIELDS].itertuples(index = False):
-        PersonID, TripID, TripOrderNum, preceeding_purpose, following_purpose, mode, travel_time = row
+    coordinates = np.full((len(points), 2), np.nan)
+    for index, point in enumerate(points):
+        try:
+            coordinates[index] = point.x, point.y
+        except AttributeError:
+            pass
 
-        if not problem is None and PersonID != problem["PersonID"]:
-            # We switch person, but we're still tracking a problem. This is a tail!
-            yield problem
-            problem = None
+    return coordinates
 
-        if problem is None:
-            # Start a new problem
-            problem = dict(
-                PersonID = PersonID, purposes = [preceeding_purpose],
-                TripIDs = [], TripOrderNums = [], modes = [], travel_times = []
-            )
-
-        problem["purposes"].append(following_purpose)
-        problem["modes"].append(mode)
-        problem["travel_times"].append(travel_time)
-        problem["TripIDs"].append(TripID)
-        problem["TripOrderNums"].append(TripOrderNum)
-
-        if problem["purposes"][-1] in FIXED_PURPOSES:
-            # The current chain (or initial tail) ends with a fixed purpose
-            yield problem
-            problem = None
-
-def find_assignment_problems(df, df_locations):
+def find_assignment_problem_arrays(df, df_locations):
+    """
+        Extracts all assignment problems (chains of secondary activities between fixed ones, and tails) at once as
+        flat arrays (struct of arrays), with:
+          - Trips of problem i: trips[starts[i]:ends[i]] (trips sorted by PersonID and TripOrderNum)
+          - Secondary activities of problem i: activities[row_starts[i]:row_starts[i + 1]] (CSR-like), each one with
+            the trip (index in trips) and purpose it is recorded with
+          - Size, person, and locations of the fixed origin/destination of each problem (NaN if none)
+    """
+    trips = {field: df[field].values for field in FIELDS}
+    person_ids = trips["PersonID"]
+    origin_purposes = trips["OriginPurpose"]
+    destination_purposes = trips["DestPurpose"]
+    number_of_trips = len(person_ids)
+
+    # A problem starts at the first trip of a person or after a trip to a fixed purpose, and ends before the next start
+    fixed_destinations = np.isin(destination_purposes, FIXED_PURPOSES)
+    new_persons = np.ones(number_of_trips, dtype = bool)
+    new_persons[1:] = person_ids[1:] != person_ids[:-1]
+    new_problems = new_persons.copy()
+    new_problems[1:] |= fixed_destinations[:-1]
+
+    starts = np.flatnonzero(new_problems)
+    ends = np.append(starts[1:], number_of_trips)[:len(starts)].astype(int)
+
+    has_origin = np.isin(origin_purposes[starts], FIXED_PURPOSES)
+    has_destination = fixed_destinations[ends - 1]
+    if np.any(~has_origin & ~has_destination):
+        raise RuntimeError("The presented 'problem' is neither a chain nor a tail")
+
+    # Secondary activities are the purposes in between the fixed ones (the origin purpose of the first trip is
+    # one of them if not fixed)
+    sizes = ends - starts + 1 - has_origin - has_destination
+
+    # Locations of the fixed activities of each person, in order of LOCATION_FIELDS
+    location_rows = pd.Index(df_locations["PersonID"].values).get_indexer(person_ids[starts])
+    coordinates = np.stack([point_coordinates(df_locations[purpose].values) for purpose in FIXED_PURPOSES])
+    coordinates = np.concatenate([coordinates, np.full((len(FIXED_PURPOSES), 1, 2), np.nan)], axis = 1)
+
+    origins = np.full((len(starts), 2), np.nan)
+    destinations = np.full((len(starts), 2), np.nan)
+    for purpose_index, purpose in enumerate(FIXED_PURPOSES):
+        f = origin_purposes[starts] == purpose
+        origins[f] = coordinates[purpose_index, location_rows[f]]
+        f = (destination_purposes[ends - 1] == purpose) & has_destination
+        destinations[f] = coordinates[purpose_index, location_rows[f]]
+
+    # We can skip if there are no secondary activities, or no place for the fixed origin or destination
+    f = sizes > 0
+    f &= ~(has_origin & np.isnan(origins).any(axis = 1))
+    f &= ~(has_destination & np.isnan(destinations).any(axis = 1))
+    starts, ends, sizes = starts[f], ends[f], sizes[f]
+    has_origin, has_destination = has_origin[f], has_destination[f]
+    origins, destinations = origins[f], destinations[f]
+
+    row_starts = np.concatenate([[0], np.cumsum(sizes)]).astype(int)
+    activity_problems = np.repeat(np.arange(len(starts)), sizes)
+    activity_offsets = np.arange(row_starts[-1]) - row_starts[activity_problems]
+    activity_trips = starts[activity_problems] + activity_offsets
+    activity_purposes = np.where(has_origin[activity_problems],
+                                 destination_purposes[activity_trips],
+                                 np.where(activity_offsets == 0,
+                                          origin_purposes[activity_trips],
+                                          destination_purposes[np.maximum(activity_trips - 1, 0)]))
+
+    return dict(
+        trips = trips,
+        starts = starts,
+        ends = ends,
+        sizes = sizes,
+        person_ids = person_ids[starts],
+        has_origin = has_origin,
+        has_destination = has_destination,
+        origins = origins,
+        destinations = destinations,
+        row_starts = row_starts,
+        activity_trips = activity_trips,
+        activity_purposes = activity_purposes
+    )
+
+def assignment_problem(problems, index):
     """
-        Enriches assignment problems with:
-          - Locations of the fixed activities
+        Problem i of the problem arrays as used by the solvers, with views on the arrays:
+          - Locations of the fixed activities (None if not fixed)
           - Size of the problem
-          - Reduces purposes to the variable ones
+          - Purposes of the secondary activities
     """
-    location_iterator = df_locations[LOCATION_FIELDS].itertuples(index = False)
-    current_location = None    
-
-    for problem in find_bare_assignment_problems(df):
-        origin_purpose = problem["purposes"][0]
-        destination_purpose = problem["purposes"][-1]
-
-        # Remove home purposes
-        if origin_purpose in FIXED_PURPOSES and destination_purpose in FIXED_PURPOSES:
-            problem["purposes"] = problem["purposes"][1:-1]
-
-        elif origin_purpose in FIXED_PURPOSES:
-            problem["purposes"] = problem["purposes"][1:]
-
-        elif destination_purpose in FIXED_PURPOSES:
-            problem["purposes"] = problem["purposes"][:-1]
-
-        else:
-            raise RuntimeError("The presented 'problem' is neither a chain nor a tail")
-
-        # Define size
-        problem["size"] = len(problem["purposes"])
-
-        if problem["size"] == 0:
-            continue # We can skip if there are no secondary activities
-
-        # Advance location iterator until we arrive at the current problem's person
-        while current_location is None or current_location[0] != problem["PersonID"]:
-            current_location = next(location_iterator)
-
-        # Define origin and destination locations if they have fixed purposes
-        problem["origin"] = None
-        problem["destination"] = None
-
-        if origin_purpose in FIXED_PURPOSES:
-            try:
-                problem["origin"] = current_location[LOCATION_FIELDS.index(origin_purpose)]  # Shapely POINT
-                problem["origin"] = np.array([[problem["origin"].x, problem["origin"].y]])
-            except AttributeError:
-                continue # We can skip if there is no place for the origin
-
-        if destination_purpose in FIXED_PURPOSES:
-            try:
-                problem["destination"] = current_location[LOCATION_FIELDS.index(destination_purpose)] # Shapely POINT
-                problem["destination"] = np.array([[problem["destination"].x, problem["destination"].y]])
-            except AttributeError:
-                continue # We can skip if there is no place for the destination
-
-        yield problem
+    trips = problems["trips"]
+    start, end = problems["starts"][index], problems["ends"][index]
+
+    return dict(
+        index = index,
+        PersonID = problems["person_ids"][index],
+        size = problems["sizes"][index],
+        purposes = problems["activity_purposes"][problems["row_starts"][index]:problems["row_starts"][index + 1]],
+        modes = trips["TripMainMode"][start:end],
+        travel_times = trips["DeclaredTripTime"][start:end],
+        TripIDs = trips["TripID"][start:end],
+        TripOrderNums = trips["TripOrderNum"][start:end],
+        origin = problems["origins"][index:index + 1] if problems["has_origin"][index] else None,
+        destination = problems["destinations"][index:index + 1] if problems["has_destination"][index] else None
+    )
+
+def find_assignment_problem_batches(problems, batch_size = 256):
+    """
+        Groups the assignment problems by size into batches of (at most) batch_size problems,
+        so that the chains of each batch can be relaxed together
+    """
+    pending = dict()
 
+    for index, size in enumerate(problems["sizes"].tolist()):
+        batch = pending.setdefault(size, [])
+        batch.append(assignment_problem(problems, index))
 
+        if len(batch) == batch_size:
+            yield pending.pop(size)
 
+    # Remaining problems of each size
+    for size in sorted(pending.keys()):
+        yield pending[size]
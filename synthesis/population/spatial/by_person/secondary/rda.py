@@ -1,6 +1,11 @@
+import time
 import numpy as np
 import numpy.linalg as la
 
+# Iterations and time (in seconds) spent by each component to solve a problem
+TELEMETRY_FIELDS = ("assignment_iterations", "sampling_iterations", "relaxation_iterations",
+                    "sampling_time", "relaxation_time", "discretization_time", "evaluation_time")
+
 def check_feasibility(distances, direct_distance, consider_total_distance = True):
     return calculate_feasibility(distances, direct_distance, consider_total_distance) == 0.0
 
@@ -16,10 +21,47 @@ def calculate_feasibility(distances, direct_distance, consider_total_distance =
 
     return float(max(delta, 0))
 
+def calculate_feasibility_batch(distances, direct_distance, consider_total_distance = True):
+    """calculate_feasibility for each row of distances (one distance chain per row)"""
+    total_distance = np.sum(distances, axis = 1)
+
+    remaining_distance = total_distance[:, np.newaxis] - distances
+    delta = np.max(distances - direct_distance - remaining_distance, axis = 1)
+
+    if consider_total_distance:
+        delta = np.maximum(delta, direct_distance - total_distance)
+
+    return np.maximum(delta, 0)
+
+def create_telemetry():
+    return dict.fromkeys(TELEMETRY_FIELDS, 0)
+
+def update_telemetry(telemetry, distance_result, relaxation_result, times):
+    """Add one assignment iteration to the telemetry of a problem: iterations of the distance sampler and relaxation
+    solver (None if solved without iterating) and time spent by sampling, relaxation, discretization and evaluation"""
+    telemetry["assignment_iterations"] += 1
+
+    if distance_result["iterations"] is None:
+        telemetry["sampling_iterations"] += 1
+    else:
+        telemetry["sampling_iterations"] += distance_result["iterations"] + 1
+
+    if relaxation_result["iterations"] is not None:
+        telemetry["relaxation_iterations"] += relaxation_result["iterations"] + 1
+
+    for component, component_time in zip(("sampling", "relaxation", "discretization", "evaluation"), times):
+        telemetry[component + "_time"] += component_time
+
+def telemetry_time(telemetry):
+    return sum(telemetry[field] for field in TELEMETRY_FIELDS if field.endswith("_time"))
+
 class DiscretizationSolver:
     def solve(self, problem, locations):
         raise NotImplementedError()
 
+    def solve_batch(self, problems, all_locations):
+        return [self.solve(problem, locations) for problem, locations in zip(problems, all_locations)]
+
 class DistanceSampler:
     def sample(self, problem):
         raise NotImplementedError()
@@ -37,16 +79,26 @@ class AssignmentSolver:
         self.discretization_solver = discretization_solver
         self.objective = objective
 
-    def solve(self, problem):
+    def solve(self, problem, deadline = None):
+        """Solve a problem, stopping with the best result found so far once the deadline (time.perf_counter) passes"""
+
         best_result = None
+        telemetry = create_telemetry()
 
         for assignment_iteration in range(self.maximum_iterations):
+            start_time = time.perf_counter()
             distance_result = self.distance_sampler.sample(problem)
+            sampling_time = time.perf_counter()
             
             relaxation_result = self.relaxation_solver.solve(problem, distance_result["distances"])
+            relaxation_time = time.perf_counter()
             discretization_result = self.discretization_solver.solve(problem, relaxation_result["locations"])
+            discretization_time = time.perf_counter()
 
             assignment_result = self.objective.evaluate(problem, distance_result, relaxation_result, discretization_result)
+            update_telemetry(telemetry, distance_result, relaxation_result, (
+                sampling_time - start_time, relaxation_time - sampling_time,
+                discretization_time - relaxation_time, time.perf_counter() - discretization_time))
 
             if best_result is None or assignment_result["objective"] < best_result["objective"]:
                 best_result = assignment_result
@@ -59,8 +111,71 @@ class AssignmentSolver:
             if best_result["valid"]:
                 break
 
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+
+        best_result["telemetry"] = telemetry
         return best_result
 
+    def solve_batch(self, problems, deadline = None, chain_budget = None):
+        """Solve several problems together (as solve for each one), relaxing the chains of all problems not solved yet
+        in a single batch at each iteration. Problems are no longer iterated once they spent chain_budget seconds, and
+        all of them once the deadline (time.perf_counter) passes, keeping their best result found so far"""
+
+        best_results = [None] * len(problems)
+        telemetries = [create_telemetry() for problem in problems]
+        unsolved = list(range(len(problems)))
+
+        for assignment_iteration in range(self.maximum_iterations):
+            distance_results = []
+            sampling_times = []
+            for index in unsolved:
+                start_time = time.perf_counter()
+                distance_results.append(self.distance_sampler.sample(problems[index]))
+                sampling_times.append(time.perf_counter() - start_time)
+
+            # The time of the batch is shared by its problems
+            start_time = time.perf_counter()
+            relaxation_results = self.relaxation_solver.solve_batch([problems[index] for index in unsolved],
+                                                                    [result["distances"] for result in distance_results])
+            relaxation_time = (time.perf_counter() - start_time) / len(unsolved)
+
+            start_time = time.perf_counter()
+            discretization_results = self.discretization_solver.solve_batch([problems[index] for index in unsolved],
+                                                                            [result["locations"] for result in relaxation_results])
+            discretization_time = (time.perf_counter() - start_time) / len(unsolved)
+
+            for index, distance_result, relaxation_result, discretization_result, sampling_time in zip(
+                    unsolved, distance_results, relaxation_results, discretization_results, sampling_times):
+                start_time = time.perf_counter()
+                assignment_result = self.objective.evaluate(problems[index], distance_result, relaxation_result, discretization_result)
+                update_telemetry(telemetries[index], distance_result, relaxation_result, (
+                    sampling_time, relaxation_time, discretization_time, time.perf_counter() - start_time))
+
+                if best_results[index] is None or assignment_result["objective"] < best_results[index]["objective"]:
+                    best_results[index] = assignment_result
+
+                    assignment_result["distance"] = distance_result
+                    assignment_result["relaxation"] = relaxation_result
+                    assignment_result["discretization"] = discretization_result
+                    assignment_result["iterations"] = assignment_iteration
+
+            unsolved = [index for index in unsolved if not best_results[index]["valid"]]
+
+            if chain_budget is not None:
+                unsolved = [index for index in unsolved if telemetry_time(telemetries[index]) < chain_budget]
+
+            if len(unsolved) == 0:
+                break
+
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+
+        for best_result, telemetry in zip(best_results, telemetries):
+            best_result["telemetry"] = telemetry
+
+        return best_results
+
 class GravityChainSolver:
     def __init__(self, random, alpha = 0.3, eps = 1e-2, maximum_iterations = 1000, lateral_deviation = None):
         self.alpha = alpha
@@ -118,7 +233,10 @@ class GravityChainSolver:
                 valid = True, locations = location.reshape(-1, 2), iterations = None
             )
 
-    def solve(self, problem, distances):
+    def prepare(self, problem, distances):
+        """Initial locations of a chain (including origin and destination) for the gravity simulation, drawing its
+        random numbers, or the result if the chain is solved without simulation (one location or infeasible)"""
+
         origin, destination = problem["origin"], problem["destination"]
 
         if origin is None or destination is None:
@@ -141,7 +259,7 @@ class GravityChainSolver:
 
         # If we have only one variable point, take a short cut
         if problem["size"] == 1:
-             return self.solve_two_points(problem, origin, destination, distances, direction, direct_distance)
+             return self.solve_two_points(problem, origin, destination, distances, direction, direct_distance), None
 
         # Prepare initial locations
         if np.sum(distances) < 1e-12:
@@ -155,48 +273,115 @@ class GravityChainSolver:
         if not check_feasibility(distances, direct_distance):
             return dict( # We still return some locations, although they may not be perfect
                 valid = False, locations = locations[1:-1], iterations = None
-            )
+            ), None
 
         # Add lateral devations
         lateral_deviation = self.lateral_deviation if not self.lateral_deviation is None else max(direct_distance, 1.0)
         locations[1:-1] += normal * 2.0 * (self.random.normal(size = len(distances) - 1)[:, np.newaxis] - 0.5) * lateral_deviation
 
-        # Prepare gravity simulation
-        valid = False
+        return None, locations
 
-        origin_weights = np.ones((len(distances) - 1, 2))
+    def relax(self, locations, distances):
+        """Gravity simulation of a batch of chains of the same size, with locations (batch, size + 2, 2) updated in
+        place and distances (batch, size + 1), converged chains being masked out of the following iterations.
+        Returns whether each chain converged and at which iteration"""
+
+        batch_size, number_of_points = locations.shape[0], locations.shape[1]
+
+        valid = np.zeros(batch_size, dtype = bool)
+        iterations = np.full(batch_size, self.maximum_iterations - 1)
+
+        # Prepare gravity simulation
+        origin_weights = np.ones((number_of_points - 2, 2))
         origin_weights[0,:] = 2.0
 
-        destination_weights = np.ones((len(distances) - 1, 2))
+        destination_weights = np.ones((number_of_points - 2, 2))
         destination_weights[-1,:] = 2.0
 
+        active = np.arange(batch_size)
+        active_locations = locations
+        active_distances = distances
+
         # Run gravity simulation
         for k in range(self.maximum_iterations):
-            directions = locations[:-1] - locations[1:]
-            lengths = la.norm(directions, axis = 1)
+            directions = active_locations[:, :-1] - active_locations[:, 1:]
+            lengths = la.norm(directions, axis = 2)
 
-            offset = distances - lengths
+            offset = active_distances - lengths
             lengths[lengths < 1.0] = 1.0
-            directions /= lengths[:, np.newaxis]
+            directions /= lengths[:, :, np.newaxis]
 
-            if np.all(np.abs(offset) < self.eps): # Check if we have converged
-                valid = True
-                break
+            converged = np.all(np.abs(offset) < self.eps, axis = 1) # Check which chains have converged
+
+            if np.any(converged):
+                valid[active[converged]] = True
+                iterations[active[converged]] = k
+                locations[active[converged]] = active_locations[converged]
+
+                active = active[~converged]
+                active_locations = active_locations[~converged]
+                active_distances = active_distances[~converged]
+                directions = directions[~converged]
+                offset = offset[~converged]
+
+                if len(active) == 0:
+                    break
 
             # Apply adjustment to locations
-            adjustment = np.zeros((len(distances) - 1, 2))
-            adjustment -= 0.5 * self.alpha * offset[:-1, np.newaxis] * directions[:-1] * origin_weights
-            adjustment += 0.5 * self.alpha * offset[1:, np.newaxis] * directions[1:] * destination_weights
+            adjustment = np.zeros((len(active), number_of_points - 2, 2))
+            adjustment -= 0.5 * self.alpha * offset[:, :-1, np.newaxis] * directions[:, :-1] * origin_weights
+            adjustment += 0.5 * self.alpha * offset[:, 1:, np.newaxis] * directions[:, 1:] * destination_weights
 
-            locations[1:-1] += adjustment
+            active_locations[:, 1:-1] += adjustment
 
-            if np.isnan(locations).any() or np.isinf(locations).any():
+            if np.isnan(active_locations).any() or np.isinf(active_locations).any():
                 raise RuntimeError("NaN/Inf value encountered during gravity simulation")
 
+        locations[active] = active_locations
+
+        return valid, iterations
+
+    def solve(self, problem, distances):
+        result, locations = self.prepare(problem, distances)
+
+        if result is not None:
+            return result
+
+        valid, iterations = self.relax(locations[np.newaxis], np.asarray(distances)[np.newaxis])
+
         return dict(
-            valid = valid, locations = locations[1:-1], iterations = k
+            valid = bool(valid[0]), locations = locations[1:-1], iterations = int(iterations[0])
         )
 
+    def solve_batch(self, problems, all_distances):
+        """Solve several chains (as solve for each one, in the same order), running the gravity simulation of the
+        chains of the same size together"""
+
+        results = [None] * len(problems)
+        pending = dict()
+
+        for index, (problem, distances) in enumerate(zip(problems, all_distances)):
+            result, locations = self.prepare(problem, distances)
+
+            if result is not None:
+                results[index] = result
+            else:
+                pending.setdefault(len(distances), []).append((index, locations, distances))
+
+        for chains in pending.values():
+            locations = np.stack([chain_locations for _, chain_locations, _ in chains])
+            distances = np.stack([chain_distances for _, _, chain_distances in chains])
+
+            valid, iterations = self.relax(locations, distances)
+
+            for batch_index, (index, _, _) in enumerate(chains):
+                results[index] = dict(
+                    valid = bool(valid[batch_index]), locations = locations[batch_index, 1:-1],
+                    iterations = int(iterations[batch_index])
+                )
+
+        return results
+
 class FeasibleDistanceSampler(DistanceSampler):
     def __init__(self, random, maximum_iterations = 1000):
         self.maximum_iterations = maximum_iterations
@@ -206,6 +391,10 @@ class FeasibleDistanceSampler(DistanceSampler):
         # Return distance chains per row
         raise NotImplementedError()
 
+    def sample_distances_block(self, problem, count):
+        # Return count distance chains, one per row, as count consecutive calls of sample_distances
+        return np.vstack([self.sample_distances(problem) for k in range(count)])
+
     def sample(self, problem):
         origin, destination = problem["origin"], problem["destination"]
 
@@ -225,21 +414,33 @@ class FeasibleDistanceSampler(DistanceSampler):
 
             return dict(valid = True, distances = distances, iterations = None)
 
-        # This is the general case
+        # This is the general case, distance chains are sampled in blocks of growing size and the first feasible
+        # one (or the first least unfeasible one) is taken, as if sampled one by one
+        direct_distance = float(direct_distance[0])
         best_distances = None
         best_delta = None
 
-        for k in range(self.maximum_iterations):
-            distances = self.sample_distances(problem)
-            delta = calculate_feasibility(distances, direct_distance)
+        start, block_size = 0, 8
+        while start < self.maximum_iterations:
+            count = min(block_size, self.maximum_iterations - start)
+            distances = self.sample_distances_block(problem, count)
+            deltas = calculate_feasibility_batch(distances, direct_distance)
 
-            if best_delta is None or delta < best_delta:
-                best_delta = delta
-                best_distances = distances
+            index = np.argmin(deltas)
+            k = start + index
+            if best_delta is None or deltas[index] < best_delta:
+                best_delta = deltas[index]
+                best_distances = distances[index]
 
-                if delta == 0.0:
+                if best_delta == 0.0:
                     break
 
+            start += count
+            block_size *= 2
+
+        if best_delta > 0.0:
+            k = self.maximum_iterations - 1
+
         return dict(
             valid = best_delta == 0.0,
             distances = best_distances,